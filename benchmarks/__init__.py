@@ -0,0 +1,12 @@
+"""
+epub服务器的基准测试与压力测试工具
+
+- synthetic: 生成指定大小的合成电子书
+- server:    以子进程方式启动/停止epub服务器并读取内存占用
+- loadtest:  模拟多台设备访问服务器，输出JSON格式的延迟、吞吐量和内存数据
+- compare:   对比两次基准测试结果，用于发现不同提交之间的性能回退
+
+用法示例:
+    python -m benchmarks.loadtest --devices 8 --chapters 40 --output result.json
+    python -m benchmarks.compare baseline.json result.json
+"""
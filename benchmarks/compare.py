@@ -0,0 +1,53 @@
+import argparse
+import json
+import sys
+
+def load(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def compare(baseline, current, threshold):
+    """对比两次结果，返回(报告行列表, 是否存在超过阈值的回退)"""
+    lines = []
+    regressed = False
+    
+    def row(name, before, after, lower_is_better=True):
+        nonlocal regressed
+        if before in (None, 0) or after is None:
+            lines.append(f"{name:<32} {before!s:>12} {after!s:>12}")
+            return
+        change = (after - before) / before * 100
+        worse = change > threshold if lower_is_better else change < -threshold
+        mark = '  <-- 回退' if worse else ''
+        regressed = regressed or worse
+        lines.append(f"{name:<32} {before:>12} {after:>12} {change:>+8.1f}%{mark}")
+    
+    lines.append(f"{'指标':<32} {'基准':>12} {'当前':>12} {'变化':>9}")
+    row('throughput_rps', baseline.get('throughput_rps'), current.get('throughput_rps'), lower_is_better=False)
+    row('startup_seconds', baseline.get('startup_seconds'), current.get('startup_seconds'))
+    kinds = sorted(set(baseline.get('latency_ms', {})) | set(current.get('latency_ms', {})))
+    for kind in kinds:
+        before = baseline.get('latency_ms', {}).get(kind, {})
+        after = current.get('latency_ms', {}).get(kind, {})
+        for key in ('p50', 'p99'):
+            row(f'latency_ms.{kind}.{key}', before.get(key), after.get(key))
+    for key in ('idle', 'peak'):
+        row(f'rss_bytes.{key}', baseline.get('rss_bytes', {}).get(key), current.get('rss_bytes', {}).get(key))
+    return lines, regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='对比两次基准测试结果')
+    parser.add_argument('baseline', type=str, help='基准结果JSON')
+    parser.add_argument('current', type=str, help='当前结果JSON')
+    parser.add_argument('--threshold', type=float, default=10.0, help='判定为回退的变化百分比')
+    args = parser.parse_args(argv)
+    
+    baseline = load(args.baseline)
+    current = load(args.current)
+    print(f"基准: {baseline.get('commit')}  当前: {current.get('commit')}")
+    lines, regressed = compare(baseline, current, args.threshold)
+    print('\n'.join(lines))
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
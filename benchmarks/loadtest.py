@@ -0,0 +1,241 @@
+import argparse
+import http.client
+import json
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import urljoin, urlparse
+
+from .server import REPO_DIR, ServerProcess, read_rss
+from .synthetic import make_synthetic_epub
+
+ASSET_PATTERN = re.compile(r'<(?:script[^>]*\ssrc|link[^>]*\shref)="([^"]+)"')
+COMMENT_PATTERN = re.compile(r'<!--.*?-->', re.S)
+BOOK_PATH_PATTERNS = (
+    re.compile(r'serverBookPath\s*=\s*("(?:[^"\\]|\\.)*")'),
+    re.compile(r'"bookPath"\s*:\s*("(?:[^"\\]|\\.)*")'),
+)
+
+def percentiles(values):
+    """计算延迟分布（毫秒）"""
+    if not values:
+        return {'count': 0}
+    ordered = sorted(values)
+    def pick(p):
+        index = min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered) + 0.5)) - 1))
+        return round(ordered[index] * 1000, 3)
+    return {
+        'count': len(ordered),
+        'mean': round(sum(ordered) / len(ordered) * 1000, 3),
+        'p50': pick(50),
+        'p90': pick(90),
+        'p99': pick(99),
+        'max': round(ordered[-1] * 1000, 3),
+    }
+
+def find_book_path(html):
+    """从注入后的index.html中找到服务器指定的电子书路径"""
+    for pattern in BOOK_PATH_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return json.loads(match.group(1))
+    return None
+
+class Recorder:
+    """线程安全地收集每个请求的耗时"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.bytes_received = 0
+    
+    def record(self, kind, seconds, size, ok):
+        with self._lock:
+            if ok:
+                self.latencies.setdefault(kind, []).append(seconds)
+                self.bytes_received += size
+            else:
+                self.errors[kind] = self.errors.get(kind, 0) + 1
+
+def fetch(base_url, method, path, recorder, kind, body=None, headers=None, cookies=None):
+    """
+    发送一个请求并记录到最后一个字节的耗时，返回响应内容（失败时返回None）。
+    cookies为字典时随请求发送，并保存响应中设置的Cookie（与浏览器一样保持设备标识）
+    """
+    parsed = urlparse(base_url)
+    headers = dict(headers or {})
+    if cookies:
+        headers['Cookie'] = '; '.join(f'{name}={value}' for name, value in cookies.items())
+    start = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection(parsed.hostname, parsed.port, timeout=30)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+        if cookies is not None:
+            for header in response.headers.get_all('Set-Cookie') or ():
+                name, _, value = header.split(';', 1)[0].partition('=')
+                cookies[name.strip()] = value.strip()
+        ok = 200 <= response.status < 400
+        recorder.record(kind, time.perf_counter() - start, len(data), ok)
+        return data if ok else None
+    except Exception:
+        recorder.record(kind, time.perf_counter() - start, 0, False)
+        return None
+
+def simulate_device(base_url, recorder, bursts, burst_size, think_seconds):
+    """
+    模拟一台设备：
+    打开index.html -> 加载页面引用的脚本和样式 -> 下载电子书 -> 若干轮连续翻页（保存进度）。
+    设备标识由服务器在打开页面时通过Cookie分配，保存进度时带上
+    """
+    cookies = {}
+    html = fetch(base_url, 'GET', '/', recorder, 'html', cookies=cookies)
+    if html is None:
+        return
+    html = html.decode('utf-8', 'replace')
+    for asset in ASSET_PATTERN.findall(COMMENT_PATTERN.sub('', html)):
+        if asset.startswith(('http://', 'https://', '//', 'data:')):
+            continue
+        fetch(base_url, 'GET', urljoin('/', asset), recorder, 'asset')
+    
+    book_path = find_book_path(html)
+    if book_path:
+        fetch(base_url, 'GET', urljoin('/', book_path), recorder, 'book')
+    
+    for burst in range(bursts):
+        for page in range(burst_size):
+            cfi = f"epubcfi(/6/{2 * (burst + 1)}!/4/{2 * (page + 1)}/1:0)"
+            body = json.dumps({'book_path': book_path, 'cfi': cfi}).encode('utf-8')
+            fetch(base_url, 'POST', '/api/save_history', recorder, 'save_history', body=body,
+                  headers={'Content-Type': 'application/json'}, cookies=cookies)
+        if think_seconds:
+            time.sleep(think_seconds)
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(REPO_DIR), capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def run_loadtest(args):
+    """运行一次压力测试，返回结果字典"""
+    # 合成电子书放在临时的工作目录中，结束时删除
+    work_dir = Path(tempfile.mkdtemp(prefix="epub-bench-"))
+    try:
+        if args.epub:
+            epub_path = Path(args.epub).resolve()
+        else:
+            epub_path = make_synthetic_epub(work_dir / "synthetic.epub", args.chapters, args.chapter_kb,
+                                            args.images, args.image_kb, seed=args.seed)
+        book_bytes = epub_path.stat().st_size
+        
+        server = ServerProcess(epub_path, port=args.port, extra_args=args.server_arg,
+                               log_path=args.server_log)
+        startup_seconds = server.start()
+        try:
+            idle_rss, _ = server.rss()
+            recorder = Recorder()
+            peak_rss = [idle_rss or 0]
+            sampling = threading.Event()
+            
+            def sample_rss():
+                while not sampling.wait(0.05):
+                    rss, _ = read_rss(server.process.pid)
+                    if rss:
+                        peak_rss[0] = max(peak_rss[0], rss)
+            
+            sampler = threading.Thread(target=sample_rss, daemon=True)
+            sampler.start()
+            
+            devices = [threading.Thread(target=simulate_device,
+                                        args=(server.base_url, recorder, args.bursts, args.burst_size,
+                                              args.think_ms / 1000.0))
+                       for _ in range(args.devices)]
+            start = time.perf_counter()
+            for device in devices:
+                device.start()
+            for device in devices:
+                device.join()
+            duration = time.perf_counter() - start
+            sampling.set()
+            sampler.join()
+            end_rss, hwm_rss = server.rss()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    total_requests = len(all_latencies) + sum(recorder.errors.values())
+    return {
+        'benchmark': 'loadtest',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {
+            'devices': args.devices,
+            'bursts': args.bursts,
+            'burst_size': args.burst_size,
+            'think_ms': args.think_ms,
+            'chapters': None if args.epub else args.chapters,
+            'chapter_kb': None if args.epub else args.chapter_kb,
+            'images': None if args.epub else args.images,
+            'image_kb': None if args.epub else args.image_kb,
+            'server_args': args.server_arg,
+        },
+        'book_bytes': book_bytes,
+        'startup_seconds': round(startup_seconds, 4),
+        'duration_seconds': round(duration, 4),
+        'requests': total_requests,
+        'errors': recorder.errors,
+        'throughput_rps': round(len(all_latencies) / duration, 2) if duration else None,
+        'bytes_received': recorder.bytes_received,
+        'latency_ms': dict({'all': percentiles(all_latencies)},
+                           **{kind: percentiles(values) for kind, values in sorted(recorder.latencies.items())}),
+        'rss_bytes': {'idle': idle_rss, 'peak_sampled': peak_rss[0] or None, 'peak': hwm_rss, 'end': end_rss},
+    }
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='epub服务器压力测试（不需要浏览器）')
+    parser.add_argument('--devices', type=int, default=4, help='模拟的设备数')
+    parser.add_argument('--bursts', type=int, default=10, help='每台设备的连续翻页轮数')
+    parser.add_argument('--burst-size', type=int, default=5, help='每轮连续翻页次数（每次保存一次进度）')
+    parser.add_argument('--think-ms', type=float, default=0, help='每轮翻页之间的停顿（毫秒）')
+    parser.add_argument('--epub', type=str, help='使用已有电子书（不指定时生成合成电子书）')
+    parser.add_argument('--chapters', type=int, default=20, help='合成电子书章节数')
+    parser.add_argument('--chapter-kb', type=int, default=50, help='合成电子书每章大小（KB）')
+    parser.add_argument('--images', type=int, default=0, help='合成电子书图片数量')
+    parser.add_argument('--image-kb', type=int, default=200, help='合成电子书每张图片大小（KB）')
+    parser.add_argument('--seed', type=int, default=0, help='合成电子书随机种子')
+    parser.add_argument('--port', type=int, help='服务器端口（默认自动选择空闲端口）')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help='传给服务器的额外参数，可多次指定，如 --server-arg=--trace')
+    parser.add_argument('--server-log', type=str, help='服务器输出保存路径')
+    parser.add_argument('--output', type=str, help='结果JSON保存路径（不指定时输出到标准输出）')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    result = run_loadtest(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+        print(f"结果已保存: {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
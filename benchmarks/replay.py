@@ -0,0 +1,166 @@
+import argparse
+import gzip
+import json
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .loadtest import Recorder, fetch, find_book_path, git_commit, percentiles
+from .server import ServerProcess
+from .synthetic import make_synthetic_epub
+
+def load_trace(path):
+    """读取服务器--record-trace记录的轨迹，返回(文件头, 请求列表)"""
+    path = Path(path)
+    opener = gzip.open if path.suffix == '.gz' else open
+    header = {}
+    requests = []
+    with opener(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 服务器被强制结束时最后一行可能不完整
+                    continue
+                if 'version' in record:
+                    header = record
+                else:
+                    requests.append(record)
+        except EOFError:
+            # 服务器被强制结束时gzip文件没有结尾
+            pass
+    requests.sort(key=lambda r: r['t'])
+    return header, requests
+
+def build_body(record, book_path):
+    """按记录的请求体大小生成请求体（/api/save_history生成合法的JSON）"""
+    size = record.get('b') or 0
+    if record['p'].split('?')[0] == '/api/save_history':
+        data = {'book_path': book_path, 'cfi': 'epubcfi(/6/2!/4/2/1:0)'}
+        base = len(json.dumps(data).encode('utf-8'))
+        if size > base + 10:
+            data['pad'] = 'x' * (size - base - 10)
+        return json.dumps(data).encode('utf-8')
+    return b'x' * size if size else None
+
+def replay(base_url, requests, speed, concurrency, rewrite_book=True):
+    """按记录的时间间隔（除以speed）重放请求，返回Recorder"""
+    recorder = Recorder()
+    book_path = None
+    if rewrite_book:
+        # 目标服务器上的电子书路径可能与记录时不同
+        html = fetch(base_url, 'GET', '/', Recorder(), 'probe')
+        if html:
+            book_path = find_book_path(html.decode('utf-8', 'replace'))
+    
+    def send(record):
+        path = record['p']
+        if rewrite_book and book_path and path.split('?')[0].endswith('.epub'):
+            path = '/' + book_path.lstrip('/')
+        headers = dict(record.get('h') or {})
+        body = build_body(record, book_path) if record['m'] == 'POST' else None
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        fetch(base_url, record['m'], path, recorder, record.get('r') or 'other', body=body, headers=headers)
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for record in requests:
+            delay = record['t'] / speed - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(send, record)
+    recorder.duration = time.perf_counter() - start
+    return recorder
+
+def recorded_latencies(requests):
+    """记录中服务器端的处理耗时（秒），按路由分组"""
+    groups = {}
+    for record in requests:
+        groups.setdefault(record.get('r') or 'other', []).append(record['d'] / 1000.0)
+    return groups
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='重放服务器记录的请求轨迹并对比延迟分布')
+    parser.add_argument('trace', type=str, help='服务器--record-trace生成的轨迹文件')
+    parser.add_argument('--target', type=str, help='目标服务器地址，如http://127.0.0.1:10086（不指定时自动启动一个）')
+    parser.add_argument('--epub', type=str, help='自动启动服务器时使用的电子书（不指定时生成合成电子书）')
+    parser.add_argument('--server-arg', action='append', default=[], help='传给自动启动的服务器的额外参数')
+    parser.add_argument('--speed', type=float, default=1.0, help='重放速度倍数，如10表示加速10倍')
+    parser.add_argument('--concurrency', type=int, default=32, help='最大并发请求数')
+    parser.add_argument('--no-rewrite-book', action='store_true', help='不把.epub请求改写为目标服务器上的电子书路径')
+    parser.add_argument('--output', type=str, help='结果JSON保存路径（不指定时输出到标准输出）')
+    args = parser.parse_args(argv)
+    
+    header, requests = load_trace(args.trace)
+    if not requests:
+        print("轨迹文件中没有请求", file=sys.stderr)
+        return 1
+    
+    server = None
+    work_dir = None
+    base_url = args.target
+    try:
+        if not base_url:
+            epub_path = args.epub
+            if not epub_path:
+                # 合成电子书放在临时的工作目录中，结束时删除
+                work_dir = Path(tempfile.mkdtemp(prefix="epub-replay-"))
+                epub_path = make_synthetic_epub(work_dir / "synthetic.epub")
+            server = ServerProcess(epub_path, extra_args=args.server_arg)
+            server.start()
+            base_url = server.base_url
+        recorder = replay(base_url, requests, args.speed, args.concurrency, not args.no_rewrite_book)
+        rss = server.rss() if server else (None, None)
+    finally:
+        if server:
+            server.stop()
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    
+    replayed = recorder.latencies
+    recorded = recorded_latencies(requests)
+    all_replayed = [value for values in replayed.values() for value in values]
+    result = {
+        'benchmark': 'replay',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'trace': str(args.trace),
+        'trace_started': header.get('started'),
+        'params': {'speed': args.speed, 'concurrency': args.concurrency, 'target': args.target},
+        'requests': len(requests),
+        'errors': recorder.errors,
+        'trace_duration_seconds': round(requests[-1]['t'], 4),
+        'duration_seconds': round(recorder.duration, 4),
+        'throughput_rps': round(len(all_replayed) / recorder.duration, 2) if recorder.duration else None,
+        'latency_ms': dict({'all': percentiles(all_replayed)},
+                           **{kind: percentiles(values) for kind, values in sorted(replayed.items())}),
+        'recorded_server_ms': {kind: percentiles(values) for kind, values in sorted(recorded.items())},
+        'rss_bytes': {'end': rss[0], 'peak': rss[1]},
+    }
+    
+    # 记录的是服务器端处理耗时，重放的是客户端看到的完整耗时（包含连接和传输）
+    print(f"{'路由':<16} {'记录p50':>10} {'重放p50':>10} {'记录p99':>10} {'重放p99':>10}", file=sys.stderr)
+    for kind in sorted(set(recorded) | set(replayed)):
+        before = result['recorded_server_ms'].get(kind, {})
+        after = result['latency_ms'].get(kind, {})
+        print(f"{kind:<16} {before.get('p50', '-'):>10} {after.get('p50', '-'):>10} "
+              f"{before.get('p99', '-'):>10} {after.get('p99', '-'):>10}", file=sys.stderr)
+    
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+        print(f"结果已保存: {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+SERVER_SCRIPT = REPO_DIR / "epub服务器.py"
+
+def find_free_port(ip="127.0.0.1"):
+    """由系统分配一个空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((ip, 0))
+        return s.getsockname()[1]
+
+def read_rss(pid):
+    """读取进程的常驻内存（字节），返回(当前值, 峰值)；无法读取时返回(None, None)"""
+    status = Path(f"/proc/{pid}/status")
+    if status.exists():
+        values = {}
+        for line in status.read_text().splitlines():
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                key, value = line.split(':', 1)
+                values[key] = int(value.split()[0]) * 1024
+        return values.get('VmRSS'), values.get('VmHWM')
+    try:
+        import psutil
+        info = psutil.Process(pid).memory_info()
+        return info.rss, getattr(info, 'peak_wset', None)
+    except Exception:
+        return None, None
+
+class ServerProcess:
+    """
+    以子进程方式运行epub服务器（历史记录、缓存等数据写入临时目录，停止时删除，不打开浏览器）
+    epub_path为None时不指定电子书（用于测试自带附加数据的打包程序）
+    """
+    def __init__(self, epub_path, title="benchmark", ip="127.0.0.1", port=None,
+                 extra_args=None, command=None, log_path=None, env=None):
+        self.epub_path = Path(epub_path).resolve() if epub_path else None
+        self.title = title
+        self.ip = ip
+        self.port = port or find_free_port(ip)
+        self.extra_args = list(extra_args or [])
+        self.command = command
+        self.log_path = log_path
+        self.env = dict(env or {})
+        self.data_dir = Path(tempfile.mkdtemp(prefix="epub-bench-data-"))
+        self.process = None
+        self._log = None
+    
+    @property
+    def base_url(self):
+        return f"http://{self.ip}:{self.port}"
+    
+    def start(self, timeout=30.0, wait=True):
+        """启动服务器并等待端口可连接，返回从启动到可连接的秒数"""
+        command = self.command or [sys.executable, str(SERVER_SCRIPT)]
+        book_args = ['--title', self.title, '--epub', str(self.epub_path)] if self.epub_path else []
+        args = command + book_args + [
+            '--ip', self.ip,
+            '--port', str(self.port),
+            '--data-dir', str(self.data_dir),
+            '--no-browser',
+        ] + self.extra_args
+        self._log = open(self.log_path, 'w', encoding='utf-8') if self.log_path else subprocess.DEVNULL
+        env = dict(os.environ, PYTHONIOENCODING='utf-8', **self.env)
+        start = time.perf_counter()
+        self.process = subprocess.Popen(args, cwd=str(REPO_DIR), stdin=subprocess.DEVNULL,
+                                        stdout=self._log, stderr=subprocess.STDOUT, env=env)
+        if wait:
+            self.wait_ready(timeout)
+        return time.perf_counter() - start
+    
+    def wait_ready(self, timeout=30.0):
+        """等待服务器端口可连接"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"服务器进程已退出，返回码: {self.process.returncode}")
+            try:
+                with socket.create_connection((self.ip, self.port), timeout=0.5):
+                    return
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"服务器在{timeout}秒内未就绪")
+    
+    def rss(self):
+        if self.process is None:
+            return None, None
+        return read_rss(self.process.pid)
+    
+    def stop(self, timeout=10.0):
+        """停止服务器并清理临时文件"""
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self._log not in (None, subprocess.DEVNULL):
+            self._log.close()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        # 绝对路径的电子书会被复制到reader/tmp，服务器被终止时可能来不及清理
+        tmp_dir = REPO_DIR / "reader" / "tmp"
+        if tmp_dir.exists():
+            for leftover in tmp_dir.glob(f"{self.title}*.epub"):
+                leftover.unlink()
+            if not any(tmp_dir.iterdir()):
+                tmp_dir.rmdir()
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self.stop()
+        return False
@@ -0,0 +1,114 @@
+import argparse
+import http.client
+import json
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from .server import ServerProcess
+from .synthetic import make_synthetic_epub
+
+def slow_header_client(ip, port, interval, results):
+    """每隔interval秒发送请求头的一个字节（始终不超过单次读超时），记录连接被服务器关闭时用了多少秒"""
+    request = b"GET /index.html HTTP/1.1\r\nHost: x\r\n" + b"X-Slow: " + b"a" * 4096
+    start = time.perf_counter()
+    try:
+        with socket.create_connection((ip, port), timeout=interval * 4) as sock:
+            for byte in request:
+                sock.sendall(bytes([byte]))
+                time.sleep(interval)
+                # 服务器关闭连接后对方的数据可读（空数据或408响应）
+                sock.setblocking(False)
+                try:
+                    sock.recv(1024)
+                    break
+                except BlockingIOError:
+                    pass
+                finally:
+                    sock.setblocking(True)
+    except OSError:
+        pass
+    results.append(time.perf_counter() - start)
+
+def normal_request(ip, port):
+    """请求一次首页，返回(状态码, 秒数)"""
+    start = time.perf_counter()
+    conn = http.client.HTTPConnection(ip, port, timeout=30)
+    try:
+        conn.request('GET', '/index.html')
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查慢速发送请求头的客户端不会一直占用工作线程')
+    parser.add_argument('--clients', type=int, default=8, help='慢速客户端数（默认为工作线程数的2倍，占满所有工作线程）')
+    parser.add_argument('--workers', type=int, default=4, help='服务器工作线程数')
+    parser.add_argument('--idle-timeout', type=float, default=2.0, help='服务器的空闲超时（秒）')
+    parser.add_argument('--read-timeout', type=float, default=2.0, help='服务器的读超时（秒）')
+    parser.add_argument('--output', type=str, help='结果JSON保存路径（不指定时输出到标准输出）')
+    args = parser.parse_args(argv)
+    
+    # 每个字节的间隔小于读超时，只靠单次读超时无法断开这些连接
+    interval = args.read_timeout / 2
+    limit = args.idle_timeout + args.read_timeout
+    work_dir = Path(tempfile.mkdtemp(prefix="epub-slowclient-"))
+    try:
+        epub_path = make_synthetic_epub(work_dir / "synthetic.epub", 3)
+        server = ServerProcess(epub_path, extra_args=[
+            '--workers', str(args.workers),
+            '--client-limit', str(args.clients + 4),
+            '--accept-queue', str(args.clients + 4),
+            '--idle-timeout', str(args.idle_timeout),
+            '--read-timeout', str(args.read_timeout),
+        ])
+        server.start()
+        try:
+            normal_request(server.ip, server.port)
+            results = []
+            clients = [threading.Thread(target=slow_header_client,
+                                        args=(server.ip, server.port, interval, results))
+                       for _ in range(args.clients)]
+            for client in clients:
+                client.start()
+            # 慢速客户端占满工作线程后，普通请求要等到它们被断开
+            time.sleep(interval)
+            status, seconds = normal_request(server.ip, server.port)
+            for client in clients:
+                client.join()
+        finally:
+            server.stop()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    # 每个工作线程依次处理排队的连接，每个连接最多占用总时限：
+    # 所有慢速客户端和普通请求都应在(轮数 x 总时限 + 检测间隔的余量)内结束，没有总时限时慢速客户端会一直占用
+    rounds = -(-(args.clients + 1) // args.workers)
+    bound = rounds * limit + interval * 2
+    slowest = max(results)
+    passed = status == 200 and slowest <= bound and seconds <= bound
+    result = {
+        'benchmark': 'slowclient',
+        'params': {'clients': args.clients, 'workers': args.workers, 'idle_timeout': args.idle_timeout,
+                   'read_timeout': args.read_timeout, 'byte_interval': interval},
+        'slow_client_closed_after_s': {'min': round(min(results), 2), 'max': round(slowest, 2)},
+        'bound_s': round(bound, 2),
+        'normal_request': {'status': status, 'seconds': round(seconds, 2)},
+        'passed': passed,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+        print(f"结果已保存: {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0 if passed else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+import argparse
+import http.client
+import json
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from .loadtest import git_commit
+from .server import ServerProcess
+from .synthetic import make_synthetic_epub
+
+# 与epub服务器.py中的ASSET_CACHE_ENV一致：服务器--asset-mode cache使用这个环境变量指定的解压缓存目录
+ASSET_CACHE_ENV = "EPUB_READER_ASSET_CACHE"
+
+def measure_launch(server, timeout=60.0):
+    """启动服务器并反复请求'/'，返回(到可连接的秒数, 到首字节的秒数, 到完整响应的秒数)"""
+    start = time.perf_counter()
+    server.start(wait=False)
+    connected = None
+    deadline = start + timeout
+    while time.perf_counter() < deadline:
+        if server.process.poll() is not None:
+            raise RuntimeError(f"服务器进程已退出，返回码: {server.process.returncode}")
+        conn = http.client.HTTPConnection(server.ip, server.port, timeout=10)
+        try:
+            conn.connect()
+            if connected is None:
+                connected = time.perf_counter() - start
+            conn.request('GET', '/')
+            response = conn.getresponse()
+            first_byte = time.perf_counter() - start
+            response.read()
+            return connected, first_byte, time.perf_counter() - start
+        except OSError:
+            time.sleep(0.002)
+        finally:
+            conn.close()
+    raise TimeoutError(f"服务器在{timeout}秒内没有响应")
+
+def summarize(values):
+    return {
+        'min': round(min(values) * 1000, 2),
+        'median': round(statistics.median(values) * 1000, 2),
+        'max': round(max(values) * 1000, 2),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='测量服务器从启动到返回首字节的时间')
+    parser.add_argument('--exe', type=str, help='测试打包后的程序（使用程序自带的附加数据）')
+    parser.add_argument('--asset-mode', choices=['archive', 'cache'], help='打包程序的阅读器资源使用方式')
+    parser.add_argument('--cold-cache', action='store_true',
+                        help='每次启动前清空资源解压缓存（测量首次启动，使用临时的缓存目录，不影响正在运行的程序）')
+    parser.add_argument('--epub', type=str, help='测试脚本时使用的电子书（不指定时生成合成电子书）')
+    parser.add_argument('--runs', type=int, default=5, help='启动次数')
+    parser.add_argument('--output', type=str, help='结果JSON保存路径（不指定时输出到标准输出）')
+    args = parser.parse_args(argv)
+    
+    extra_args = ['--asset-mode', args.asset_mode] if args.asset_mode else []
+    # 合成电子书和临时的资源解压缓存都放在工作目录中，结束时删除
+    work_dir = Path(tempfile.mkdtemp(prefix="epub-startup-"))
+    env = {}
+    if args.cold_cache:
+        cache_root = work_dir / "asset-cache"
+        env[ASSET_CACHE_ENV] = str(cache_root)
+    if args.exe:
+        command = [str(Path(args.exe).resolve())]
+        epub_path = None
+    else:
+        command = None
+        epub_path = args.epub or make_synthetic_epub(work_dir / "synthetic.epub")
+    
+    runs = []
+    try:
+        for _ in range(args.runs):
+            if args.cold_cache:
+                shutil.rmtree(cache_root, ignore_errors=True)
+            server = ServerProcess(epub_path, command=command, extra_args=extra_args, env=env)
+            try:
+                connected, first_byte, complete = measure_launch(server)
+            finally:
+                server.stop()
+            runs.append({'connect': connected, 'first_byte': first_byte, 'complete': complete})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    
+    result = {
+        'benchmark': 'startup',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'commit': git_commit(),
+        'params': {'exe': args.exe, 'asset_mode': args.asset_mode, 'cold_cache': args.cold_cache, 'runs': args.runs},
+        'launch_to_connect_ms': summarize([r['connect'] for r in runs if r['connect'] is not None]),
+        'launch_to_first_byte_ms': summarize([r['first_byte'] for r in runs]),
+        'launch_to_complete_ms': summarize([r['complete'] for r in runs]),
+        'startup_seconds': round(statistics.median(r['first_byte'] for r in runs), 4),
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+        print(f"结果已保存: {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+import random
+import struct
+import zipfile
+import zlib
+from pathlib import Path
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog reader server chapter page night "
+    "river mountain letter window garden story morning silence journey light "
+    "春 夏 秋 冬 山 水 风 雨 书 页 夜 灯 路 远 梦 云"
+).split()
+
+def _png_bytes(width, height, rng):
+    """生成随机噪点PNG（噪点几乎无法压缩，文件大小约等于width*height*3）"""
+    raw = bytearray()
+    for _ in range(height):
+        raw.append(0)
+        raw.extend(rng.getrandbits(8) for _ in range(width * 3))
+    
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack('>I', len(data)) + body + struct.pack('>I', zlib.crc32(body) & 0xffffffff)
+    
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(bytes(raw), 1)) + chunk(b'IEND', b''))
+
+def _paragraphs(target_bytes, rng):
+    """生成总大小约为target_bytes的段落"""
+    paragraphs = []
+    size = 0
+    while size < target_bytes:
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+        paragraphs.append(f"<p>{text}</p>")
+        size += len(paragraphs[-1].encode('utf-8'))
+    return paragraphs
+
+def make_synthetic_epub(path, chapters=20, chapter_kb=50, images=0, image_kb=200,
+                        title="Synthetic Benchmark Book", seed=0):
+    """
+    生成合成电子书（EPUB 3，带nav和NCX）
+    - chapters: 章节数
+    - chapter_kb: 每章正文大小（KB）
+    - images: 图片数量（平均分布到各章节）
+    - image_kb: 每张图片大小（KB）
+    返回生成文件的路径
+    """
+    rng = random.Random(seed)
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    
+    side = max(8, int((image_kb * 1024 / 3) ** 0.5))
+    manifest = []
+    spine = []
+    nav_items = []
+    ncx_points = []
+    
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        z.writestr('META-INF/container.xml',
+                   '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>')
+        z.writestr('OEBPS/style.css', 'body { font-family: serif; line-height: 1.6; }\n'
+                                      'h1 { text-align: center; }\nimg { max-width: 100%; }\n')
+        manifest.append('<item id="css" href="style.css" media-type="text/css"/>')
+        
+        for i in range(images):
+            name = f'images/img{i + 1:04d}.png'
+            z.writestr(f'OEBPS/{name}', _png_bytes(side, side, rng), compress_type=zipfile.ZIP_STORED)
+            manifest.append(f'<item id="img{i + 1}" href="{name}" media-type="image/png"/>')
+        
+        for i in range(chapters):
+            number = i + 1
+            name = f'chapter{number:04d}.xhtml'
+            body = _paragraphs(chapter_kb * 1024, rng)
+            chapter_images = [j for j in range(images) if j % max(chapters, 1) == i]
+            for j in chapter_images:
+                body.insert(len(body) // 2, f'<p><img src="images/img{j + 1:04d}.png" alt="image {j + 1}"/></p>')
+            z.writestr(f'OEBPS/{name}',
+                       '<?xml version="1.0" encoding="UTF-8"?>\n'
+                       '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+                       f'<title>Chapter {number}</title>'
+                       '<link rel="stylesheet" type="text/css" href="style.css"/></head>'
+                       f'<body><h1>Chapter {number}</h1>{"".join(body)}</body></html>')
+            manifest.append(f'<item id="ch{number}" href="{name}" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="ch{number}"/>')
+            nav_items.append(f'<li><a href="{name}">Chapter {number}</a></li>')
+            ncx_points.append(f'<navPoint id="np{number}" playOrder="{number}">'
+                              f'<navLabel><text>Chapter {number}</text></navLabel>'
+                              f'<content src="{name}"/></navPoint>')
+        
+        z.writestr('OEBPS/nav.xhtml',
+                   '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                   '<head><title>Contents</title></head><body>'
+                   f'<nav epub:type="toc"><ol>{"".join(nav_items)}</ol></nav></body></html>')
+        manifest.append('<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>')
+        z.writestr('OEBPS/toc.ncx',
+                   '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                   f'<head/><docTitle><text>{title}</text></docTitle>'
+                   f'<navMap>{"".join(ncx_points)}</navMap></ncx>')
+        manifest.append('<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>')
+        
+        z.writestr('OEBPS/content.opf',
+                   '<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="bookid">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                   f'<dc:identifier id="bookid">urn:uuid:synthetic-{seed}-{chapters}-{chapter_kb}</dc:identifier>'
+                   f'<dc:title>{title}</dc:title><dc:creator>Benchmark</dc:creator><dc:language>en</dc:language>'
+                   '</metadata>'
+                   f'<manifest>{"".join(manifest)}</manifest>'
+                   f'<spine toc="ncx">{"".join(spine)}</spine></package>')
+    return path
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='生成合成电子书')
+    parser.add_argument('output', type=str, help='输出文件路径')
+    parser.add_argument('--chapters', type=int, default=20, help='章节数')
+    parser.add_argument('--chapter-kb', type=int, default=50, help='每章正文大小（KB）')
+    parser.add_argument('--images', type=int, default=0, help='图片数量')
+    parser.add_argument('--image-kb', type=int, default=200, help='每张图片大小（KB）')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    args = parser.parse_args()
+    result = make_synthetic_epub(args.output, args.chapters, args.chapter_kb,
+                                 args.images, args.image_kb, seed=args.seed)
+    print(f"已生成: {result} ({result.stat().st_size / 1024 / 1024:.2f} MB)")
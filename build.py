@@ -7,12 +7,13 @@ import subprocess
 import shutil
 import json
 import random
+import time
+import argparse
+import hashlib
+import struct
 import zipfile
 import xml.etree.ElementTree as ET
 from pathlib import Path
-import base64
-import ctypes
-import platform
 
 
 def check_requirements():
@@ -98,137 +99,6 @@ def get_book_title_from_file(epub_path):
     except zipfile.BadZipFile:
         return Path(epub_path).stem
 
-def setup_staging_directory_fallback(script_dir):
-    """还原reader/epub/staging/目录"""
-    
-    # 创建脚本目录下的staging目录
-    script_staging_dir = script_dir / "staging"
-    script_staging_dir.mkdir(parents=True, exist_ok=True)
-    
-    # 创建reader/epub/staging目录的符号链接
-    reader_staging_dir = script_dir / "reader" / "epub" / "staging"
-    reader_staging_dir.parent.mkdir(parents=True, exist_ok=True)
-    
-    try:
-        if os.name == 'nt':  # Windows
-            # 尝试创建交接点
-            import subprocess
-            try:
-                subprocess.run(['cmd', '/c', 'mklink', '/J', 
-                              str(reader_staging_dir), str(script_staging_dir)], 
-                            check=True, capture_output=True)
-                print(f"已创建交接点: {reader_staging_dir} -> {script_staging_dir}")
-            except subprocess.CalledProcessError:
-                # 交接点失败，尝试符号链接
-                reader_staging_dir.unlink(missing_ok=True)
-                success_win = create_symlink_with_admin(script_staging_dir, reader_staging_dir, target_is_directory=True)
-                if not success_win:
-                    input("创建符号链接失败,按回车键退出……")
-                    exit(1)
-                print(f"已创建符号链接: {reader_staging_dir} -> {script_staging_dir}")
-        else:  # Unix-like系统
-            success_unix = create_symlink_with_admin(script_staging_dir, reader_staging_dir, target_is_directory=True)
-            if not success_unix:
-                input("创建符号链接失败,按回车键退出……")
-                exit(1)
-            print(f"已创建符号链接: {reader_staging_dir} -> {script_staging_dir}")
-        
-        # 创建.reparse_point文件并检查存在性
-        reparse_file = script_staging_dir / ".reparse_point"
-        reparse_file.touch()
-        check_file = reader_staging_dir / ".reparse_point"
-        if check_file.exists():
-            print(f"符号链接验证通过: {check_file}")
-        else:
-            print(f"警告: 符号链接可能未正确工作，未找到 {check_file}")
-    except Exception as e:
-        print(f"创建符号链接失败: {e}")
-        print("请手动创建交接点或符号链接")
-
-def is_admin():
-    """检查当前是否以管理员权限运行"""
-    try:
-        return ctypes.windll.shell32.IsUserAnAdmin()
-    except:
-        return False
-
-def create_symlink_with_admin(source, target, target_is_directory=True):
-    """
-    创建符号链接，如果权限不足则请求管理员权限
-    """
-    try:
-        # 尝试直接创建符号链接
-        os.symlink(source, target, target_is_directory=target_is_directory)
-        print(f"已创建符号链接: {target} -> {source}")
-        return True
-        
-    except PermissionError:
-        # 如果是因为权限问题失败，尝试以管理员权限运行
-        if platform.system() == "Windows":
-            print("权限不足，正在尝试以管理员权限创建符号链接...")
-            
-            # 构建PowerShell命令
-            ps_command = f"""
-            $source = '{source}'
-            $target = '{target}'
-            
-            if (Test-Path $target) {{
-                Write-Host "目标已存在: $target" -ForegroundColor Yellow
-                exit 1
-            }}
-            
-            try {{
-                New-Item -ItemType SymbolicLink -Path $target -Target $source
-                Write-Host "已创建符号链接: $target -> $source" -ForegroundColor Green
-                exit 0
-            }} catch {{
-                Write-Host "创建符号链接失败: $($_.Exception.Message)" -ForegroundColor Red
-                exit 2
-            }}
-            """
-            
-            # 编码PowerShell命令
-            encoded_command = base64.b64encode(ps_command.encode('utf-16le')).decode()
-            
-            # 构建完整的PowerShell命令
-            full_ps_command = [
-                'powershell',
-                '-ExecutionPolicy', 'Bypass',
-                '-EncodedCommand', encoded_command
-            ]
-            
-            # 运行PowerShell以管理员权限执行
-            try:
-                # 检查当前是否已经是管理员
-                if is_admin():
-                    # 如果已经是管理员，直接执行
-                    result = subprocess.run(full_ps_command, capture_output=True, text=True, encoding='utf-8')
-                else:
-                    # 否则请求UAC提升
-                    runas_command = [
-                        'powershell',
-                        '-Command',
-                        f'Start-Process powershell -ArgumentList \'-ExecutionPolicy Bypass -Command "{ps_command.replace(chr(34), chr(92)+chr(34))}\' -Verb RunAs'
-                    ]
-                    result = subprocess.run(runas_command, capture_output=True, text=True, encoding='utf-8')
-                
-                if result.returncode == 0:
-                    print("符号链接创建成功")
-                    return True
-                else:
-                    print(f"符号链接创建失败: {result.stderr}")
-                    return False
-                    
-            except Exception as e:
-                print(f"执行管理员命令时出错: {e}")
-                return False
-                
-        else:
-            # 非Windows系统
-            print("权限不足，请使用sudo或管理员权限运行此脚本")
-            return False
-
-
 def get_user_input():
     """获取用户输入"""
     
@@ -251,32 +121,17 @@ def get_user_input():
         epub_file_provided = True
         print(f"检测到epub文件: {epub_path}")
         
-        # 检查原book.epub文件大小
-        target_file = Path("reader") / "epub" / "book.epub"
-        if target_file.exists() and target_file.stat().st_size > 1024:  # 大于1KB
-            print("警告: reader/epub/book.epub 非空（大于1KB）")
-            confirm = input("确定要继续替换吗？(y/N): ").strip().lower()
-            if confirm not in ['y', 'yes']:
-                print("操作已取消")
-                return None
-        
         # 从epub文件中获取书名
         book_title = get_book_title_from_file(epub_path)
         print(f"从epub文件中获取的书名: {book_title}")
-        
-        # 复制epub文件到reader/epub/book.epub
-        target_dir = Path("reader") / "epub"
-        target_dir.mkdir(parents=True, exist_ok=True)
-        
-        try:
-            shutil.copy2(epub_path, target_file)
-            print(f"已复制epub文件到: {target_file}")
-        except Exception as e:
-            print(f"错误: 复制epub文件失败: {e}")
-            return None
     else:
-        # 使用用户输入的书名
+        # 使用用户输入的书名，电子书使用reader/epub/book.epub
         book_title = user_input
+        epub_path = Path("reader") / "epub" / "book.epub"
+        if epub_path.exists() and epub_path.stat().st_size > 0:
+            print(f"使用电子书: {epub_path}")
+        else:
+            epub_path = None
     
     if not book_title:
         print("错误: 无法获取有效的书名")
@@ -315,7 +170,8 @@ def get_user_input():
         'clean_title': clean_title,
         'server_ip': server_ip,
         'server_port': server_port,
-        'epub_file_provided': epub_file_provided
+        'epub_file_provided': epub_file_provided,
+        'epub_path': epub_path
     }
 
 def clean_filename(filename):
@@ -329,30 +185,39 @@ def clean_filename(filename):
     clean_name = clean_name.strip().strip('.')
     return clean_name
 
-def check_and_clean_staging_directory():
-    """检查并清理staging目录"""
-    reparse_point = Path("reader") / "epub" / "staging" / ".reparse_point"
-    staging_dir = Path("reader") / "epub" / "staging"
-    
-    if reparse_point.exists():
-        print("检测到.reparse_point文件，正在删除staging目录...")
-        try:
-            if staging_dir.exists():
-                if staging_dir.is_symlink() or staging_dir.is_file():
-                    staging_dir.unlink()
-                else:
-                    shutil.rmtree(staging_dir, ignore_errors=True)
-            print("staging目录已删除")
-            return True
-        except Exception as e:
-            print(f"删除staging目录失败: {e}")
-            return False
-    return False
+RUNTIME_NAME = "epub服务器-runtime"
+RUNTIME_DIR = Path("runtime")
 
-def generate_spec_file(config):
-    """生成PyInstaller的spec文件"""
-    clean_title = config['clean_title']
-    
+def hash_files(files, digest=None):
+    """计算一组文件（含路径）的内容摘要"""
+    digest = digest or hashlib.sha256()
+    for path in files:
+        digest.update(Path(path).as_posix().encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+def get_runtime_key():
+    """根据spec内容和服务器脚本计算通用程序的版本（内容不变时复用已构建的程序）"""
+    digest = hashlib.sha256(generate_spec_file(RUNTIME_NAME, write=False).encode('utf-8'))
+    return hash_files([Path("epub服务器.py")], digest)
+
+def get_reader_assets():
+    """阅读器资源（不包含电子书目录和临时目录）"""
+    assets = []
+    for path in sorted(Path("reader").rglob('*')):
+        parts = path.relative_to("reader").parts
+        if path.is_file() and parts[0] not in ('epub', 'tmp'):
+            assets.append(path)
+    return assets
+
+def generate_spec_file(name, write=True):
+    """
+    生成PyInstaller的spec文件（通用程序只包含Python运行环境和服务器脚本）
+    reader资源和电子书都放在附加数据中，单文件程序每次启动时只需解压运行环境；
+    不使用UPX压缩，避免每次启动时解压可执行文件
+    """
     spec_content = f"""# -*- mode: python ; coding: utf-8 -*-
 
 block_cipher = None
@@ -361,10 +226,7 @@ a = Analysis(
     ['epub服务器.py'],
     pathex=[],
     binaries=[],
-    datas=[
-        ('reader', 'reader'),
-        ('config.json', '.'),
-    ],
+    datas=[],
     hiddenimports=[],
     hookspath=[],
     hooksconfig={{}},
@@ -385,11 +247,11 @@ exe = EXE(
     a.zipfiles,
     a.datas,
     [],
-    name='{clean_title}',
+    name='{name}',
     debug=False,
     bootloader_ignore_signals=False,
     strip=False,
-    upx=True,
+    upx=False,
     upx_exclude=[],
     runtime_tmpdir=None,
     console=True,
@@ -399,6 +261,8 @@ exe = EXE(
     codepage='utf8',
 )
 """
+    if not write:
+        return spec_content
     
     spec_file = "temp_build.spec"
     with open(spec_file, 'w', encoding='utf-8') as f:
@@ -406,18 +270,14 @@ exe = EXE(
     
     return spec_file
 
-def create_config_file(config):
-    """创建配置文件"""
-    config_data = {
+def create_config_data(config, assets_key):
+    """生成附加到程序末尾的配置"""
+    return {
         'book_title': config['clean_title'],
         'server_ip': config['server_ip'],
-        'server_port': config['server_port']
+        'server_port': config['server_port'],
+        'assets_key': assets_key
     }
-    
-    with open('config.json', 'w', encoding='utf-8') as f:
-        json.dump(config_data, f, ensure_ascii=False, indent=2)
-    
-    print("创建配置文件: config.json")
 
 def run_pyinstaller(spec_file):
     """运行PyInstaller进行打包"""
@@ -438,25 +298,105 @@ def run_pyinstaller(spec_file):
         print(f"错误: 执行PyInstaller时发生异常: {e}")
         return False
 
-def move_and_cleanup(config):
-    """移动生成的文件并清理临时文件"""
-    clean_title = config['clean_title']
-    
-    print("\n处理生成的文件...")
-    
-    # 移动exe文件到当前目录
-    exe_source = Path("dist") / f"{clean_title}.exe"
-    if exe_source.exists():
-        shutil.move(str(exe_source), f"{clean_title}.exe")
-        print(f"移动可执行文件: {clean_title}.exe")
-    else:
-        print(f"警告: 找不到生成的可执行文件: {exe_source}")
-        return False
-    
-    # 清理临时文件
-    cleanup_temp_files()
-    
-    return True
+def ensure_runtime(rebuild=False):
+    """
+    获取通用程序：服务器脚本没有变化时直接复用runtime目录中已构建的程序，
+    否则运行一次PyInstaller构建
+    返回通用程序路径，失败时返回None
+    """
+    key = get_runtime_key()
+    suffix = '.exe' if os.name == 'nt' else ''
+    runtime_path = RUNTIME_DIR / f"{RUNTIME_NAME}-{key}{suffix}"
+    if runtime_path.exists() and not rebuild:
+        print(f"复用已构建的通用程序: {runtime_path}")
+        return runtime_path
+    
+    print("服务器脚本有变化，构建通用程序（只需构建一次）...")
+    spec_file = generate_spec_file(RUNTIME_NAME)
+    try:
+        if not run_pyinstaller(spec_file):
+            return None
+        built = Path("dist") / f"{RUNTIME_NAME}{suffix}"
+        if not built.exists():
+            print(f"警告: 找不到生成的可执行文件: {built}")
+            return None
+        RUNTIME_DIR.mkdir(exist_ok=True)
+        # 删除旧版本的通用程序
+        for old in RUNTIME_DIR.glob(f"{RUNTIME_NAME}-*"):
+            old.unlink()
+        shutil.move(str(built), str(runtime_path))
+        print(f"通用程序已保存: {runtime_path}")
+        return runtime_path
+    finally:
+        cleanup_temp_files()
+
+PYINSTALLER_COOKIE_MAGIC = b'MEI\014\013\012\013\016'
+PYINSTALLER_COOKIE_SIZE = 88
+
+def read_pyinstaller_cookie(runtime_path):
+    """读取通用程序中PyInstaller归档的cookie，返回(cookie结束位置, cookie内容)，找不到时返回None"""
+    with open(runtime_path, 'rb') as f:
+        data = f.read()
+    position = data.rfind(PYINSTALLER_COOKIE_MAGIC)
+    if position < 0 or position + PYINSTALLER_COOKIE_SIZE > len(data):
+        return None
+    return position + PYINSTALLER_COOKIE_SIZE, data[position:position + PYINSTALLER_COOKIE_SIZE]
+
+def mirror_pyinstaller_cookie(target, cookie):
+    """
+    把PyInstaller的cookie复制到文件末尾（zip注释的位置）
+    单文件程序启动时从文件末尾向前逐块搜索cookie，附加数据越大搜索越慢（每MB约数毫秒），
+    在末尾放一份cookie并相应增大归档长度，计算出的归档起始位置不变，搜索立即结束
+    """
+    cookie_end, cookie_data = cookie
+    size = target.stat().st_size
+    pkg_length = struct.unpack('!I', cookie_data[8:12])[0] + (size - cookie_end)
+    with open(target, 'r+b') as f:
+        f.seek(size - PYINSTALLER_COOKIE_SIZE)
+        f.write(cookie_data[:8] + struct.pack('!I', pkg_length) + cookie_data[12:])
+
+def package_book(runtime_path, config, reader_assets, assets_key):
+    """复制通用程序，并把reader资源、这本书的config.json和电子书以zip格式附加到末尾"""
+    suffix = '.exe' if os.name == 'nt' else ''
+    target = Path(f"{config['clean_title']}{suffix}")
+    temp_target = target.with_name(target.name + ".tmp")
+    
+    shutil.copyfile(runtime_path, temp_target)
+    # 'a'模式打开非zip文件时，zipfile会把新的zip追加到文件末尾
+    with zipfile.ZipFile(temp_target, 'a') as z:
+        z.writestr('config.json', json.dumps(create_config_data(config, assets_key), ensure_ascii=False, indent=2),
+                   compress_type=zipfile.ZIP_DEFLATED)
+        # reader资源不压缩，服务器可以直接从附加数据流式读取
+        for asset in reader_assets:
+            z.write(asset, asset.as_posix(), compress_type=zipfile.ZIP_STORED)
+        if config.get('epub_path'):
+            # 电子书本身已经是压缩格式，不再压缩，服务器可以直接流式读取
+            z.write(config['epub_path'], 'book.epub', compress_type=zipfile.ZIP_STORED)
+        cookie = read_pyinstaller_cookie(runtime_path)
+        if cookie is not None:
+            # 占位，关闭后替换为cookie（zip注释位于文件最末尾）
+            z.comment = bytes(PYINSTALLER_COOKIE_SIZE)
+    if cookie is not None:
+        mirror_pyinstaller_cookie(temp_target, cookie)
+    if os.name != 'nt':
+        temp_target.chmod(0o755)
+    os.replace(temp_target, target)
+    return target
+
+def config_from_epub(epub_path, server_ip, server_port):
+    """非交互模式：根据电子书文件生成配置"""
+    book_title = get_book_title_from_file(epub_path)
+    clean_title = clean_filename(book_title)
+    if not clean_title:
+        clean_title = clean_filename(Path(epub_path).stem) or "book"
+    return {
+        'book_title': book_title,
+        'clean_title': clean_title,
+        'server_ip': server_ip,
+        'server_port': server_port,
+        'epub_file_provided': True,
+        'epub_path': Path(epub_path)
+    }
 
 def cleanup_temp_files():
     """清理临时文件"""
@@ -486,72 +426,58 @@ def cleanup_temp_files():
     
     print("清理临时文件完成")
 
-def reset_book_epub():
-    """重置book.epub为空文件"""
-    target_file = Path("reader") / "epub" / "book.epub"
-    if target_file.exists():
-        try:
-            # 清空文件内容
-            with open(target_file, 'wb') as f:
-                f.truncate(0)
-            print("已重置book.epub为空文件")
-        except Exception as e:
-            print(f"重置book.epub失败: {e}")
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='把电子书打包为可执行文件')
+    parser.add_argument('epubs', nargs='*', help='电子书文件（指定时不再交互询问，可一次打包多本）')
+    parser.add_argument('--ip', type=str, default='127.0.0.1', help='服务器IP（非交互模式，默认127.0.0.1）')
+    parser.add_argument('--port', type=int, help='服务器端口（非交互模式，多本书时依次递增，默认在55000-65535之间随机）')
+    parser.add_argument('--rebuild-runtime', action='store_true', help='强制重新构建通用程序')
+    return parser.parse_args()
 
 def main():
     """主函数"""
-    staging_cleaned = False
-    epub_replaced = False
+    args = parse_arguments()
     
     try:
         # 检查环境
         if not check_requirements():
             return 1
         
-        # 获取用户输入
-        config = get_user_input()
-        if not config:
-            return 1
-        
-        # 记录是否替换了epub文件
-        epub_replaced = config.get('epub_file_provided', False)
-        
-        print(f"\n配置信息:")
-        print(f"  书名: {config['clean_title']}")
-        print(f"  服务器IP: {config['server_ip']}")
-        print(f"  服务器端口: {config['server_port']}")
-        
-        # 检查并清理staging目录
-        staging_cleaned = check_and_clean_staging_directory()
-        
-        # 创建配置文件
-        create_config_file(config)
-        
-        # 生成spec文件
-        spec_file = generate_spec_file(config)
-        
-        # 运行PyInstaller
-        if not run_pyinstaller(spec_file):
-            return 1
+        # 获取配置（命令行指定电子书时不再询问）
+        if args.epubs:
+            configs = []
+            for index, epub in enumerate(args.epubs):
+                port = args.port + index if args.port else random.randint(55000, 65535)
+                configs.append(config_from_epub(epub, args.ip, port))
+        else:
+            config = get_user_input()
+            if not config:
+                return 1
+            configs = [config]
         
-        # 移动文件和清理
-        if not move_and_cleanup(config):
+        # 获取通用程序（只在reader资源或服务器脚本变化时构建）
+        runtime_path = ensure_runtime(args.rebuild_runtime)
+        if runtime_path is None:
             return 1
         
-        # 如果之前清理了staging目录，现在重新创建符号链接
-        if staging_cleaned:
-            print("\n重新创建staging目录符号链接...")
-            setup_staging_directory_fallback(Path.cwd())
-        
-        # 如果替换了epub文件，则在最后重置为空文件
-        if epub_replaced:
-            print("\n重置book.epub文件...")
-            reset_book_epub()
+        # 每本书只需复制通用程序并附加数据
+        reader_assets = get_reader_assets()
+        assets_key = hash_files(reader_assets)
+        for config in configs:
+            print(f"\n配置信息:")
+            print(f"  书名: {config['clean_title']}")
+            print(f"  服务器IP: {config['server_ip']}")
+            print(f"  服务器端口: {config['server_port']}")
+            if not config.get('epub_path'):
+                print("  警告: 没有电子书，程序将使用reader/epub/book.epub")
+            
+            start = time.perf_counter()
+            target = package_book(runtime_path, config, reader_assets, assets_key)
+            print(f"可执行文件: {target}（用时{time.perf_counter() - start:.2f}秒）")
+            print(f"历史记录文件: History/{config['clean_title']}.json")
         
-        # 显示完成信息
         print("\n打包完成!")
-        print(f"可执行文件: {config['clean_title']}.exe")
-        print(f"历史记录文件: History/{config['clean_title']}.json")
         return 0
         
     except KeyboardInterrupt:
@@ -564,4 +490,4 @@ def main():
         return 1
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
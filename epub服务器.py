@@ -1,17 +1,82 @@
+import sys
+import time
+import threading
+
+# 启动计时从模块开始执行算起（--startup-profile）
+_MODULE_START = time.perf_counter()
+
+class _ImportTimer:
+    """
+    导入计时器（--startup-profile开启时安装在sys.meta_path最前面）
+    记录每个模块的自身耗时和累计耗时，输出格式与python -X importtime相同
+    """
+    def __init__(self):
+        self.records = []
+        self._local = threading.local()
+    
+    def find_spec(self, name, path=None, target=None):
+        # 交给后面的查找器查找，再把加载器包装成计时加载器
+        for finder in sys.meta_path[sys.meta_path.index(self) + 1:]:
+            find_spec = getattr(finder, 'find_spec', None)
+            if find_spec is None:
+                continue
+            spec = find_spec(name, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(self, spec.loader)
+                return spec
+        return None
+    
+    def run(self, name, func, *args):
+        stack = self._local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            cumulative = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            self.records.append((name, cumulative - children, cumulative, len(stack)))
+
+class _TimedLoader:
+    """包装原加载器，只对exec_module计时，其余属性原样转发"""
+    def __init__(self, timer, loader):
+        self._timer = timer
+        self._loader = loader
+    
+    def create_module(self, spec):
+        create_module = getattr(self._loader, 'create_module', None)
+        return create_module(spec) if create_module else None
+    
+    def exec_module(self, module):
+        self._timer.run(module.__name__, self._loader.exec_module, module)
+    
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+IMPORT_TIMER = None
+if '--startup-profile' in sys.argv:
+    IMPORT_TIMER = _ImportTimer()
+    sys.meta_path.insert(0, IMPORT_TIMER)
+
+# 启动时只导入服务请求必需的模块，其余模块（zipfile、shutil、webbrowser等）在用到的函数内导入
+import html
 import http.server
+import io
 import socketserver
-import webbrowser
 import os
-import sys
 import json
-import argparse
-import shutil
-import threading
-import time
-import zipfile
-import xml.etree.ElementTree as ET
+import atexit
+import bisect
+import copy
+import posixpath
+import signal
+import socket
+from html.parser import HTMLParser
 from pathlib import Path
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, quote, unquote
 
 def get_resource_path(relative_path):
     """获取资源的绝对路径，支持调试模式和打包模式"""
@@ -24,9 +89,114 @@ def get_resource_path(relative_path):
     
     return Path(base_path) / relative_path
 
+# 附加数据：build.py把每本书的config.json和电子书以zip格式附加在通用程序末尾
+PAYLOAD_PATH = None
+PAYLOAD_BOOK_NAME = "book.epub"
+PAYLOAD_BOOK_URL = "payload/book.epub"
+_PAYLOAD = None
+_PAYLOAD_LOADED = False
+
+class Payload:
+    """附加在可执行文件末尾的zip数据（zipfile可以直接读取带前缀数据的zip）"""
+    def __init__(self, path):
+        import zipfile
+        self.path = Path(path)
+        self._zip = zipfile.ZipFile(self.path)
+        self.names = set(self._zip.namelist())
+    
+    def has(self, name):
+        return name in self.names
+    
+    def read(self, name):
+        return self._zip.read(name)
+    
+    def open(self, name):
+        return self._zip.open(name)
+    
+    def size(self, name):
+        return self._zip.getinfo(name).file_size
+    
+    def etag(self, name):
+        info = self._zip.getinfo(name)
+        return f'"{info.CRC:08x}-{info.file_size:x}"'
+
+def get_payload():
+    """获取附加数据（打包模式下读取程序自身，调试模式下读取--payload指定的文件），没有时返回None"""
+    global _PAYLOAD, _PAYLOAD_LOADED
+    if not _PAYLOAD_LOADED:
+        _PAYLOAD_LOADED = True
+        source = PAYLOAD_PATH or (sys.executable if getattr(sys, 'frozen', False) else None)
+        if source:
+            import zipfile
+            try:
+                payload = Payload(source)
+                if payload.has("config.json"):
+                    _PAYLOAD = payload
+            except (zipfile.BadZipFile, OSError):
+                pass
+    return _PAYLOAD
+
+# 阅读器资源所在的附加数据（--asset-mode archive时直接从附加数据读取，不解压）
+ASSET_ARCHIVE = None
+PAYLOAD_READER_PREFIX = "reader/"
+
+def payload_has_reader(payload):
+    """附加数据中是否包含阅读器资源"""
+    return payload is not None and payload.has(PAYLOAD_READER_PREFIX + "index.html")
+
+# 环境变量指定资源解压缓存目录时使用它（测量首次启动时使用临时目录，不影响正在运行的程序）
+ASSET_CACHE_ENV = "EPUB_READER_ASSET_CACHE"
+
+def get_asset_cache_root():
+    """获取持久化的资源解压缓存目录（不同次启动之间复用）"""
+    if os.environ.get(ASSET_CACHE_ENV):
+        return Path(os.environ[ASSET_CACHE_ENV])
+    if os.name == 'nt' and os.environ.get('LOCALAPPDATA'):
+        base = Path(os.environ['LOCALAPPDATA'])
+    else:
+        base = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / ".cache")
+    return base / "EpubReaderServer"
+
+def extract_reader_cache(payload, key):
+    """
+    把附加数据中的阅读器资源解压到按版本区分的持久化缓存目录，
+    已存在时直接复用（只有第一次启动或资源变化后才需要解压）
+    """
+    import shutil
+    import tempfile
+    if not key:
+        key = f"{payload.path.stat().st_size:x}-{int(payload.path.stat().st_mtime):x}"
+    cache_root = get_asset_cache_root()
+    target = cache_root / f"reader-{key}"
+    if (target / "index.html").exists():
+        print(f"复用已解压的阅读器资源: {target}")
+        return target
+    
+    cache_root.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=f"reader-{key}-", dir=cache_root))
+    for name in payload.names:
+        if not name.startswith(PAYLOAD_READER_PREFIX) or name.endswith('/'):
+            continue
+        destination = staging.joinpath(*name[len(PAYLOAD_READER_PREFIX):].split('/'))
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        with payload.open(name) as src, open(destination, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+    try:
+        # 解压完成后再改名，避免其他同时启动的进程读到不完整的目录
+        os.rename(staging, target)
+        print(f"已解压阅读器资源到: {target}")
+    except OSError:
+        # 其他进程已经解压完成
+        shutil.rmtree(staging, ignore_errors=True)
+    return target
+
 def get_config():
-    """获取配置文件（打包模式下从资源路径读取）"""
+    """获取配置文件（优先读取附加数据，打包模式下从资源路径读取）"""
     try:
+        payload = get_payload()
+        if payload is not None:
+            return json.loads(payload.read("config.json").decode('utf-8'))
+        
         if getattr(sys, 'frozen', False):
             # 打包模式：从资源路径读取config.json
             config_path = get_resource_path("config.json")
@@ -44,6 +214,9 @@ def get_config():
 
 def get_book_title_from_file(epub_path, reader_dir):
     """从电子书文件中获取书名（以reader目录为起点解析相对路径）"""
+    import zipfile
+    import xml.etree.ElementTree as ET
+    
     # 将路径转换为相对于reader目录的绝对路径
     epub_path = Path(epub_path)
     if not epub_path.is_absolute():
@@ -121,8 +294,83 @@ def get_book_title_from_file(epub_path, reader_dir):
         print(f"从电子书提取书名失败: {e}")
         return Path(epub_path).stem
 
+def find_cover(z):
+    """
+    在电子书（已打开的ZipFile）中查找封面图片，依次尝试：
+    - manifest中properties含cover-image的条目（EPUB 3）
+    - <meta name="cover">指向的条目（EPUB 2）
+    - guide中type为cover的引用（指向封面页时取页面中的第一张图片）
+    返回(条目名, 媒体类型)，找不到时返回None
+    """
+    import re
+    import mimetypes
+    import xml.etree.ElementTree as ET
+    
+    def _local_name(tag):
+        return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+    
+    def _resolve(base, href):
+        return posixpath.normpath(posixpath.join(base, unquote(href.split('#', 1)[0])))
+    
+    names = set(z.namelist())
+    container = ET.fromstring(z.read('META-INF/container.xml'))
+    opf_path = next((el.get('full-path') for el in container.iter() if _local_name(el.tag) == 'rootfile'), None)
+    if not opf_path or opf_path not in names:
+        return None
+    opf_dir = posixpath.dirname(opf_path)
+    opf = ET.fromstring(z.read(opf_path))
+    
+    items = {}
+    candidates = []
+    for el in opf.iter():
+        if _local_name(el.tag) == 'item' and el.get('href'):
+            item = (_resolve(opf_dir, el.get('href')), el.get('media-type', ''))
+            items[el.get('id')] = item
+            if 'cover-image' in (el.get('properties') or '').split():
+                candidates.append(item)
+    for el in opf.iter():
+        if _local_name(el.tag) == 'meta' and el.get('name') == 'cover' and el.get('content') in items:
+            candidates.append(items[el.get('content')])
+    for el in opf.iter():
+        if _local_name(el.tag) == 'reference' and (el.get('type') or '').lower() == 'cover' and el.get('href'):
+            name = _resolve(opf_dir, el.get('href'))
+            media_type = mimetypes.guess_type(name)[0] or ''
+            if not media_type.startswith('image/') and name in names:
+                # 封面页：取其中第一张图片（<img src>或SVG中的<image xlink:href>）
+                text = z.read(name).decode('utf-8', 'ignore')
+                match = re.search(r'''<(?:img|image)\b[^>]*?(?:src|href)\s*=\s*["']([^"']+)["']''', text, re.I)
+                if not match:
+                    continue
+                name = _resolve(posixpath.dirname(name), match.group(1))
+                media_type = mimetypes.guess_type(name)[0] or ''
+            candidates.append((name, media_type))
+    
+    for name, media_type in candidates:
+        if name in names and media_type.startswith('image/'):
+            return name, media_type
+    return None
+
+# 数据目录（通过--data-dir指定，History、Cache和Profiles都在其中，未指定时为History目录的上级目录）
+# 和历史记录目录（通过--history-dir指定，未指定时使用数据目录或程序所在目录下的History）
+DATA_DIR = None
+HISTORY_DIR = None
+
+def get_data_dir():
+    """获取数据目录（缓存和性能分析结果保存在其中）"""
+    if DATA_DIR is not None:
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        return DATA_DIR
+    return get_history_dir().parent
+
 def get_history_dir():
     """获取历史记录目录"""
+    if HISTORY_DIR is not None:
+        HISTORY_DIR.mkdir(parents=True, exist_ok=True)
+        return HISTORY_DIR
+    if DATA_DIR is not None:
+        history_dir = get_data_dir() / "History"
+        history_dir.mkdir(exist_ok=True)
+        return history_dir
     try:
         # 打包后保存到exe所在目录
         if getattr(sys, 'frozen', False):
@@ -148,15 +396,56 @@ def clean_filename(filename):
     clean_name = clean_name.strip().strip('.')
     return clean_name if clean_name else "history"
 
-def get_history_filename():
-    """获取历史记录文件名（基于书名）"""
-    global BOOK_TITLE
-    clean_title = clean_filename(BOOK_TITLE)
-    return f"{clean_title}.json"
+def get_history_filename(book=None):
+    """获取历史记录文件名（基于书名，book为None时为当前的书）"""
+    return (book or BOOK).history_filename()
+
+class HistoryFileLock:
+    """
+    历史记录文件的跨进程建议锁（Windows用msvcrt，其他系统用fcntl）。
+    锁加在同目录的{文件名}.lock上而不是历史记录文件本身，因为写入时会用新文件替换历史记录文件；
+    每个文件一把锁，多个服务器进程共用History目录时只有写同一个文件才会互相等待
+    """
+    def __init__(self, history_file):
+        self.path = Path(f"{history_file}.lock")
+        self._file = None
+    
+    def __enter__(self):
+        self._file = open(self.path, 'a+b')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                while True:
+                    try:
+                        # LK_LOCK重试10秒后仍未取得锁时抛出OSError，继续等待
+                        self._file.seek(0)
+                        msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:
+                        pass
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+            self._file.close()
+            raise
+        return self
+    
+    def __exit__(self, *exc_info):
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
 
-def load_history():
-    """加载历史记录"""
-    history_file = get_history_dir() / get_history_filename()
+def load_history(filename=None):
+    """加载历史记录（filename为None时为当前书的历史记录文件）"""
+    history_file = get_history_dir() / (filename or get_history_filename())
     if history_file.exists():
         try:
             with open(history_file, 'r', encoding='utf-8') as f:
@@ -165,35 +454,399 @@ def load_history():
             return {}
     return {}
 
-def save_history(history_data):
-    """保存历史记录"""
-    history_file = get_history_dir() / get_history_filename()
+def save_history(history_data, filename=None):
+    """
+    保存历史记录（filename为None时为当前书的历史记录文件）：持有文件锁时读入文件中的记录，
+    与history_data按时间合并后写入临时文件再替换，其他进程在此期间写入的进度不会被覆盖。
+    返回合并后的记录和写入后文件的标识（见file_stamp），保存失败时返回(history_data, None)
+    """
+    history_file = get_history_dir() / (filename or get_history_filename())
+    start = time.perf_counter()
     try:
-        with open(history_file, 'w', encoding='utf-8') as f:
-            json.dump(history_data, f, ensure_ascii=False, indent=2)
+        with HistoryFileLock(history_file):
+            merged = merge_history(load_history(history_file.name), history_data)
+            write_file_atomic(history_file, json.dumps(merged, ensure_ascii=False, indent=2).encode('utf-8'))
+            return merged, file_stamp(history_file)
     except Exception as e:
         print(f"保存历史记录失败: {e}")
+        return history_data, None
+    finally:
+        METRICS.observe_history_write(time.perf_counter() - start)
 
-def update_history(book_path, cfi):
-    """保存历史记录（仅保存CFI信息）"""
-    history = load_history()
-    history['last_read'] = {
-        'cfi': cfi
-    }
-    save_history(history)
-
-def get_last_position(book_path):
-    """获取上次阅读位置（不再验证book_path）"""
-    history = load_history()
-    if 'last_read' in history:
-        return history['last_read'].get('cfi')
-    return None
+def file_stamp(path):
+    """文件的(修改时间, inode, 大小)，用于判断文件是否被替换或修改过，文件不存在时返回None"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_ino, stat.st_size
+
+def history_readers(history):
+    """历史记录中的进度表{读者: {设备: {"cfi": 位置, "time": 时间}}}（旧文件中只有last_read时作为default读者的进度）"""
+    readers = history.get('readers')
+    if isinstance(readers, dict):
+        return readers
+    cfi = (history.get('last_read') or {}).get('cfi')
+    return {DEFAULT_READER: {'legacy': {'cfi': cfi, 'time': 0}}} if cfi else {}
+
+def prune_devices(devices):
+    """设备超过MAX_READER_DEVICES个时删除最久没有更新的（直接修改devices）"""
+    if len(devices) > MAX_READER_DEVICES:
+        ordered = sorted(devices, key=lambda device: devices[device].get('time', 0), reverse=True)
+        for device in ordered[MAX_READER_DEVICES:]:
+            del devices[device]
+    return devices
+
+def merge_history(*histories):
+    """合并多份历史记录：每个读者在每个设备上保留时间最新的位置，last_read为所有位置中最新的"""
+    readers = {}
+    for history in histories:
+        for reader, devices in history_readers(history).items():
+            merged = readers.setdefault(reader, {})
+            for device, entry in devices.items():
+                current = merged.get(device)
+                if current is None or entry.get('time', 0) > current.get('time', 0):
+                    merged[device] = entry
+    for devices in readers.values():
+        prune_devices(devices)
+    result = {'readers': readers}
+    latest = max((entry for devices in readers.values() for entry in devices.values()),
+                 key=lambda entry: entry.get('time', 0), default=None)
+    if latest is not None:
+        result['last_read'] = {'cfi': latest['cfi']}
+    return result
+
+# 阅读进度按读者和设备区分：读者由Cookie区分（页面地址加?reader=名字切换，默认为default），
+# 设备由服务器分配的Cookie区分；打开页面时按PROGRESS_POLICY选择位置：
+# latest使用该读者在所有设备上最新的位置，device优先使用本设备的位置。
+# 没有带设备Cookie的请求（第一次访问、curl、不保存Cookie的客户端）记在同一个匿名设备下，
+# 每个读者最多保留MAX_READER_DEVICES个设备，超过时删除最久没有更新的
+DEFAULT_READER = 'default'
+READER_COOKIE = 'reader_name'
+DEVICE_COOKIE = 'reader_device'
+ANONYMOUS_DEVICE = 'anonymous'
+MAX_READER_DEVICES = 32
+PROGRESS_POLICY = 'latest'
+PROGRESS_SHARDS = 16
+PROGRESS_FLUSH_INTERVAL = 2.0
+
+class ProgressStore:
+    """
+    阅读进度表：按(历史记录文件, 读者)分到多个分片，每个分片一把锁，不同读者保存进度时互不等待；
+    修改只在内存中进行并标记所在的书，由后台线程合并后写入该书的历史记录文件，退出时写入剩余的修改。
+    文件格式：{"last_read": {"cfi": 最新的位置}, "readers": {读者: {设备: {"cfi": 位置, "time": 时间}}}}
+    （保留last_read兼容旧版本，旧文件中只有last_read时作为default读者的进度）。
+    多个服务器进程共用历史记录文件时，写入前与文件中的记录按时间合并，
+    读取位置时文件被其他进程修改过则重新读入，较新的位置覆盖内存中的
+    """
+    def __init__(self, shards=PROGRESS_SHARDS, flush_interval=PROGRESS_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self._shards = [({}, threading.Lock()) for _ in range(shards)]
+        self._loaded = {}
+        self._load_lock = threading.Lock()
+        self._dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+    
+    def _shard(self, book, reader):
+        return self._shards[hash((book, reader)) % len(self._shards)]
+    
+    def load(self, book, refresh=False):
+        """第一次访问一本书时从历史记录文件读入；refresh为True时文件被替换或修改过则重新读入"""
+        if book in self._loaded and not refresh:
+            return
+        stamp = file_stamp(get_history_dir() / book)
+        if self._loaded.get(book, False) == stamp:
+            return
+        with self._load_lock:
+            if self._loaded.get(book, False) == stamp:
+                return
+            self._merge(book, load_history(book))
+            self._loaded[book] = stamp
+    
+    def _merge(self, book, history):
+        """把文件中的记录并入内存，同一设备保留时间较新的位置"""
+        for reader, devices in history_readers(history).items():
+            data, lock = self._shard(book, reader)
+            with lock:
+                current = data.setdefault((book, reader), {})
+                for device, entry in devices.items():
+                    if device not in current or entry.get('time', 0) > current[device]['time']:
+                        current[device] = {'cfi': entry['cfi'], 'time': entry.get('time', 0)}
+    
+    def get(self, book, reader, device, policy=None):
+        """读者在这本书上的位置（按policy选择设备），没有记录时返回None"""
+        self.load(book, refresh=True)
+        data, lock = self._shard(book, reader)
+        with lock:
+            devices = data.get((book, reader))
+            if not devices:
+                return None
+            if (policy or PROGRESS_POLICY) == 'device' and device in devices:
+                return devices[device]['cfi']
+            return max(devices.values(), key=lambda entry: entry['time'])['cfi']
+    
+    def update(self, book, reader, device, cfi, saved_at=None):
+        """
+        保存读者在某个设备上的位置（只修改内存，稍后写入文件）。
+        saved_at为位置实际保存的时间（离线时保存、稍后重放的进度），默认为现在；
+        该设备已有更新的位置时不覆盖
+        """
+        self.load(book)
+        now = time.time()
+        saved_at = now if saved_at is None else min(saved_at, now)
+        data, lock = self._shard(book, reader)
+        with lock:
+            devices = data.setdefault((book, reader), {})
+            if device in devices and devices[device]['time'] > saved_at:
+                return
+            devices[device] = {'cfi': cfi, 'time': saved_at}
+            prune_devices(devices)
+        with self._dirty_lock:
+            self._dirty.add(book)
+        self._start()
+        self._wake.set()
+    
+    def pending(self):
+        """等待写入文件的书的数量"""
+        with self._dirty_lock:
+            return len(self._dirty)
+    
+    def flush(self):
+        """把有修改的书写入历史记录文件"""
+        with self._dirty_lock:
+            books, self._dirty = self._dirty, set()
+        for book in books:
+            readers = {}
+            for data, lock in self._shards:
+                with lock:
+                    for (entry_book, reader), devices in data.items():
+                        if entry_book == book:
+                            readers[reader] = copy.deepcopy(devices)
+            merged, stamp = save_history({'readers': readers}, book)
+            if stamp is not None:
+                # 其他进程写入的较新位置同时并入内存，下次读取时不用再读文件
+                self._merge(book, merged)
+                with self._load_lock:
+                    self._loaded[book] = stamp
+    
+    def _start(self):
+        if self._thread is None:
+            with self._load_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='history', daemon=True)
+                    self._thread.start()
+    
+    def _run(self):
+        while True:
+            self._wake.wait()
+            # 合并一段时间内的多次翻页，只写一次文件
+            time.sleep(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+PROGRESS = ProgressStore()
+
+def update_history(book_path, cfi, reader=DEFAULT_READER, device=None, book=None, saved_at=None):
+    """保存读者在某个设备上的阅读位置（仅保存CFI信息，book为None时为当前的书，saved_at见ProgressStore.update）"""
+    PROGRESS.update(get_history_filename(book), reader, device, cfi, saved_at)
+
+def get_last_position(book_path, reader=DEFAULT_READER, device=None, book=None):
+    """获取读者上次阅读的位置（不再验证book_path，book为None时为当前的书）"""
+    return PROGRESS.get(get_history_filename(book), reader, device)
+
+class BookState:
+    """
+    正在提供的电子书：浏览器中的地址、书名、内容哈希（sha256，浏览器按它在本地缓存电子书）和书脊索引。
+    换书时生成新的对象整体替换BOOK，请求开始时取到的对象在请求结束前不变，进行中的请求继续使用旧书；
+    请求和后台任务通过acquire/release持有它，换下来后等最后一个使用者释放才关闭索引、删除副本
+    """
+    def __init__(self, path=None, title=None, book_hash=None, source=None, source_stamp=None):
+        self.path = path
+        self.title = title
+        self.hash = book_hash
+        # 电子书原文件和读取时的文件标识（文件监视用），附加在程序中的电子书为None
+        self.source = source
+        self.source_stamp = source_stamp
+        self._index = None
+        self._index_lock = threading.Lock()
+        self._closed = False
+        self._holders = 0
+        self._retired = False
+    
+    @property
+    def key(self):
+        """页面和保存进度的请求中用来区分书的标识：有内容哈希时为哈希的前16位，否则为书名"""
+        return self.hash[:16] if self.hash else self.title
+    
+    def history_filename(self):
+        return f"{clean_filename(self.title)}.json"
+    
+    def index(self):
+        """书脊索引（第一次调用时生成），读取失败或已关闭时返回None"""
+        with self._index_lock:
+            if self._closed:
+                return None
+            if self._index is None:
+                try:
+                    if self.path == PAYLOAD_BOOK_URL and get_payload() is not None:
+                        self._index = BookIndex(None, PAYLOAD_BOOK_NAME)
+                    else:
+                        self._index = BookIndex(self.path)
+                    self._index.book_hash = self.hash
+                    self._index.owner = self
+                except Exception as e:
+                    print(f"读取电子书目录失败: {e}")
+                    return None
+        return self._index
+    
+    def close(self):
+        """关闭书脊索引打开的电子书文件，之后不再重新打开（换书后删除旧文件和退出时清理临时目录前调用）"""
+        with self._index_lock:
+            self._closed = True
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+    
+    def acquire(self):
+        """增加一个使用者，返回自身"""
+        with self._index_lock:
+            self._holders += 1
+        return self
+    
+    def release(self):
+        """减少一个使用者，已换下的书没有使用者时返回True（由调用者关闭）"""
+        with self._index_lock:
+            self._holders -= 1
+            return self._retired and self._holders == 0
+    
+    def retire(self):
+        """标记为已换下，没有使用者时返回True（由调用者关闭），否则由最后一个使用者release时关闭"""
+        with self._index_lock:
+            self._retired = True
+            return self._holders == 0
+
+# 书名、电子书文件和内容哈希在开始监听后由后台线程准备，准备好之前BOOK中都为None
+BOOK = BookState()
+# 本次运行中提供过的书（按key），换书前打开的页面保存进度时仍写入原来那本书的历史记录
+_BOOK_STATES = {}
+# 换书后不再提供的电子书副本（reader/tmp中），文件仍被占用时留到下次换书或退出时再删除
+_RETIRED_BOOKS = []
+_RETIRED_BOOKS_LOCK = threading.Lock()
+# 替换BOOK和取得当前的书并持有它时加锁，换书后旧书不会再被新的请求取得
+_BOOK_LOCK = threading.Lock()
+
+def acquire_book():
+    """取得当前的书并持有它（用完后调用release_book），持有期间换书不会关闭它的索引和删除副本"""
+    with _BOOK_LOCK:
+        return BOOK.acquire()
+
+def release_book(book):
+    """释放acquire_book或BookState.acquire持有的书，已换下的书没有其他使用者时关闭"""
+    if book.release():
+        dispose_book(book)
+
+def retire_book(book):
+    """换下一本书：没有请求或后台任务在使用时立即关闭，否则等最后一个使用者释放"""
+    if book.retire():
+        dispose_book(book)
+
+def dispose_book(book):
+    """关闭换下来的书的索引，删除它在临时目录中的副本（与当前的书是同一个文件时保留）"""
+    book.close()
+    with _RETIRED_BOOKS_LOCK:
+        if book.path and book.path.startswith('tmp/'):
+            _RETIRED_BOOKS.append(READER_DIR / book.path)
+        for path in list(_RETIRED_BOOKS):
+            # 重新读取同一版本时新书仍使用这个文件
+            if BOOK.path and READER_DIR / BOOK.path == path:
+                _RETIRED_BOOKS.remove(path)
+                continue
+            try:
+                path.unlink(missing_ok=True)
+                _RETIRED_BOOKS.remove(path)
+            except OSError:
+                pass
+
+def close_books():
+    """关闭所有书的索引（退出时在清理临时目录前调用）"""
+    for book in [BOOK, *_BOOK_STATES.values()]:
+        book.close()
+
+BOOK_METADATA_CACHE = "books.json"
+_BOOK_METADATA_LOCK = threading.Lock()
+
+def get_cache_dir():
+    """获取缓存目录（数据目录下的Cache）"""
+    cache_dir = get_data_dir() / "Cache"
+    cache_dir.mkdir(exist_ok=True)
+    return cache_dir
+
+def write_file_atomic(path, data):
+    """先写入同目录下的临时文件再替换，中途退出不会留下不完整的文件"""
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=Path(path).parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def hash_file(f):
+    """流式计算文件的SHA-256，不把整本书读入内存"""
+    import hashlib
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+def get_book_metadata(source, member=None):
+    """
+    获取电子书的内容哈希和书名，member不为None时读取附加数据中的电子书（不提取书名）。
+    结果按文件路径、大小和修改时间缓存在Cache/books.json，书没有变化时不用重新读取整个文件
+    """
+    source = Path(source).resolve()
+    stat = source.stat()
+    key = f"{source}!{member}" if member else str(source)
+    stamp = [stat.st_size, stat.st_mtime_ns]
+    cache_file = get_cache_dir() / BOOK_METADATA_CACHE
+    
+    with _BOOK_METADATA_LOCK:
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        entry = cache.get(key)
+        if entry and entry.get('stamp') == stamp:
+            return entry
+        
+        with (get_payload().open(member) if member else open(source, 'rb')) as f:
+            book_hash = hash_file(f)
+        entry = {
+            'stamp': stamp,
+            'hash': book_hash,
+            'title': None if member else get_book_title_from_file(source, source.parent),
+        }
+        cache[key] = entry
+        try:
+            tmp_file = cache_file.with_suffix('.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_file, cache_file)
+        except OSError as e:
+            print(f"保存电子书元数据缓存失败: {e}")
+        return entry
 
-def setup_epub_file(epub_path, book_title, reader_dir):
+def setup_epub_file(epub_path, book_title, reader_dir, book_hash=None):
     """
     设置epub文件：
-    - 如果是绝对路径：复制到reader/tmp目录，返回tmp/{book_title}.epub
+    - 如果是绝对路径：复制到reader/tmp目录，返回tmp/{book_title}.{哈希前12位}.epub（没有哈希时为tmp/{book_title}.epub）
     - 如果是相对路径：检查文件是否存在，返回原路径
+    每个版本的电子书复制到不同的文件，换书时不用替换正在被读取的文件（Windows上打开的文件无法替换或删除）
     """
     if not epub_path:
         return "epub/book.epub"  # 默认路径
@@ -202,19 +855,29 @@ def setup_epub_file(epub_path, book_title, reader_dir):
     
     # 如果是绝对路径
     if epub_path.is_absolute():
+        import shutil
+        
         # 创建tmp目录
         tmp_dir = reader_dir / "tmp"
         tmp_dir.mkdir(exist_ok=True)
         
         # 生成目标文件名
         clean_title = clean_filename(book_title)
-        target_file = tmp_dir / f"{clean_title}.epub"
+        name = f"{clean_title}.{book_hash[:12]}.epub" if book_hash else f"{clean_title}.epub"
+        target_file = tmp_dir / name
+        
+        # 同一版本已经复制过时直接使用
+        if book_hash and target_file.exists():
+            print(f"使用已复制的电子书: {target_file}")
+            return f"tmp/{name}"
         
-        # 复制文件
+        # 复制文件（先复制到临时文件再替换，中途失败不会留下不完整的电子书）
         try:
-            shutil.copy2(epub_path, target_file)
+            tmp_file = target_file.with_suffix('.copying')
+            shutil.copy2(epub_path, tmp_file)
+            os.replace(tmp_file, target_file)
             print(f"已复制电子书到: {target_file}")
-            return f"tmp/{clean_title}.epub"
+            return f"tmp/{name}"
         except Exception as e:
             print(f"复制电子书失败: {e}")
             return "epub/book.epub"
@@ -252,305 +915,3545 @@ def validate_epub_path(epub_path, reader_dir):
         else:
             return False, f"文件不存在: {full_path}"
 
-def cleanup_temp_dir(reader_dir):
-    """清理临时目录"""
+def cleanup_temp_dir(reader_dir, timeout=5.0):
+    """清理临时目录（文件可能仍被占用，在期限内重试）"""
+    import shutil
     tmp_dir = reader_dir / "tmp"
-    if tmp_dir.exists():
+    deadline = time.monotonic() + timeout
+    overkill_count = 0
+    while tmp_dir.exists():
         try:
             shutil.rmtree(tmp_dir)
             print(f"已清理临时目录: {tmp_dir}")
-        except Exception as e:
-            print(f"清理临时目录失败: {e}")
- 
-    Overkill_count = 0
-    while tmp_dir.exists():
-        Overkill_count += 1
-        print(f"临时目录没删干净, 正在第{Overkill_count}次鞭尸")
-        shutil.rmtree(tmp_dir)
-        print(f"已成功清理临时目录: {tmp_dir}")
+        except OSError as e:
+            if time.monotonic() >= deadline:
+                print(f"清理临时目录失败: {e}")
+                return False
+            overkill_count += 1
+            print(f"临时目录没删干净, 正在第{overkill_count}次鞭尸")
+            time.sleep(0.2)
+    return True
 
-class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
-    def do_GET(self):
-        """处理GET请求，自动注入历史记录恢复代码"""
-        if self.path == '/':
-            # 重定向到index.html
-            self.path = '/index.html'
-        
-        if self.path.endswith('.html'):
-            # 对于HTML文件，注入历史记录恢复代码
-            return self.serve_html_with_history()
-        else:
-            # 其他文件正常处理
-            return super().do_GET()
+class _Histogram:
+    """固定分桶的直方图（累计分桶在输出时计算，记录时只做一次二分查找）"""
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
     
-    def serve_html_with_history(self):
-        """处理HTML文件并注入历史记录恢复代码"""
-        try:
-            # 获取原始文件路径
-            file_path = self.translate_path(self.path)
-            if not os.path.isfile(file_path):
-                self.send_error(404, "File not found")
-                return
-            
-            # 读取HTML文件内容
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            
-            # 使用全局的书籍路径
-            global CURRENT_BOOK_PATH
-            book_path = CURRENT_BOOK_PATH
-            
-            # 获取上次阅读位置
-            last_cfi = get_last_position(book_path)
-            
-            # 注入历史记录恢复代码和书籍路径覆盖代码
-            injected_code = f"""
-            <script>
-            // 覆盖书籍路径获取函数，强制使用服务器指定的路径
-            window.getBookParam = function() {{
-                const serverBookPath = {json.dumps(book_path)};
-                console.log('使用服务器指定的书籍路径:', serverBookPath);
-                return serverBookPath;
-            }};
-            
-            // 历史记录恢复
-            document.addEventListener('DOMContentLoaded', function() {{
-                const lastCFI = {json.dumps(last_cfi)};
-                const bookPath = {json.dumps(book_path)};
-                
-                console.log('历史记录恢复:', {{ bookPath: bookPath, lastCFI: lastCFI }});
-                
-                if (lastCFI) {{
-                    // 修改ePubReader初始化，直接跳转到上次位置
-                    const originalEBookInit = window.ePubReader;
-                    window.ePubReader = function(path, options) {{
-                        options = options || {{}};
-                        // 强制使用服务器指定的路径
-                        path = bookPath;
-                        if (lastCFI) {{
-                            options.previousLocationCfi = lastCFI;
-                            console.log('设置上次阅读位置:', lastCFI);
-                        }}
-                        return originalEBookInit(path, options);
-                    }};
-                    window.ePubReader.prototype = originalEBookInit.prototype;
-                }} else {{
-                    // 没有历史记录时，也确保使用正确的路径
-                    const originalEBookInit = window.ePubReader;
-                    window.ePubReader = function(path, options) {{
-                        // 强制使用服务器指定的路径
-                        return originalEBookInit(bookPath, options);
-                    }};
-                    window.ePubReader.prototype = originalEBookInit.prototype;
-                }}
-                
-                // 监听页面变化并保存历史记录
-                let currentReader = null;
-                const originalOnLoad = window.onload;
-                window.onload = function() {{
-                    if (originalOnLoad) originalOnLoad();
-                    
-                    // 等待阅读器初始化
-                    setTimeout(() => {{
-                        if (window.reader && window.reader.rendition) {{
-                            currentReader = window.reader;
-                            
-                            // 监听页面变化
-                            currentReader.rendition.on('relocated', function(location) {{
-                                if (location && location.start && location.start.cfi) {{
-                                    const cfi = location.start.cfi;
-                                    console.log('页面变化，保存历史记录:', cfi);
-                                    
-                                    // 发送保存请求到后端
-                                    fetch('/api/save_history', {{
-                                        method: 'POST',
-                                        headers: {{
-                                            'Content-Type': 'application/json',
-                                        }},
-                                        body: JSON.stringify({{
-                                            book_path: bookPath,
-                                            cfi: cfi
-                                        }})
-                                    }}).catch(err => console.error('保存历史记录失败:', err));
-                                }}
-                            }});
-                        }}
-                    }}, 1000);
-                }};
-            }});
-            </script>
-            """
-            
-            # 在</head>标签前注入代码
-            if '</head>' in content:
-                content = content.replace('</head>', injected_code + '</head>')
-            else:
-                # 如果没有head标签，在body开始处注入
-                content = content.replace('<body>', '<body>' + injected_code)
-            
-            # 发送修改后的内容
-            self.send_response(200)
-            self.send_header('Content-Type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(content.encode('utf-8'))
-            
-        except Exception as e:
-            # 修复HTTP头中的Unicode编码问题
-            error_msg = str(e).encode('ascii', 'ignore').decode('ascii')
-            self.send_error(500, f"Internal server error: {error_msg}")
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class _CountingWriter:
+    """包装wfile，统计实际写出的字节数"""
+    def __init__(self, raw):
+        self._raw = raw
+        self.bytes_written = 0
     
-    def do_POST(self):
-        """处理POST请求，用于保存历史记录"""
-        if self.path == '/api/save_history':
-            try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
-                
-                book_path = data.get('book_path')
-                cfi = data.get('cfi')
-                
-                if book_path and cfi:
-                    update_history(book_path, cfi)
-                    print(f"历史记录已保存: {book_path} -> {cfi}")
-                
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({'status': 'success'}).encode('utf-8'))
-            except Exception as e:
-                self.send_error(500, f"Save history error: {str(e)}")
-        else:
-            self.send_error(404, "Not found")
+    def write(self, data):
+        n = self._raw.write(data)
+        self.bytes_written += len(data) if n is None else n
+        return n
     
-    def end_headers(self):
-        # 添加CORS头信息
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        super().end_headers()
-
-def parse_arguments():
-    """解析命令行参数"""
-    parser = argparse.ArgumentParser(description='ePub服务器')
-    parser.add_argument('--title', type=str, help='书名')
-    parser.add_argument('--epub', type=str, help='ePub电子书路径（绝对路径或相对路径）')
-    parser.add_argument('--ip', type=str, help='服务器IP地址')
-    parser.add_argument('--port', type=int, help='服务器端口')
-    return parser.parse_args()
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
 
-def is_packaged():
-    """检查是否在打包模式下运行"""
-    return getattr(sys, 'frozen', False)
+class DeadlineExceeded(TimeoutError):
+    """超过了请求或响应的总时限（已计入指标）"""
 
-def get_user_input():
-    """获取用户输入（仅在独立运行时使用）"""
-    # 获取服务器IP
-    server_ip = input("请输入服务器IP（直接回车为127.0.0.1）: ").strip()
-    if not server_ip:
-        server_ip = "127.0.0.1"
+class _DeadlineSocket(io.RawIOBase):
+    """
+    连接的读写加上总期限：套接字超时只限制单次收发，客户端每次只发一个字节时可以一直占用工作线程；
+    设置deadline后每次收发前把套接字超时缩短到距期限的剩余时间，过了期限时抛出TimeoutError
+    """
+    def __init__(self, sock):
+        super().__init__()
+        self._sock = sock
+        self.deadline = None
     
-    # 获取服务器端口
-    server_port_input = input("请输入服务器端口（直接回车为10086）: ").strip()
-    if server_port_input:
-        try:
-            server_port = int(server_port_input)
-        except ValueError:
-            print("输入无效，使用默认端口10086")
-            server_port = 10086
-    else:
-        server_port = 10086
+    def readable(self):
+        return True
     
-    return server_ip, server_port
+    def writable(self):
+        return True
+    
+    def _apply_deadline(self):
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            METRICS.record_dropped('timeout')
+            raise DeadlineExceeded('超过请求或响应的总时限')
+        timeout = self._sock.gettimeout()
+        if timeout is None or remaining < timeout:
+            self._sock.settimeout(remaining)
+    
+    def readinto(self, b):
+        self._apply_deadline()
+        return self._sock.recv_into(b)
+    
+    def write(self, b):
+        # sendall的超时限制整次发送，写入的数据总是全部发出
+        self._apply_deadline()
+        self._sock.sendall(b)
+        return len(b)
 
-def get_epub_path_from_user(reader_dir):
-    """从用户输入获取epub路径，以reader目录为起点验证路径有效性"""
-    while True:
-        epub_path_input = input("请输入ePub电子书路径（直接回车为epub\\book.epub）: ").strip()
+class ServerMetrics:
+    """
+    服务器指标，输出为Prometheus文本格式：
+    - 按路由统计的请求数、延迟直方图和发送字节数
+    - 当前连接数、历史记录写入延迟
+    - 缓存命中/未命中次数、队列深度等瞬时值
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._latency = {}
+        self._bytes_sent = {}
+        self._in_flight = 0
+        self._history_writes = _Histogram(self.LATENCY_BUCKETS)
+        self._cache = {}
+        self._gauges = {}
+        self._dropped = {}
+    
+    def connection_opened(self):
+        with self._lock:
+            self._in_flight += 1
+    
+    def connection_closed(self):
+        with self._lock:
+            self._in_flight -= 1
+    
+    def observe_request(self, route, method, status, seconds, bytes_sent):
+        """记录一次请求"""
+        with self._lock:
+            key = (route, method, str(status))
+            self._requests[key] = self._requests.get(key, 0) + 1
+            histogram = self._latency.get(route)
+            if histogram is None:
+                histogram = self._latency[route] = _Histogram(self.LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            self._bytes_sent[route] = self._bytes_sent.get(route, 0) + bytes_sent
+    
+    def observe_history_write(self, seconds):
+        """记录一次历史记录落盘耗时"""
+        with self._lock:
+            self._history_writes.observe(seconds)
+    
+    def record_cache(self, cache, hit):
+        """记录一次缓存访问（hit为True表示命中）"""
+        with self._lock:
+            counts = self._cache.setdefault(cache, [0, 0])
+            counts[0 if hit else 1] += 1
+    
+    def record_dropped(self, reason):
+        """记录一个被拒绝或中断的连接（reason如queue_full、client_limit、disconnected）"""
+        with self._lock:
+            self._dropped[reason] = self._dropped.get(reason, 0) + 1
+    
+    def register_gauge(self, name, help_text, func):
+        """注册瞬时值（如队列深度），在输出指标时调用func()取值"""
+        with self._lock:
+            self._gauges[name] = (help_text, func)
+    
+    @staticmethod
+    def _labels(**labels):
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+    
+    def _render_histogram(self, lines, name, histogram, labels):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{self._labels(**labels, le=repr(bound))} {cumulative}')
+        lines.append(f'{name}_bucket{self._labels(**labels, le="+Inf")} {histogram.count}')
+        suffix = self._labels(**labels) if labels else ''
+        lines.append(f'{name}_sum{suffix} {histogram.total:.6f}')
+        lines.append(f'{name}_count{suffix} {histogram.count}')
+    
+    def render(self):
+        """生成Prometheus文本格式的指标"""
+        with self._lock:
+            requests = dict(self._requests)
+            latency = {route: copy.deepcopy(h) for route, h in self._latency.items()}
+            bytes_sent = dict(self._bytes_sent)
+            in_flight = self._in_flight
+            history_writes = copy.deepcopy(self._history_writes)
+            cache = {name: list(counts) for name, counts in self._cache.items()}
+            gauges = dict(self._gauges)
+            dropped = dict(self._dropped)
         
-        # 移除可能包裹的双引号
-        epub_path_input = epub_path_input.strip('"')
+        lines = []
+        lines.append('# HELP epub_server_requests_total 按路由、方法和状态码统计的请求数')
+        lines.append('# TYPE epub_server_requests_total counter')
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(f'epub_server_requests_total{self._labels(route=route, method=method, status=status)} {count}')
         
-        if not epub_path_input:
-            print("路径为epub\\book.epub")
-            epub_path_input = "epub\\book.epub"
+        lines.append('# HELP epub_server_request_duration_seconds 按路由统计的请求处理耗时')
+        lines.append('# TYPE epub_server_request_duration_seconds histogram')
+        for route, histogram in sorted(latency.items()):
+            self._render_histogram(lines, 'epub_server_request_duration_seconds', histogram, {'route': route})
         
-        # 验证路径有效性（以reader目录为起点）
-        is_valid, result = validate_epub_path(epub_path_input, reader_dir)
+        lines.append('# HELP epub_server_response_bytes_total 按路由统计的发送字节数')
+        lines.append('# TYPE epub_server_response_bytes_total counter')
+        for route, count in sorted(bytes_sent.items()):
+            lines.append(f'epub_server_response_bytes_total{self._labels(route=route)} {count}')
         
-        if is_valid:
-            print(f"找到电子书文件: {result}")
-            return epub_path_input
-        else:
-            print(f"错误: {result}")
-            print("请重新输入有效的电子书路径")
+        lines.append('# HELP epub_server_connections_in_flight 当前正在处理的连接数')
+        lines.append('# TYPE epub_server_connections_in_flight gauge')
+        lines.append(f'epub_server_connections_in_flight {in_flight}')
+        
+        lines.append('# HELP epub_server_connections_dropped_total 被拒绝或中断的连接数（按原因）')
+        lines.append('# TYPE epub_server_connections_dropped_total counter')
+        for reason, count in sorted(dropped.items()):
+            lines.append(f'epub_server_connections_dropped_total{self._labels(reason=reason)} {count}')
+        
+        lines.append('# HELP epub_server_history_write_seconds 历史记录写入耗时')
+        lines.append('# TYPE epub_server_history_write_seconds histogram')
+        self._render_histogram(lines, 'epub_server_history_write_seconds', history_writes, {})
+        
+        lines.append('# HELP epub_server_cache_hits_total 缓存命中次数')
+        lines.append('# TYPE epub_server_cache_hits_total counter')
+        for name, (hits, _) in sorted(cache.items()):
+            lines.append(f'epub_server_cache_hits_total{self._labels(cache=name)} {hits}')
+        lines.append('# HELP epub_server_cache_misses_total 缓存未命中次数')
+        lines.append('# TYPE epub_server_cache_misses_total counter')
+        for name, (_, misses) in sorted(cache.items()):
+            lines.append(f'epub_server_cache_misses_total{self._labels(cache=name)} {misses}')
+        
+        for name, (help_text, func) in sorted(gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+        
+        return '\n'.join(lines) + '\n'
 
-def keyboard_listener(httpd, reader_dir):
-    """监听键盘输入，ESC键退出"""
+METRICS = ServerMetrics()
+METRICS.register_gauge('epub_server_threads', '当前线程数', threading.active_count)
+METRICS.register_gauge('epub_server_history_pending', '等待写入文件的历史记录数', PROGRESS.pending)
+
+class _NullPhase:
+    """未开启追踪时使用的空上下文"""
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PHASE = _NullPhase()
+
+class _Phase:
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+    
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self._trace.phases.append((self._name, time.perf_counter() - self._start))
+        return False
+
+class RequestTrace:
+    """单个请求的分阶段耗时"""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = []
+    
+    def phase(self, name):
+        return _Phase(self, name)
+    
+    def server_timing(self):
+        """生成Server-Timing头（只包含发送响应头之前已完成的阶段）"""
+        parts = [f'{name};dur={seconds * 1000:.3f}' for name, seconds in self.phases]
+        parts.append(f'total;dur={(time.perf_counter() - self.start) * 1000:.3f}')
+        return ', '.join(parts)
+    
+    def to_record(self, handler):
+        """生成写入追踪日志的结构化记录"""
+        return {
+            'ts': round(time.time(), 3),
+            'client': handler.client_address[0],
+            'method': handler.command,
+            'path': handler.path,
+            'route': handler._route,
+            'status': handler._status,
+            'total_ms': round((time.perf_counter() - self.start) * 1000, 3),
+            'phases': {name: round(seconds * 1000, 3) for name, seconds in self.phases},
+        }
+
+# 请求追踪（通过--trace开启）
+TRACE_ENABLED = False
+TRACE_LOGGER = None
+
+def setup_tracing(enabled, log_path=None):
+    """开启请求追踪，可选写入按大小轮转的追踪日志（每行一个JSON）"""
+    global TRACE_ENABLED, TRACE_LOGGER
+    TRACE_ENABLED = enabled
+    if enabled and log_path:
+        import logging
+        import logging.handlers
+        log_path = Path(log_path).resolve()
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            log_path, maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        TRACE_LOGGER = logging.getLogger('epub_server.trace')
+        TRACE_LOGGER.setLevel(logging.INFO)
+        TRACE_LOGGER.propagate = False
+        TRACE_LOGGER.addHandler(handler)
+        print(f"追踪日志: {log_path}")
+
+def get_profile_dir():
+    """获取性能分析结果目录（数据目录下的Profiles）"""
+    profile_dir = get_data_dir() / "Profiles"
+    profile_dir.mkdir(exist_ok=True)
+    return profile_dir
+
+class LiveProfiler:
+    """
+    运行中的服务器按需性能分析，一次会话持续指定秒数，同时进行：
+    - cProfile：对会话期间处理的每个请求分别分析，结束后合并为pstats文件
+    - 采样：后台线程定期读取sys._current_frames()，输出折叠栈文件（可用flamegraph.pl/speedscope查看）
+    - tracemalloc：会话开始和结束各取一次快照，输出分配增长最多的位置
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._profiles = []
+        self._prefix = None
+    
+    @property
+    def running(self):
+        return self._running
+    
+    def start(self, seconds, sample_interval=0.005):
+        """开始一次分析会话，返回输出文件路径；已有会话在运行时返回None"""
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+            self._profiles = []
+        
+        prefix = get_profile_dir() / time.strftime('profile-%Y%m%d-%H%M%S')
+        self._prefix = prefix
+        files = {
+            'pstats': str(prefix.with_suffix('.pstats')),
+            'collapsed': str(prefix.with_suffix('.collapsed')),
+            'tracemalloc': str(prefix.with_suffix('.tracemalloc.txt')),
+        }
+        thread = threading.Thread(target=self._run, args=(seconds, sample_interval, files),
+                                  name='live-profiler', daemon=True)
+        thread.start()
+        print(f"开始性能分析，持续{seconds}秒，结果保存到: {prefix}.*")
+        return files
+    
+    def profile_call(self, func):
+        """在分析会话期间用cProfile包装一次请求处理"""
+        if not self._running:
+            return func()
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 其他线程的cProfile正在运行（Python 3.12+同一时刻只允许一个），跳过此请求
+            return func()
+        try:
+            return func()
+        finally:
+            profile.disable()
+            with self._lock:
+                if self._running:
+                    # 会话结束时再合并，避免在请求路径上生成统计
+                    self._profiles.append(profile)
+    
+    def _run(self, seconds, sample_interval, files):
+        import pstats
+        import tracemalloc
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(25)
+        before = tracemalloc.take_snapshot()
+        
+        stacks = {}
+        own_ident = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    key = ';'.join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                time.sleep(sample_interval)
+        finally:
+            after = tracemalloc.take_snapshot()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            with self._lock:
+                self._running = False
+                profiles = self._profiles
+                self._profiles = []
+        
+        try:
+            if profiles:
+                pstats.Stats(*profiles).dump_stats(files['pstats'])
+            else:
+                files['pstats'] = None
+            with open(files['collapsed'], 'w', encoding='utf-8') as f:
+                for key, count in sorted(stacks.items()):
+                    f.write(f"{key} {count}\n")
+            with open(files['tracemalloc'], 'w', encoding='utf-8') as f:
+                f.write(f"# 分析时长{seconds}秒内内存分配增长最多的位置\n")
+                for stat in after.compare_to(before, 'lineno')[:50]:
+                    f.write(f"{stat}\n")
+                f.write("\n# 会话结束时内存占用最多的位置\n")
+                for stat in after.statistics('lineno')[:50]:
+                    f.write(f"{stat}\n")
+            print(f"性能分析完成: {self._prefix}.*")
+        except Exception as e:
+            print(f"保存性能分析结果失败: {e}")
+
+PROFILER = LiveProfiler()
+
+# 管理接口令牌（通过--admin-token设置，未设置时管理接口只允许本机访问）
+ADMIN_TOKEN = None
+
+def is_admin_request(handler):
+    """检查请求是否有权访问管理接口"""
+    if ADMIN_TOKEN:
+        import hmac
+        query = parse_qs(urlparse(handler.path).query)
+        token = handler.headers.get('X-Admin-Token') or query.get('token', [None])[0]
+        return hmac.compare_digest(str(token or ''), ADMIN_TOKEN)
+    return handler.client_address[0] in ('127.0.0.1', '::1')
+
+def install_profile_signal(seconds=30):
+    """注册SIGUSR1信号：收到时开始一次性能分析（仅类Unix系统）"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    def _handler(signum, frame):
+        PROFILER.start(seconds)
+    signal.signal(signal.SIGUSR1, _handler)
+
+class TraceRecorder:
+    """
+    记录请求轨迹（方法、路径、部分请求头、请求体大小、耗时），供benchmarks.replay重放
+    文件为每行一个JSON的紧凑格式，文件名以.gz结尾时使用gzip压缩
+    """
+    HEADERS = ('User-Agent', 'Content-Type', 'Accept', 'Accept-Encoding', 'Range',
+               'If-None-Match', 'If-Modified-Since')
+    
+    def __init__(self, path):
+        self.path = Path(path).resolve()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.suffix == '.gz':
+            import gzip
+            self._file = gzip.open(self.path, 'wt', encoding='utf-8')
+        else:
+            # 行缓冲：进程被强制结束时最多丢失正在写的一行
+            self._file = open(self.path, 'w', encoding='utf-8', buffering=1)
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._last_flush = self._start
+        self._write({'version': 1, 'started': round(time.time(), 3)})
+    
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+    
+    def record(self, handler, start, duration, bytes_sent):
+        """记录一个已完成的请求（start为time.perf_counter()时间）"""
+        headers = {}
+        for name in self.HEADERS:
+            value = handler.headers.get(name) if handler.headers else None
+            if value:
+                headers[name] = value
+        try:
+            body = int(handler.headers.get('Content-Length') or 0)
+        except (TypeError, ValueError, AttributeError):
+            body = 0
+        record = {
+            't': round(start - self._start, 4),
+            'm': handler.command,
+            # do_GET会把'/'改写为'/index.html'，记录原始请求行中的路径
+            'p': handler.requestline.split(' ')[1] if handler.requestline.count(' ') >= 2 else handler.path,
+            'r': handler._route,
+            'h': headers,
+            'b': body,
+            's': handler._status,
+            'd': round(duration * 1000, 3),
+            'o': bytes_sent,
+        }
+        with self._lock:
+            if not self._file.closed:
+                self._write(record)
+                # gzip每秒最多刷新一次：进程被强制结束时最多丢失最后一秒的记录
+                if start - self._last_flush > 1.0:
+                    self._file.flush()
+                    self._last_flush = start
+    
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+# 请求轨迹记录（通过--record-trace开启）
+TRACE_RECORDER = None
+
+# 合并脚本：index.html中的脚本按原顺序合并、精简为一个文件，文件名带内容哈希，浏览器可以永久缓存
+BUNDLE_SOURCES = [
+    'js/libs/jquery.min.js',
+    'js/libs/zip.min.js',
+    'js/libs/localforage.min.js',
+    'js/libs/screenfull.min.js',
+    'js/epub.js',
+    'js/reader.js',
+]
+BUNDLE_ENABLED = True
+_BUNDLE = None
+_BUNDLE_FAILED = False
+_BUNDLE_LOCK = threading.Lock()
+_BASE64_DIGITS = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def read_reader_asset(name):
+    """读取阅读器资源（附加数据或当前的reader目录），不存在时返回None"""
+    if ASSET_ARCHIVE is not None and ASSET_ARCHIVE.has(PAYLOAD_READER_PREFIX + name):
+        return ASSET_ARCHIVE.read(PAYLOAD_READER_PREFIX + name)
+    path = Path(name)
+    return path.read_bytes() if path.is_file() else None
+
+def minify_js_lines(text):
+    """
+    保守的按行精简：去掉缩进、空行、整行的//注释和整行的/* */注释（保留/*!版权注释），
+    保留的行内容和换行不变，不影响自动分号插入；保留的代码中有模板字符串或续行字符串时不精简。
+    返回[(行内容, 原始行号, 原始缩进)]
+    """
+    import re
+    lines = text.split('\n')
+    result = []
+    skip_to = -1
+    for i, line in enumerate(lines):
+        if i <= skip_to:
+            continue
+        stripped = line.strip()
+        if not stripped or stripped.startswith('//'):
+            continue
+        if stripped.startswith('/*') and not stripped.startswith('/*!'):
+            # 找到注释结束的位置，只有结束后该行没有其他内容时才整段去掉
+            end, rest = i, stripped[2:]
+            while '*/' not in rest and end + 1 < len(lines):
+                end += 1
+                rest = lines[end]
+            if '*/' in rest and not rest.split('*/', 1)[1].strip():
+                skip_to = end
+                continue
+        result.append((stripped, i, len(line) - len(line.lstrip())))
+    
+    # 去掉行内的字符串和注释后检查
+    literals = re.compile(r"'(?:[^'\\\n]|\\.)*'|\"(?:[^\"\\\n]|\\.)*\"|/\*.*?\*/")
+    for stripped, _, _ in result:
+        if stripped.endswith('\\') or '`' in literals.sub('', stripped):
+            # 字符串跨行，去掉缩进会改变字符串内容
+            return [(line.rstrip('\r'), i, 0) for i, line in enumerate(lines)
+                    if not line.startswith('//# sourceMappingURL=')]
+    return result
+
+def _vlq(value):
+    """source map的Base64 VLQ编码"""
+    value = ((-value) << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        encoded += _BASE64_DIGITS[digit]
+        if not value:
+            return encoded
+
+def _line_source_map(source, kept_lines):
+    """按行映射的source map：每个输出行映射到原文件对应行的缩进之后"""
+    segments = []
+    previous_line = previous_column = 0
+    for _, line, column in kept_lines:
+        segments.append(_vlq(0) + _vlq(0) + _vlq(line - previous_line) + _vlq(column - previous_column))
+        previous_line, previous_column = line, column
+    return {'version': 3, 'sources': ['/' + source], 'names': [], 'mappings': ';'.join(segments)}
+
+class AssetBundle:
+    """合并后的脚本及其source map（index map，每个源文件一段），文件名为{prefix}.{内容哈希}.js"""
+    def __init__(self, sources, prefix='js/bundle'):
+        import gzip
+        import hashlib
+        self.sources = list(sources)
+        parts = []
+        sections = []
+        offset = 0
+        for source in self.sources:
+            data = read_reader_asset(source)
+            if data is None:
+                raise FileNotFoundError(source)
+            kept = minify_js_lines(data.decode('utf-8-sig'))
+            sections.append({'offset': {'line': offset, 'column': 0}, 'map': _line_source_map(source, kept)})
+            # 每个文件后单独一行分号，避免前一个文件结尾缺少分号
+            parts.append('\n'.join(line for line, _, _ in kept) + '\n;\n')
+            offset += len(kept) + 1
+        content = ''.join(parts)
+        self.hash = hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+        self.name = f"{prefix}.{self.hash}.js"
+        self.map_name = self.name + '.map'
+        self.body = (content + f"//# sourceMappingURL={self.map_name.rsplit('/', 1)[1]}\n").encode('utf-8')
+        self.gzipped = gzip.compress(self.body, 9)
+        self.map_body = json.dumps({'version': 3, 'file': self.name.rsplit('/', 1)[1], 'sections': sections},
+                                   separators=(',', ':')).encode('utf-8')
+        self.etag = f'"{self.hash}"'
+    
+    def rewrite_html(self, content):
+        """把页面中各个源文件的script标签替换为一个合并脚本标签（缺少任何一个时不替换）"""
+        tags = [f'<script src="{source}"></script>' for source in self.sources]
+        if not all(tag in content for tag in tags):
+            return content
+        content = content.replace(tags[0], f'<script src="{self.name}"></script>', 1)
+        for tag in tags[1:]:
+            content = content.replace(tag, '', 1)
+        return content
+
+# 页面与服务器的集成脚本（进度恢复与同步等），服务器只注入配置，脚本本身带内容哈希可长期缓存
+SYNC_SCRIPT_SOURCE = 'js/reader-sync.js'
+SYNC_SCRIPT_PREFIX = 'js/reader-sync'
+_SYNC_SCRIPT = None
+
+def get_sync_script():
+    """获取集成脚本（第一次调用时生成），找不到时返回None"""
+    global _SYNC_SCRIPT
+    with _BUNDLE_LOCK:
+        if _SYNC_SCRIPT is None:
+            try:
+                _SYNC_SCRIPT = AssetBundle([SYNC_SCRIPT_SOURCE], SYNC_SCRIPT_PREFIX)
+            except (OSError, UnicodeDecodeError) as e:
+                print(f"读取集成脚本失败: {e}")
+    return _SYNC_SCRIPT
+
+def get_asset_bundle():
+    """获取合并脚本（第一次调用时生成），未开启或生成失败时返回None"""
+    global _BUNDLE, _BUNDLE_FAILED
+    if not BUNDLE_ENABLED:
+        return None
+    with _BUNDLE_LOCK:
+        if _BUNDLE is None and not _BUNDLE_FAILED:
+            try:
+                _BUNDLE = AssetBundle(BUNDLE_SOURCES)
+                print(f"已生成合并脚本: {_BUNDLE.name} ({len(_BUNDLE.body) // 1024}KB, gzip后{len(_BUNDLE.gzipped) // 1024}KB)")
+            except (OSError, UnicodeDecodeError) as e:
+                _BUNDLE_FAILED = True
+                print(f"生成合并脚本失败，使用原始脚本: {e}")
+    return _BUNDLE
+
+# 离线缓存：Service Worker预缓存的阅读器资源目录（脚本另外按是否合并确定）
+PRECACHE_DIRS = ('css/', 'font/', 'img/')
+SERVICE_WORKER_NAME = 'sw.js'
+_PRECACHE_ASSETS = None
+_PRECACHE_LOCK = threading.Lock()
+
+def list_reader_assets():
+    """列出阅读器资源（相对reader目录的路径）"""
+    if ASSET_ARCHIVE is not None:
+        return sorted(name[len(PAYLOAD_READER_PREFIX):] for name in ASSET_ARCHIVE.names
+                      if name.startswith(PAYLOAD_READER_PREFIX) and not name.endswith('/'))
+    return sorted(path.as_posix() for path in Path('.').rglob('*') if path.is_file())
+
+def get_precache_assets():
+    """需要预缓存的阅读器资源及其内容哈希（第一次调用时计算）"""
+    global _PRECACHE_ASSETS
+    import hashlib
+    with _PRECACHE_LOCK:
+        if _PRECACHE_ASSETS is None:
+            bundle = get_asset_bundle()
+            assets = []
+            sync_script = get_sync_script()
+            if sync_script is not None:
+                assets.append({'url': sync_script.name, 'revision': sync_script.hash})
+            names = [name for name in list_reader_assets() if name.startswith(PRECACHE_DIRS)]
+            if bundle is None:
+                names += BUNDLE_SOURCES
+            else:
+                assets.append({'url': bundle.name, 'revision': bundle.hash})
+            for name in names:
+                data = read_reader_asset(name)
+                if data is not None:
+                    assets.append({'url': name, 'revision': hashlib.sha256(data).hexdigest()[:12]})
+            _PRECACHE_ASSETS = assets
+    return _PRECACHE_ASSETS
+
+def get_book_revision(book):
+    """电子书的版本（离线缓存用），找不到文件时返回None"""
+    if book.hash:
+        return book.hash[:16]
+    if book.path == PAYLOAD_BOOK_URL and get_payload() is not None:
+        return get_payload().etag(PAYLOAD_BOOK_NAME).strip('"')
     try:
-        # 尝试使用msvcrt（Windows）
-        import msvcrt
-        while True:
-            if msvcrt.kbhit():
-                key = msvcrt.getch()
-                if key == b'\x1b':  # ESC键
-                    print("\n收到ESC键，正在退出服务器...")
+        stat = Path(book.path).stat()
+    except (OSError, TypeError):
+        return None
+    return f"{stat.st_size:x}-{int(stat.st_mtime):x}"
+
+def get_precache_manifest():
+    """预缓存清单：阅读器资源和当前电子书，version随任何内容变化"""
+    import hashlib
+    assets = get_precache_assets()
+    current = BOOK
+    book = None
+    revision = get_book_revision(current)
+    if revision is not None:
+        book = {'url': quote(current.path), 'revision': revision}
+    version = hashlib.sha256(json.dumps([assets, book], sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return {'version': version, 'assets': assets, 'book': book}
+
+# 拆分模式：浏览器按目录方式打开电子书，由/book/entry/逐个请求章节和资源，
+# 服务器根据书脊顺序和阅读位置在响应中预加载接下来的章节
+BOOK_MODE = 'archive'
+BOOK_ENTRY_PREFIX = 'book/entry/'
+PRELOAD_COUNT = 2
+
+class BookIndex:
+    """
+    电子书的书脊索引：按阅读顺序排列的章节、每个章节引用的样式表/图片/字体，
+    以及按路径读取单个条目（zip内的文件）
+    """
+    def __init__(self, source, member=None):
+        import zipfile
+        import xml.etree.ElementTree as ET
+        if member is not None:
+            self._zip = zipfile.ZipFile(get_payload().open(member))
+        else:
+            self._zip = zipfile.ZipFile(source)
+        self._lock = threading.Lock()
+        self._resources = {}
+        self.names = set(self._zip.namelist())
+        
+        def _local_name(tag):
+            return tag.rsplit('}', 1)[-1]
+        
+        container = ET.fromstring(self._zip.read('META-INF/container.xml'))
+        opf_path = next(el.get('full-path') for el in container.iter() if _local_name(el.tag) == 'rootfile')
+        self.opf_path = opf_path
+        opf_dir = posixpath.dirname(opf_path)
+        opf = ET.fromstring(self._zip.read(opf_path))
+        
+        self.media_types = {}
+        manifest = {}
+        # 目录：EPUB3的导航文档，没有时使用EPUB2的NCX
+        self.toc_path = None
+        ncx_path = None
+        for el in opf.iter():
+            if _local_name(el.tag) == 'item' and el.get('href'):
+                name = posixpath.normpath(posixpath.join(opf_dir, unquote(el.get('href'))))
+                manifest[el.get('id')] = name
+                self.media_types[name] = el.get('media-type', '')
+                if 'nav' in (el.get('properties') or '').split():
+                    self.toc_path = name
+                elif el.get('media-type') == 'application/x-dtbncx+xml':
+                    ncx_path = name
+        self.toc_path = self.toc_path or ncx_path
+        self.idrefs = [el.get('idref') for el in opf.iter()
+                       if _local_name(el.tag) == 'itemref' and el.get('idref') in manifest]
+        self.spine = [manifest[idref] for idref in self.idrefs]
+        self.positions = {name: i for i, name in enumerate(self.spine)}
+        # 精简视图渲染好的章节（换书时随索引一起丢弃）
+        self.lite_chapters = {}
+        # 电子书的内容哈希（由BookState设置，缩放图片的缓存键使用）
+        self.book_hash = None
+        # 所属的BookState（由BookState设置），后台任务使用索引期间持有它
+        self.owner = None
+    
+    def read(self, name):
+        with self._lock:
+            return self._zip.read(name)
+    
+    def close(self):
+        with self._lock:
+            self._zip.close()
+    
+    def toc(self):
+        """目录中按顺序排列的条目[(书内路径, 锚点, 标题)]，没有目录或无法解析时返回空列表"""
+        import xml.etree.ElementTree as ET
+        if self.toc_path is None or self.toc_path not in self.names:
+            return []
+        
+        def _local_name(tag):
+            return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
+        
+        try:
+            root = ET.fromstring(self.read(self.toc_path))
+        except ET.ParseError:
+            return []
+        base = posixpath.dirname(self.toc_path)
+        links = []
+        if _local_name(root.tag) == 'ncx':
+            for point in root.iter():
+                if _local_name(point.tag) != 'navPoint':
+                    continue
+                label = src = None
+                for child in point:
+                    if _local_name(child.tag) == 'navLabel':
+                        label = ''.join(child.itertext())
+                    elif _local_name(child.tag) == 'content':
+                        src = child.get('src')
+                if src:
+                    links.append((src, label))
+        else:
+            navs = [el for el in root.iter() if _local_name(el.tag) == 'nav']
+            toc = next((nav for nav in navs if 'toc' in (nav.get('{http://www.idpf.org/2007/ops}type') or '').split()),
+                       navs[0] if navs else None)
+            if toc is not None:
+                links = [(a.get('href'), ''.join(a.itertext())) for a in toc.iter()
+                         if _local_name(a.tag) == 'a' and a.get('href')]
+        entries = []
+        for href, label in links:
+            target, _, fragment = href.partition('#')
+            name = posixpath.normpath(posixpath.join(base, unquote(target)))
+            label = ' '.join((label or '').split())
+            if name in self.positions and label:
+                entries.append((name, unquote(fragment), label))
+        return entries
+    
+    def etag(self, name):
+        info = self._zip.getinfo(name)
+        return f'"{info.CRC:08x}-{info.file_size:x}"'
+    
+    def content_type(self, name):
+        import mimetypes
+        return self.media_types.get(name) or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    
+    def _references(self, name, pattern):
+        text = self.read(name).decode('utf-8', 'ignore')
+        base = posixpath.dirname(name)
+        result = []
+        for ref in pattern.findall(text):
+            ref = unquote(ref.split('#', 1)[0].split('?', 1)[0])
+            if ref and '://' not in ref and not ref.startswith('data:'):
+                target = posixpath.normpath(posixpath.join(base, ref))
+                if target in self.names and target not in result:
+                    result.append(target)
+        return result
+    
+    def resources(self, name):
+        """章节直接引用的样式表和图片，以及样式表中引用的字体和图片（结果缓存）"""
+        import re
+        if name not in self._resources:
+            html_refs = re.compile(r'''<(?:link|img|image)\b[^>]*?(?:href|src)\s*=\s*["']([^"']+)["']''', re.I)
+            css_refs = re.compile(r'''url\(\s*["']?([^"')]+)["']?\s*\)''', re.I)
+            resources = []
+            for ref in self._references(name, html_refs):
+                if ref in self.positions or ref in resources:
+                    continue
+                resources.append(ref)
+                if self.content_type(ref) == 'text/css':
+                    resources += [r for r in self._references(ref, css_refs) if r not in resources]
+            self._resources[name] = resources
+        return self._resources[name]
+    
+    def preload_entries(self, start, count):
+        """从书脊第start项开始的count个章节及其资源（按需要的先后顺序）"""
+        entries = []
+        for name in self.spine[max(start, 0):max(start, 0) + count]:
+            for entry in [name] + self.resources(name):
+                if entry not in entries:
+                    entries.append(entry)
+        return entries
+    
+    @staticmethod
+    def cfi_spine_index(cfi):
+        """从CFI中取出书脊位置（epubcfi(/6/N...)中的N对应第N/2-1项），无法解析时返回None"""
+        import re
+        match = re.match(r'epubcfi\(/6/(\d+)', cfi or '')
+        return int(match.group(1)) // 2 - 1 if match else None
+
+def preload_link(name, content_type):
+    """生成一个Link: rel=preload的值（as按类型区分，fetch和字体请求需要crossorigin）"""
+    url = '/' + quote(BOOK_ENTRY_PREFIX + name)
+    if content_type == 'text/css':
+        return f'<{url}>; rel=preload; as=style'
+    if content_type.startswith('image/'):
+        return f'<{url}>; rel=preload; as=image'
+    if 'font' in content_type or name.lower().endswith(('.woff', '.woff2', '.ttf', '.otf')):
+        return f'<{url}>; rel=preload; as=font; crossorigin'
+    return f'<{url}>; rel=preload; as=fetch; crossorigin'
+
+# 精简视图：服务器把每个章节净化为独立的HTML页面（/lite/），浏览器不需要运行epub.js，
+# 适合电子墨水屏和旧手机；按字数分页，翻页时按CFI保存进度，与完整阅读器互通
+LITE_PREFIX = 'lite/'
+LITE_PAGE_CHARS = 4000
+LITE_STYLE = (
+    "body{max-width:40em;margin:0 auto;padding:0.5em 1em;font:1.1em/1.7 serif;color:#000;background:#fff}"
+    "img{max-width:100%;height:auto}pre{white-space:pre-wrap}"
+    "table{border-collapse:collapse}td,th{border:1px solid #999;padding:0.2em 0.4em}"
+    "nav{display:flex;justify-content:space-between;gap:1em;margin:0.8em 0;font-size:0.9em}"
+    "nav a{color:#000}"
+)
+LITE_ALLOWED_TAGS = frozenset({
+    'p', 'div', 'section', 'article', 'aside', 'header', 'footer', 'main', 'nav',
+    'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'code', 'hr', 'br',
+    'em', 'strong', 'b', 'i', 'u', 's', 'small', 'big', 'sub', 'sup', 'span', 'a', 'img',
+    'abbr', 'cite', 'q', 'del', 'ins', 'mark', 'ruby', 'rb', 'rt', 'rp',
+    'ul', 'ol', 'li', 'dl', 'dt', 'dd', 'figure', 'figcaption',
+    'table', 'caption', 'thead', 'tbody', 'tfoot', 'tr', 'th', 'td',
+})
+LITE_DROPPED_TAGS = frozenset({
+    'head', 'script', 'style', 'iframe', 'object', 'embed', 'noscript', 'template',
+    'form', 'button', 'input', 'select', 'textarea', 'audio', 'video', 'canvas',
+})
+LITE_VOID_TAGS = frozenset({'br', 'hr', 'img', 'image', 'meta', 'link', 'input', 'col', 'area',
+                            'base', 'wbr', 'source', 'track', 'param', 'embed'})
+LITE_BLOCK_TAGS = frozenset({'p', 'div', 'section', 'article', 'aside', 'header', 'footer', 'main',
+                             'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'hr',
+                             'ul', 'ol', 'li', 'dl', 'figure', 'table'})
+# 在这些元素内部不分页（重新打开后显示会乱）
+LITE_UNSPLITTABLE_TAGS = frozenset({'table', 'pre', 'figure', 'ruby', 'dl'})
+LITE_ATTRIBUTES = {'a': ('href',), 'img': ('src', 'alt'), 'td': ('colspan', 'rowspan'),
+                   'th': ('colspan', 'rowspan'), 'ol': ('start',)}
+LITE_GLOBAL_ATTRIBUTES = ('id', 'lang', 'dir', 'title')
+
+class LiteChapter:
+    """
+    精简视图中渲染好的一个章节：各页的HTML、每页开头元素在原文档中的路径（用于生成CFI）、
+    锚点（id）所在的页和章节标题
+    """
+    def __init__(self, pages, starts, anchors, title):
+        self.pages = pages
+        self.starts = starts
+        self.anchors = anchors
+        self.title = title
+    
+    def page_of(self, path):
+        """原文档中的元素路径所在的页（路径按文档顺序比较）"""
+        return max(bisect.bisect_right(self.starts, path) - 1, 0)
+
+def lite_cfi(index, position, path):
+    """精简视图中页的位置对应的CFI：epubcfi(/6/{书脊位置}[idref]!{元素路径})"""
+    steps = ''.join(f'/{step}' for step in path)
+    return f'epubcfi(/6/{2 * (position + 1)}[{index.idrefs[position]}]!{steps})'
+
+def cfi_element_path(cfi):
+    """取出CFI中章节内的元素路径（!之后的偶数步，到文本节点的奇数步或字符偏移为止）"""
+    import re
+    if not cfi or '!' not in cfi:
+        return []
+    local = cfi.split('!', 1)[1].split(',', 1)[0].split(':', 1)[0]
+    path = []
+    for step in re.findall(r'/(\d+)', re.sub(r'\[[^\]]*\]', '', local)):
+        step = int(step)
+        if step % 2:
+            break
+        path.append(step)
+    return path
+
+class _LiteRenderer(HTMLParser):
+    """
+    把章节XHTML净化为简单的HTML：只保留白名单中的标签和属性，删除脚本、样式和表单，
+    链接改为精简视图或/book/entry/的地址；同时记录每个元素在原文档中的路径（与CFI的步一致）
+    """
+    def __init__(self, index, position, page_chars):
+        super().__init__(convert_charrefs=True)
+        self.index = index
+        self.position = position
+        name = index.spine[position]
+        self.base = posixpath.dirname(name)
+        self.page_chars = page_chars
+        self.title = None
+        self.anchors = {}
+        self._stack = []
+        self._dropping = 0
+        self._in_title = False
+        self._open = []
+        self._pages = [[]]
+        self._starts = [None]
+        self._chars = 0
+        self._content = False
+    
+    def _element_path(self, tag):
+        """新元素在原文档中的路径：根元素（html）为空，之后每层是它在父元素中的位置×2"""
+        if not self._stack:
+            return []
+        parent = self._stack[-1]
+        parent['children'] += 1
+        return parent['path'] + [2 * parent['children']]
+    
+    def _rewrite_url(self, tag, url):
+        """改写链接和图片地址，不安全或找不到目标时返回None"""
+        url = url.strip()
+        scheme = url.split(':', 1)[0].lower() if ':' in url.split('/', 1)[0] else ''
+        if scheme:
+            if scheme in ('http', 'https', 'mailto') and tag == 'a':
+                return url
+            return url if scheme == 'data' and tag == 'img' else None
+        target, _, fragment = url.partition('#')
+        name = posixpath.normpath(posixpath.join(self.base, unquote(target.split('?', 1)[0]))) if target else None
+        if tag == 'a' and (name is None or name in self.index.positions):
+            position = self.index.positions.get(name, self.position)
+            return f'/{LITE_PREFIX}{position}' + (f'?id={quote(fragment)}' if fragment else '')
+        if name in self.index.names:
+            return '/' + quote(BOOK_ENTRY_PREFIX + name)
+        return None
+    
+    def _emit_start(self, tag, attrs, path):
+        allowed = LITE_ATTRIBUTES.get(tag, ()) + LITE_GLOBAL_ATTRIBUTES
+        parts = []
+        for key, value in attrs:
+            if value is None or key not in allowed:
+                continue
+            if key in ('href', 'src'):
+                value = self._rewrite_url(tag, value)
+                if value is None:
+                    continue
+            if key == 'id':
+                self.anchors.setdefault(value, len(self._pages) - 1)
+            parts.append(f' {key}="{html.escape(value)}"')
+        if tag == 'img':
+            if not any(part.startswith(' src=') for part in parts):
+                return
+            self._content = True
+        if self._starts[-1] is None and (tag in LITE_BLOCK_TAGS or tag == 'img'):
+            self._starts[-1] = path
+        self._pages[-1].append(f'<{tag}{"".join(parts)}>')
+        if tag not in LITE_VOID_TAGS:
+            # 分页后重新打开时不带id，避免重复
+            reopen = f'<{tag}{"".join(p for p in parts if not p.startswith(" id="))}>'
+            self._open.append((tag, reopen))
+    
+    def handle_starttag(self, tag, attrs):
+        path = self._element_path(tag)
+        entry = {'tag': tag, 'path': path, 'children': 0, 'emitted': False, 'dropping': False}
+        if tag == 'title' and self.title is None:
+            self._in_title = True
+            self.title = ''
+        if self._dropping or tag in LITE_DROPPED_TAGS:
+            if tag not in LITE_VOID_TAGS:
+                entry['dropping'] = True
+                self._dropping += 1
+                self._stack.append(entry)
+            return
+        if tag == 'image':
+            # SVG中的图片（常见于封面页）
+            href = dict(attrs).get('xlink:href') or dict(attrs).get('href')
+            if href:
+                self._emit_start('img', [('src', href)], path)
+            return
+        if tag in LITE_ALLOWED_TAGS:
+            self._emit_start(tag, attrs, path)
+            entry['emitted'] = tag not in LITE_VOID_TAGS
+        if tag not in LITE_VOID_TAGS:
+            self._stack.append(entry)
+    
+    def handle_endtag(self, tag):
+        if tag in LITE_VOID_TAGS:
+            return
+        # 容忍不匹配的结束标签：关闭到最近的同名元素，找不到时忽略
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i]['tag'] == tag:
+                break
+        else:
+            return
+        while len(self._stack) > i:
+            entry = self._stack.pop()
+            if entry['dropping']:
+                self._dropping -= 1
+            if entry['emitted']:
+                self._pages[-1].append(f'</{self._open.pop()[0]}>')
+            if entry['tag'] == 'title':
+                self._in_title = False
+        if tag in LITE_BLOCK_TAGS:
+            self._maybe_split()
+    
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        if self._dropping or not self._stack:
+            return
+        self._pages[-1].append(html.escape(data, quote=False))
+        text = data.strip()
+        if text:
+            self._chars += len(text)
+            self._content = True
+    
+    def _maybe_split(self):
+        """当前页的字数超过上限时在块级元素结束处分页，未关闭的元素在下一页重新打开"""
+        if self.page_chars <= 0 or self._chars < self.page_chars:
+            return
+        if any(tag in LITE_UNSPLITTABLE_TAGS for tag, _ in self._open):
+            return
+        self._pages[-1].extend(f'</{tag}>' for tag, _ in reversed(self._open))
+        self._pages.append([reopen for _, reopen in self._open])
+        self._starts.append(None)
+        self._chars = 0
+        self._content = False
+    
+    def result(self):
+        pages = self._pages
+        starts = self._starts
+        if len(pages) > 1 and not self._content:
+            # 最后一页只有重新打开的空元素
+            pages[-2].extend(pages.pop())
+            starts.pop()
+        for i, start in enumerate(starts):
+            if start is None:
+                starts[i] = starts[i - 1] if i else [4]
+        title = ' '.join((self.title or '').split())
+        return LiteChapter([''.join(page) for page in pages], starts, self.anchors, title)
+
+def get_lite_chapter(index, position):
+    """渲染精简视图中的一个章节（结果缓存在书脊索引上）"""
+    key = (position, LITE_PAGE_CHARS)
+    chapter = index.lite_chapters.get(key)
+    if chapter is None:
+        renderer = _LiteRenderer(index, position, LITE_PAGE_CHARS)
+        renderer.feed(index.read(index.spine[position]).decode('utf-8', 'replace'))
+        renderer.close()
+        chapter = renderer.result()
+        index.lite_chapters[key] = chapter
+    return chapter
+
+def render_lite_page(title, body, nav):
+    """精简视图的页面（样式内联，不需要再请求其他资源）"""
+    return f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{html.escape(title)}</title>
+<style>{LITE_STYLE}</style>
+</head>
+<body>
+{nav}
+<main>{body}</main>
+{nav}
+</body>
+</html>
+"""
+
+# 阅读位置：每本书预先统计各章节的字数（不含空白）以及章节中块级元素和锚点开头的字数偏移（位置表），
+# 按电子书哈希缓存在Cache/positions；服务器用它把保存的CFI换算为全书百分比和所在的目录标题，
+# 不需要浏览器加载整本书
+POSITION_TABLE_VERSION = 1
+POSITION_MEMORY_SIZE = 32
+POSITION_RESULT_CACHE_SIZE = 4096
+_POSITION_TABLES = None
+_POSITION_TABLES_LOCK = threading.Lock()
+
+class _OffsetScanner(HTMLParser):
+    """统计章节的字数，记录块级元素和图片开头的路径（与CFI的步一致）及字数偏移、锚点的字数偏移和第一个标题"""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chars = 0
+        self.paths = []
+        self.offsets = []
+        self.anchors = {}
+        self.heading = None
+        self._stack = []
+        self._dropping = 0
+        self._heading_depth = None
+        self._heading_text = []
+    
+    def handle_starttag(self, tag, attrs):
+        path = []
+        if self._stack:
+            parent = self._stack[-1]
+            parent['children'] += 1
+            path = parent['path'] + [2 * parent['children']]
+        if not self._dropping:
+            element_id = dict(attrs).get('id')
+            if element_id:
+                self.anchors.setdefault(element_id, self.chars)
+            if tag in LITE_BLOCK_TAGS or tag in ('img', 'image'):
+                self.paths.append(path)
+                self.offsets.append(self.chars)
+        if tag in LITE_VOID_TAGS:
+            return
+        dropping = bool(self._dropping) or tag in LITE_DROPPED_TAGS
+        if dropping:
+            self._dropping += 1
+        if tag in ('h1', 'h2', 'h3', 'h4', 'h5', 'h6') and self.heading is None and self._heading_depth is None and not dropping:
+            self._heading_depth = len(self._stack)
+        self._stack.append({'tag': tag, 'path': path, 'children': 0, 'dropping': dropping})
+    
+    def handle_endtag(self, tag):
+        if tag in LITE_VOID_TAGS:
+            return
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i]['tag'] == tag:
+                break
+        else:
+            return
+        while len(self._stack) > i:
+            entry = self._stack.pop()
+            if entry['dropping']:
+                self._dropping -= 1
+        if self._heading_depth is not None and len(self._stack) <= self._heading_depth:
+            self._heading_depth = None
+            self.heading = ' '.join(''.join(self._heading_text).split()) or None
+            self._heading_text = []
+    
+    def handle_data(self, data):
+        if self._dropping or not self._stack:
+            return
+        if self._heading_depth is not None:
+            self._heading_text.append(data)
+        self.chars += len(''.join(data.split()))
+
+class PositionTable:
+    """一本书的位置表：各章节的字数和块级元素偏移，以及目录条目在全书中的字数偏移"""
+    def __init__(self, data):
+        self.chapters = data['chapters']
+        self.idrefs = {chapter['idref']: i for i, chapter in enumerate(self.chapters)}
+        self.starts = []
+        total = 0
+        for chapter in self.chapters:
+            self.starts.append(total)
+            total += chapter['chars']
+        self.total = total
+        self.toc = data['toc']
+        self._toc_offsets = [offset for offset, _ in self.toc]
+    
+    @staticmethod
+    def build(index):
+        """读取书中的每个章节生成位置表的数据（可以保存为JSON）"""
+        chapters = []
+        anchors = []
+        for position, name in enumerate(index.spine):
+            scanner = _OffsetScanner()
+            try:
+                scanner.feed(index.read(name).decode('utf-8', 'replace'))
+                scanner.close()
+            except Exception as e:
+                print(f"统计章节字数失败 {name}: {e}")
+            chapters.append({'idref': index.idrefs[position], 'chars': scanner.chars,
+                             'heading': scanner.heading, 'paths': scanner.paths, 'offsets': scanner.offsets})
+            anchors.append(scanner.anchors)
+        
+        # 目录条目换算为全书中的字数偏移
+        starts = [0]
+        for chapter in chapters:
+            starts.append(starts[-1] + chapter['chars'])
+        toc = []
+        for name, fragment, title in index.toc():
+            position = index.positions[name]
+            offset = starts[position] + anchors[position].get(fragment, 0)
+            toc.append([offset, title])
+        toc.sort(key=lambda entry: entry[0])
+        return {'version': POSITION_TABLE_VERSION, 'chapters': chapters, 'toc': toc}
+    
+    def locate(self, cfi):
+        """CFI在全书中的位置：{'percent': 百分比, 'chapter': 书脊位置, 'chapter_title': 目录标题}，无法解析时返回None"""
+        import re
+        position = BookIndex.cfi_spine_index(cfi)
+        match = re.match(r'epubcfi\(/6/\d+\[([^\]]+)\]', cfi or '')
+        if match and match.group(1) in self.idrefs:
+            # CFI中带有章节的idref时以它为准
+            position = self.idrefs[match.group(1)]
+        if position is None or not 0 <= position < len(self.chapters):
+            return None
+        chapter = self.chapters[position]
+        i = bisect.bisect_right(chapter['paths'], cfi_element_path(cfi)) - 1
+        offset = self.starts[position] + (chapter['offsets'][i] if i >= 0 else 0)
+        if self.total:
+            percent = offset / self.total * 100
+        else:
+            percent = position / len(self.chapters) * 100
+        # 目录中位于这个位置之前的最后一个条目，没有时使用章节中的第一个标题
+        t = bisect.bisect_right(self._toc_offsets, offset) - 1
+        title = self.toc[t][1] if t >= 0 else chapter['heading']
+        return {'percent': round(percent, 1), 'chapter': position, 'chapter_title': title}
+
+class PositionTables:
+    """
+    位置表缓存：磁盘上按电子书哈希保存在Cache/positions，内存中保留最近用过的几本书；
+    缺少时由后台线程读取电子书生成，同一本书只生成一次。CFI的换算结果另外缓存，
+    书库中几百本书的进度不需要每次都读入位置表
+    """
+    def __init__(self, cache_dir, workers=None):
+        from collections import OrderedDict
+        from concurrent.futures import ThreadPoolExecutor
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._tables = OrderedDict()
+        self._results = OrderedDict()
+        self._pool = ThreadPoolExecutor(max_workers=workers or min(2, os.cpu_count() or 1),
+                                        thread_name_prefix='positions')
+    
+    def _load(self, book_hash):
+        """从内存或磁盘读取位置表，没有时返回None（调用时持有锁）"""
+        table = self._tables.get(book_hash)
+        if table is not None:
+            self._tables.move_to_end(book_hash)
+            return table
+        try:
+            with open(self.cache_dir / f'{book_hash}.json', 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('version') != POSITION_TABLE_VERSION:
+            return None
+        table = PositionTable(data)
+        self._tables[book_hash] = table
+        while len(self._tables) > POSITION_MEMORY_SIZE:
+            self._tables.popitem(last=False)
+        return table
+    
+    def _build(self, book_hash, open_index, book=None):
+        try:
+            index = open_index()
+            if index is None:
+                return None
+            data = PositionTable.build(index)
+            write_file_atomic(self.cache_dir / f'{book_hash}.json',
+                              json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            table = PositionTable(data)
+            with self._lock:
+                self._tables[book_hash] = table
+                while len(self._tables) > POSITION_MEMORY_SIZE:
+                    self._tables.popitem(last=False)
+            return table
+        except Exception as e:
+            print(f"生成位置表失败 {book_hash[:12]}: {e}")
+            return None
+        finally:
+            with self._lock:
+                self._pending.pop(book_hash, None)
+            if book is not None:
+                release_book(book)
+    
+    def get(self, book_hash, open_index, wait=True, timeout=30, book=None):
+        """
+        获取一本书的位置表，没有时提交后台任务（open_index返回这本书的BookIndex，在后台线程中调用）；
+        book为open_index所属的BookState时后台任务持有它到生成结束；wait为False或超时时返回None
+        """
+        from concurrent.futures import TimeoutError as FutureTimeout
+        with self._lock:
+            table = self._load(book_hash)
+            METRICS.record_cache('positions', table is not None)
+            if table is not None:
+                return table
+            future = self._pending.get(book_hash)
+            if future is None:
+                if book is not None:
+                    book.acquire()
+                future = self._pool.submit(self._build, book_hash, open_index, book)
+                self._pending[book_hash] = future
+        if not wait:
+            return None
+        try:
+            return future.result(timeout)
+        except FutureTimeout:
+            return None
+    
+    def locate(self, book_hash, cfi, open_index, wait=True, book=None):
+        """把一本书中的CFI换算为位置（见PositionTable.locate），位置表还没准备好时返回None"""
+        key = (book_hash, cfi)
+        with self._lock:
+            result = self._results.get(key)
+            if result is not None:
+                self._results.move_to_end(key)
+                return result
+        table = self.get(book_hash, open_index, wait, book=book)
+        if table is None:
+            return None
+        result = table.locate(cfi)
+        if result is not None:
+            with self._lock:
+                self._results[key] = result
+                while len(self._results) > POSITION_RESULT_CACHE_SIZE:
+                    self._results.popitem(last=False)
+        return result
+    
+    def close(self):
+        """取消还没开始的任务，等待正在生成的位置表"""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+        self._pool.shutdown(wait=True)
+
+def get_position_tables():
+    """获取位置表缓存（第一次调用时创建）"""
+    global _POSITION_TABLES
+    with _POSITION_TABLES_LOCK:
+        if _POSITION_TABLES is None:
+            _POSITION_TABLES = PositionTables(get_cache_dir() / 'positions')
+    return _POSITION_TABLES
+
+def close_position_tables():
+    """停止位置表的工作线程（退出时调用）"""
+    if _POSITION_TABLES is not None:
+        _POSITION_TABLES.close()
+
+# 图片缩放：拆分模式下按浏览器的视口宽度和像素比缩小、转码书中的图片（需要Pillow，未安装时发送原图），
+# 结果按电子书哈希、条目和规格缓存在Cache/images中
+IMAGE_RESIZE_ENABLED = True
+IMAGE_QUALITY = 80
+IMAGE_CACHE_MB = 256
+IMAGE_WIDTHS = (320, 480, 640, 800, 1080, 1280, 1600, 2048)
+IMAGE_VIEWPORT_COOKIE = 'reader_viewport'
+RESIZABLE_IMAGE_TYPES = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+IMAGE_FORMAT_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'WEBP': 'image/webp'}
+_IMAGE_RESIZER = None
+_IMAGE_RESIZER_LOCK = threading.Lock()
+_PILLOW_AVAILABLE = None
+
+def pillow_available():
+    """是否安装了Pillow（只查找一次，不导入，图片缩放和封面缩略图共用）"""
+    global _PILLOW_AVAILABLE
+    if _PILLOW_AVAILABLE is None:
+        import importlib.util
+        try:
+            _PILLOW_AVAILABLE = importlib.util.find_spec('PIL.Image') is not None
+        except ImportError:
+            _PILLOW_AVAILABLE = False
+    return _PILLOW_AVAILABLE
+
+def image_target_width(css_width, dpr=1.0):
+    """按视口宽度和像素比选择图片宽度（取不小于所需像素数的档位，减少需要缓存的规格）"""
+    pixels = css_width * min(max(dpr, 1.0), 4.0)
+    for width in IMAGE_WIDTHS:
+        if width >= pixels:
+            return width
+    return IMAGE_WIDTHS[-1]
+
+class ImageResizer:
+    """
+    图片缩放和转码：每个规格（电子书哈希、条目、宽度、格式、质量）由工作线程池计算一次，
+    同一规格的并发请求共用一个任务；结果写入大小有限的磁盘缓存，超出上限时删除最久未使用的文件
+    """
+    def __init__(self, cache_dir, max_bytes, quality, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        from PIL import features
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self.webp = features.check('webp')
+        self._pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                        thread_name_prefix='image')
+        self._lock = threading.Lock()
+        self._pending = {}
+        # 不需要处理的规格（原图已经足够小、动图，或处理后反而更大）
+        self._unchanged = set()
+        self._total = sum(p.stat().st_size for p in self.cache_dir.iterdir() if p.suffix != '.tmp')
+    
+    def output_format(self, content_type, accept):
+        """输出格式：浏览器支持WebP时JPEG和PNG转为WebP，否则保持原格式"""
+        fmt = RESIZABLE_IMAGE_TYPES[content_type]
+        if fmt != 'WEBP' and self.webp and 'image/webp' in accept:
+            return 'WEBP'
+        return fmt
+    
+    def etag(self, index, name, width, fmt):
+        """某个规格的ETag（由条目的CRC和大小及规格决定，不用先处理图片就能判断浏览器的缓存是否有效）"""
+        return f'{index.etag(name)[:-1]}-{width}-{fmt.lower()}-q{self.quality}"'
+    
+    def _key(self, index, name, width, fmt):
+        import hashlib
+        book = index.book_hash or index.etag(name)
+        return hashlib.sha256(f'{book}\0{name}\0{width}\0{fmt}\0{self.quality}'.encode('utf-8')).hexdigest()[:32]
+    
+    def submit(self, index, name, width, fmt):
+        """提交一个规格的计算任务，返回(缓存键, Future)，Future的结果为缓存文件路径（不需要处理时为None）"""
+        from concurrent.futures import Future
+        key = self._key(index, name, width, fmt)
+        path = self.cache_dir / f'{key}.{fmt.lower()}'
+        with self._lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return key, future
+            done = key in self._unchanged or path.exists()
+            METRICS.record_cache('image', done)
+            if done:
+                future = Future()
+                future.set_result(None if key in self._unchanged else path)
+                return key, future
+            # 处理期间持有索引所属的书，换书不会关闭正在读取的电子书
+            if index.owner is not None:
+                index.owner.acquire()
+            future = self._pool.submit(self._render, key, index, name, width, fmt, path)
+            self._pending[key] = future
+        return key, future
+    
+    def get(self, index, name, width, fmt, timeout=30):
+        """获取缩放后的图片内容，不需要处理或处理失败时返回None"""
+        key, future = self.submit(index, name, width, fmt)
+        try:
+            path = future.result(timeout)
+        except Exception as e:
+            print(f"处理图片失败 {name}: {e}")
+            return None
+        if path is None:
+            return None
+        try:
+            # 更新修改时间，淘汰时按它判断最近使用
+            os.utime(path)
+            return path.read_bytes()
+        except OSError:
+            return None
+    
+    def prefetch(self, index, names, width, accept):
+        """在后台计算接下来要用到的图片（与预加载的章节对应）"""
+        for name in names:
+            content_type = index.content_type(name)
+            if content_type in RESIZABLE_IMAGE_TYPES:
+                self.submit(index, name, width, self.output_format(content_type, accept))
+    
+    def _render(self, key, index, name, width, fmt, path):
+        import io
+        import tempfile
+        from PIL import Image
+        try:
+            data = index.read(name)
+            with Image.open(io.BytesIO(data)) as source:
+                if getattr(source, 'is_animated', False) or (source.width <= width and source.format == fmt):
+                    self._unchanged.add(key)
+                    return None
+                image = source
+                if image.mode not in ('RGB', 'RGBA', 'L'):
+                    image = image.convert('RGBA' if image.mode in ('P', 'LA', 'PA') or 'transparency' in image.info else 'RGB')
+                if fmt == 'JPEG' and image.mode == 'RGBA':
+                    image = image.convert('RGB')
+                if image.width > width:
+                    image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+                output = io.BytesIO()
+                if fmt == 'PNG':
+                    image.save(output, fmt, optimize=True)
+                else:
+                    image.save(output, fmt, quality=self.quality)
+            body = output.getvalue()
+            if len(body) >= len(data):
+                self._unchanged.add(key)
+                return None
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._total += len(body)
+            self._evict()
+            return path
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            if index.owner is not None:
+                release_book(index.owner)
+    
+    def _evict(self):
+        """超出大小上限时按修改时间（命中时更新）从旧到新删除，删到上限的90%"""
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+            files = []
+            for p in self.cache_dir.iterdir():
+                try:
+                    stat = p.stat()
+                except OSError:
+                    continue
+                if p.suffix != '.tmp':
+                    files.append((stat.st_mtime, stat.st_size, p))
+            for _, size, p in sorted(files):
+                if self._total <= self.max_bytes * 0.9:
                     break
-            time.sleep(0.1)
-    except ImportError:
-        # 非Windows系统使用其他方法
+                try:
+                    p.unlink()
+                except OSError:
+                    continue
+                self._total -= size
+    
+    def close(self):
+        """取消还没开始的任务，等待正在处理的任务结束"""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+        self._pool.shutdown(wait=True)
+
+def get_image_resizer():
+    """获取图片缩放器（第一次调用时创建），关闭了图片缩放或未安装Pillow时返回None"""
+    global _IMAGE_RESIZER, IMAGE_RESIZE_ENABLED
+    if not IMAGE_RESIZE_ENABLED:
+        return None
+    with _IMAGE_RESIZER_LOCK:
+        if _IMAGE_RESIZER is None:
+            if not pillow_available():
+                print("未安装Pillow，书中的图片按原图发送")
+                IMAGE_RESIZE_ENABLED = False
+                return None
+            _IMAGE_RESIZER = ImageResizer(get_cache_dir() / 'images', IMAGE_CACHE_MB * 1024 * 1024, IMAGE_QUALITY)
+    return _IMAGE_RESIZER
+
+def close_image_resizer():
+    """停止图片缩放的工作线程（退出时调用）"""
+    if _IMAGE_RESIZER is not None:
+        _IMAGE_RESIZER.close()
+
+# 书库：--library目录中的所有电子书（/library/目录页），
+# 封面缩略图由后台线程池生成并缓存在Cache/covers，地址带电子书哈希，可以永久缓存
+LIBRARY_DIR = None
+LIBRARY_PREFIX = 'library/'
+LIBRARY_CACHE = 'library.json'
+LIBRARY_RESCAN_INTERVAL = 300
+THUMBNAIL_SIZES = {'s': (120, 180), 'm': (240, 360)}
+_LIBRARY = None
+
+class Library:
+    """
+    书库：扫描目录中的电子书，哈希、书名和封面位置按文件大小和修改时间缓存在Cache/library.json；
+    封面提取和缩略图生成在后台线程池中进行，每本书只处理一次（未安装Pillow时只提取封面原图）
+    """
+    def __init__(self, root, cache_dir, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        self.root = Path(root)
+        self.cache_file = Path(cache_dir) / LIBRARY_CACHE
+        self.cover_dir = Path(cache_dir) / 'covers'
+        self.cover_dir.mkdir(parents=True, exist_ok=True)
+        self.books = {}
+        self.generation = 0
+        self.scanned = threading.Event()
+        self.scanned_at = 0
+        self._scan_lock = threading.Lock()
+        self.thumbnails = pillow_available()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pool = ThreadPoolExecutor(max_workers=workers or min(4, os.cpu_count() or 1),
+                                        thread_name_prefix='cover')
+    
+    def scan(self):
+        """
+        扫描书库目录（文件没有变化时使用缓存），封面提交到后台处理；
+        有书增加、删除或移动时generation加一（OPDS等按它判断是否需要重新生成）
+        """
+        if not self._scan_lock.acquire(blocking=False):
+            return
+        try:
+            try:
+                with open(self.cache_file, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+            entries = {}
+            for path in sorted(self.root.rglob('*.epub')):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                key = str(path.resolve())
+                stamp = [stat.st_size, stat.st_mtime_ns]
+                entry = cache.get(key)
+                if not entry or entry.get('stamp') != stamp:
+                    try:
+                        entry = self._read_book(path, stamp)
+                    except Exception as e:
+                        print(f"读取电子书失败 {path}: {e}")
+                        continue
+                entries[key] = entry
+                with self._lock:
+                    old = self.books.get(entry['hash'])
+                    if old is None or old['path'] != path:
+                        self.books[entry['hash']] = dict(entry, path=path)
+                        self.generation += 1
+                if entry['cover']:
+                    self.submit_cover(entry['hash'])
+            # 删除已经不在目录中的书
+            hashes = {entry['hash'] for entry in entries.values()}
+            with self._lock:
+                for book_hash in list(self.books):
+                    if book_hash not in hashes:
+                        del self.books[book_hash]
+                        self.generation += 1
+            if entries != cache:
+                try:
+                    write_file_atomic(self.cache_file, json.dumps(entries, ensure_ascii=False, indent=2).encode('utf-8'))
+                except OSError as e:
+                    print(f"保存书库缓存失败: {e}")
+            if not self.scanned.is_set():
+                print(f"书库: {len(self.books)}本电子书")
+            self.scanned_at = time.time()
+            self.scanned.set()
+        finally:
+            self._scan_lock.release()
+    
+    def refresh(self, max_age=LIBRARY_RESCAN_INTERVAL):
+        """上次扫描已经超过max_age秒时在后台重新扫描（不等待扫描结束）"""
+        if self.scanned.is_set() and time.time() - self.scanned_at > max_age and not self._scan_lock.locked():
+            threading.Thread(target=self.scan, name='library', daemon=True).start()
+    
+    def _read_book(self, path, stamp):
+        import zipfile
+        with open(path, 'rb') as f:
+            book_hash = hash_file(f)
+        with zipfile.ZipFile(path) as z:
+            try:
+                cover = find_cover(z)
+            except Exception as e:
+                print(f"查找封面失败 {path}: {e}")
+                cover = None
+        return {
+            'stamp': stamp,
+            'hash': book_hash,
+            'title': get_book_title_from_file(path, path.parent),
+            'cover': cover[0] if cover else None,
+            'cover_type': cover[1] if cover else None,
+        }
+    
+    @staticmethod
+    def history_filename(book):
+        """书库中一本书的历史记录文件名（与打开这本书时使用的书名一致）"""
+        return f"{clean_filename(book['title'] or book['path'].stem)}.json"
+    
+    def progress(self, reader, device, hashes=None):
+        """
+        读者在书库中各本书上的进度{哈希: {'cfi', 'percent', 'chapter', 'chapter_title'}}（没有进度的书不列出）；
+        位置表还没生成的书只有cfi和'pending': True，生成任务在后台进行
+        """
+        with self._lock:
+            books = [(book_hash, book) for book_hash, book in self.books.items() if hashes is None or book_hash in hashes]
+        tables = get_position_tables()
+        result = {}
+        for book_hash, book in books:
+            cfi = PROGRESS.get(self.history_filename(book), reader, device)
+            if not cfi:
+                continue
+            position = tables.locate(book_hash, cfi, lambda path=book['path']: BookIndex(path), wait=False)
+            result[book_hash] = dict(position, cfi=cfi) if position else {'cfi': cfi, 'pending': True}
+        return result
+    
+    def _cover_files(self, book_hash):
+        """封面原图和各尺寸缩略图的缓存文件"""
+        original = self.cover_dir / f'{book_hash}.cover'
+        thumbs = {size: self.cover_dir / f'{book_hash}-{size}.jpg' for size in THUMBNAIL_SIZES}
+        return original, thumbs
+    
+    def submit_cover(self, book_hash):
+        """提交一本书的封面处理任务（已经处理过或正在处理时不重复提交），返回Future"""
+        from concurrent.futures import Future
+        original, thumbs = self._cover_files(book_hash)
+        with self._lock:
+            future = self._pending.get(book_hash)
+            if future is not None:
+                return future
+            if original.exists() and (not self.thumbnails or all(p.exists() for p in thumbs.values())):
+                future = Future()
+                future.set_result(None)
+                return future
+            future = self._pool.submit(self._make_cover, book_hash, original, thumbs)
+            self._pending[book_hash] = future
+        return future
+    
+    def _make_cover(self, book_hash, original, thumbs):
+        import io
+        import zipfile
+        try:
+            book = self.books[book_hash]
+            if original.exists():
+                data = original.read_bytes()
+            else:
+                with zipfile.ZipFile(book['path']) as z:
+                    data = z.read(book['cover'])
+                write_file_atomic(original, data)
+            if not self.thumbnails:
+                return
+            from PIL import Image, ImageOps
+            with Image.open(io.BytesIO(data)) as image:
+                image = image.convert('RGB')
+                for size, box in THUMBNAIL_SIZES.items():
+                    output = io.BytesIO()
+                    ImageOps.fit(image, box, Image.LANCZOS).save(output, 'JPEG', quality=IMAGE_QUALITY)
+                    write_file_atomic(thumbs[size], output.getvalue())
+        except Exception as e:
+            print(f"生成封面缩略图失败 {book_hash[:12]}: {e}")
+        finally:
+            with self._lock:
+                self._pending.pop(book_hash, None)
+    
+    def cover(self, book_hash, size, timeout=10):
+        """获取封面缩略图，返回(文件路径, 类型)（未安装Pillow时为封面原图），没有封面时返回None"""
+        book = self.books.get(book_hash)
+        if book is None or not book['cover'] or size not in THUMBNAIL_SIZES:
+            return None
+        original, thumbs = self._cover_files(book_hash)
+        if not thumbs[size].exists():
+            try:
+                self.submit_cover(book_hash).result(timeout)
+            except Exception:
+                pass
+        if thumbs[size].exists():
+            return thumbs[size], 'image/jpeg'
+        if original.exists():
+            return original, book['cover_type']
+        return None
+    
+    def render(self, current_hash=None, progress=None):
+        """
+        生成目录页（按书名排序，封面延迟加载，当前正在阅读的书链接到阅读器，其他书可以下载；
+        progress为Library.progress的结果，有进度的书在书名下显示进度条）
+        """
+        progress = progress or {}
+        with self._lock:
+            books = sorted(self.books.items(), key=lambda item: (item[1]['title'] or '').lower())
+        items = []
+        for book_hash, book in books:
+            title = html.escape(book['title'] or book['path'].stem)
+            percent = progress.get(book_hash, {}).get('percent')
+            if percent is not None:
+                chapter = html.escape(progress[book_hash].get('chapter_title') or '')
+                title += (f'<span class="progress" title="{chapter} {percent:g}%">'
+                          f'<span style="width:{percent:g}%"></span></span>')
+            width, height = THUMBNAIL_SIZES['s']
+            if book['cover']:
+                small = f'/{LIBRARY_PREFIX}cover/{book_hash}-s'
+                large = f'/{LIBRARY_PREFIX}cover/{book_hash}-m'
+                cover = (f'<img src="{small}" srcset="{small} 1x, {large} 2x" '
+                         f'width="{width}" height="{height}" loading="lazy" decoding="async" alt="">')
+            else:
+                cover = '<span class="cover"></span>'
+            if book_hash == current_hash:
+                items.append(f'<li class="current"><a href="/">{cover}<span class="title">{title}</span></a></li>')
+            else:
+                items.append(f'<li><a href="/{LIBRARY_PREFIX}book/{book_hash}.epub" download>{cover}<span class="title">{title}</span></a></li>')
+        status = '' if self.scanned.is_set() else '<p>正在扫描书库……</p>'
+        return f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>书库</title>
+<style>
+body {{ font-family: sans-serif; margin: 1em; }}
+ul {{ list-style: none; padding: 0; display: grid; grid-template-columns: repeat(auto-fill, {width}px); gap: 1em; }}
+a {{ color: inherit; text-decoration: none; }}
+img, .cover {{ display: block; width: {width}px; height: {height}px; object-fit: cover; background: #ddd; margin-bottom: 0.3em; }}
+.title {{ display: block; font-size: 0.85em; overflow-wrap: anywhere; }}
+.current img, .current .cover {{ outline: 3px solid #4a90d9; }}
+.progress {{ display: block; height: 4px; margin-top: 0.3em; background: #ddd; }}
+.progress span {{ display: block; height: 100%; background: #4a90d9; }}
+</style>
+</head>
+<body>
+<h1>书库（{len(books)}）</h1>
+{status}<ul>
+{chr(10).join(items)}
+</ul>
+</body>
+</html>
+"""
+
+    def close(self):
+        """取消还没开始的封面任务，等待正在处理的任务结束"""
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+        self._pool.shutdown(wait=True)
+
+def close_library():
+    """停止书库的封面处理线程（退出时调用）"""
+    if _LIBRARY is not None:
+        _LIBRARY.close()
+
+# OPDS目录（/opds/）：电子书阅读App按OPDS 1.2浏览、搜索和下载书库中的书
+OPDS_PREFIX = 'opds/'
+OPDS_PAGE_SIZE = 50
+OPDS_NAVIGATION = 'application/atom+xml;profile=opds-catalog;kind=navigation'
+OPDS_ACQUISITION = 'application/atom+xml;profile=opds-catalog;kind=acquisition'
+OPDS_FEED_CACHE_SIZE = 256
+_OPDS_CATALOG = None
+
+def _atom_time(timestamp):
+    import datetime
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+class OPDSCatalog:
+    """
+    书库的OPDS 1.2目录：根目录为导航feed，全部书籍（按书名）、最近阅读和搜索为获取feed，都支持分页。
+    每本书的条目XML缓存到书变化为止，排序结果和生成好的页面按书库的generation缓存，
+    书库变化时只重新生成新增的书的条目；页面带ETag，没有变化时返回304
+    """
+    def __init__(self, library, page_size=OPDS_PAGE_SIZE):
+        self.library = library
+        self.page_size = page_size
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_title = (None, [])
+        self._feeds = {}
+    
+    def _entry(self, book_hash, book):
+        """一本书的条目（获取链接、封面和缩略图）"""
+        entry = self._entries.get(book_hash)
+        if entry is None:
+            title = html.escape(book['title'] or book['path'].stem)
+            links = [f'<link rel="http://opds-spec.org/acquisition" href="/{LIBRARY_PREFIX}book/{book_hash}.epub" type="application/epub+zip"/>']
+            if book['cover']:
+                cover_type = 'image/jpeg' if self.library.thumbnails else book['cover_type']
+                links.append(f'<link rel="http://opds-spec.org/image" href="/{LIBRARY_PREFIX}cover/{book_hash}-m" type="{cover_type}"/>')
+                links.append(f'<link rel="http://opds-spec.org/image/thumbnail" href="/{LIBRARY_PREFIX}cover/{book_hash}-s" type="{cover_type}"/>')
+            entry = (f'<entry><title>{title}</title><id>urn:sha256:{book_hash}</id>'
+                     f'<updated>{_atom_time(book["stamp"][1] / 1e9)}</updated>{"".join(links)}</entry>')
+            self._entries[book_hash] = entry
+        return entry
+    
+    def _sorted_by_title(self):
+        generation = self.library.generation
+        if self._by_title[0] != generation:
+            with self.library._lock:
+                books = list(self.library.books.items())
+            books.sort(key=lambda item: ((item[1]['title'] or '').casefold(), item[0]))
+            self._by_title = (generation, [book_hash for book_hash, _ in books])
+        return self._by_title[1]
+    
+    def _recently_read(self):
+        """有历史记录的书，按历史记录文件的修改时间从新到旧排列"""
+        by_file = {Library.history_filename(book): book_hash for book_hash, book in list(self.library.books.items())}
+        recent = []
+        try:
+            with os.scandir(get_history_dir()) as it:
+                for item in it:
+                    if item.name in by_file:
+                        recent.append((item.stat().st_mtime_ns, by_file[item.name]))
+        except OSError:
+            pass
+        recent.sort(reverse=True)
+        return [book_hash for _, book_hash in recent], (len(recent), max([mtime for mtime, _ in recent], default=0))
+    
+    def feed(self, kind, page=0, query=''):
+        """
+        生成一页feed（kind为root、all、recent或search），返回(ETag, 内容)，页码超出范围时返回None。
+        同一版本的页面只生成一次
+        """
+        import hashlib
+        if kind == 'root':
+            hashes, version = [], 0
+        elif kind == 'recent':
+            hashes, version = self._recently_read()
+        else:
+            hashes, version = self._sorted_by_title(), 0
+            if kind == 'search':
+                needle = query.casefold()
+                books = self.library.books
+                hashes = [h for h in hashes if h in books and needle in (books[h]['title'] or '').casefold()]
+        pages = max((len(hashes) + self.page_size - 1) // self.page_size, 1)
+        if not 0 <= page < pages:
+            return None
+        key = (kind, query, page, self.library.generation, version)
+        with self._lock:
+            cached = self._feeds.get(key)
+        if cached is not None:
+            return cached
+        
+        if kind == 'root':
+            body = self._render_root()
+        else:
+            body = self._render_acquisition(kind, query, page, pages, hashes)
+        body = body.encode('utf-8')
+        result = (f'"{hashlib.sha256(body).hexdigest()[:16]}"', body)
+        with self._lock:
+            if len(self._feeds) >= OPDS_FEED_CACHE_SIZE:
+                self._feeds.clear()
+            self._feeds[key] = result
+        return result
+    
+    def _feed_head(self, feed_id, title, self_href, kind_type, updated):
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opds="http://opds-spec.org/2010/catalog" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/">
+<id>urn:epub-reader:{feed_id}</id>
+<title>{html.escape(title)}</title>
+<updated>{updated}</updated>
+<link rel="self" href="{html.escape(self_href)}" type="{kind_type}"/>
+<link rel="start" href="/{OPDS_PREFIX}" type="{OPDS_NAVIGATION}"/>
+<link rel="search" href="/{OPDS_PREFIX}search.xml" type="application/opensearchdescription+xml"/>
+"""
+    
+    def _render_root(self):
+        updated = _atom_time(self.library.scanned_at or time.time())
+        sections = [
+            ('all', '全部书籍', f'共{len(self.library.books)}本，按书名排序'),
+            ('recent', '最近阅读', '按最近阅读的时间排序'),
+        ]
+        entries = [f'<entry><title>{title}</title><id>urn:epub-reader:{kind}</id><updated>{updated}</updated>'
+                   f'<content type="text">{content}</content>'
+                   f'<link rel="subsection" href="/{OPDS_PREFIX}{kind}" type="{OPDS_ACQUISITION}"/></entry>'
+                   for kind, title, content in sections]
+        return self._feed_head('root', '书库', f'/{OPDS_PREFIX}', OPDS_NAVIGATION, updated) + '\n'.join(entries) + '\n</feed>\n'
+    
+    def _render_acquisition(self, kind, query, page, pages, hashes):
+        books = self.library.books
+        selected = [h for h in hashes[page * self.page_size:(page + 1) * self.page_size] if h in books]
+        entries = [self._entry(h, books[h]) for h in selected]
+        updated = _atom_time(max([books[h]['stamp'][1] / 1e9 for h in selected], default=self.library.scanned_at or time.time()))
+        title = {'all': '全部书籍', 'recent': '最近阅读', 'search': f'搜索：{query}'}[kind]
+        base = f'/{OPDS_PREFIX}{kind}?' + (f'q={quote(query)}&' if kind == 'search' else '')
+        
+        head = self._feed_head(kind, title, f'{base}page={page}', OPDS_ACQUISITION, updated)
+        links = [f'<link rel="first" href="{html.escape(base)}page=0" type="{OPDS_ACQUISITION}"/>',
+                 f'<link rel="last" href="{html.escape(base)}page={pages - 1}" type="{OPDS_ACQUISITION}"/>']
+        if page > 0:
+            links.append(f'<link rel="previous" href="{html.escape(base)}page={page - 1}" type="{OPDS_ACQUISITION}"/>')
+        if page + 1 < pages:
+            links.append(f'<link rel="next" href="{html.escape(base)}page={page + 1}" type="{OPDS_ACQUISITION}"/>')
+        links += [f'<opensearch:totalResults>{len(hashes)}</opensearch:totalResults>',
+                  f'<opensearch:itemsPerPage>{self.page_size}</opensearch:itemsPerPage>',
+                  f'<opensearch:startIndex>{page * self.page_size + 1}</opensearch:startIndex>']
+        return head + '\n'.join(links + entries) + '\n</feed>\n'
+
+class CORSRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def setup(self):
+        # 等待请求行的时间不超过空闲超时，之后读请求头、请求体和发送响应分别使用读写超时；
+        # 读写都经过_DeadlineSocket，请求行和请求头、请求体、整个响应各有总时限
+        self.timeout = IDLE_TIMEOUT
+        super().setup()
+        self._socket_io = _DeadlineSocket(self.connection)
+        self.rfile = io.BufferedReader(self._socket_io)
+        # 统计发送字节数
+        self.wfile = _CountingWriter(self._socket_io)
+    
+    def handle(self):
+        METRICS.connection_opened()
+        try:
+            super().handle()
+        finally:
+            METRICS.connection_closed()
+    
+    def handle_one_request(self):
+        """处理单个请求并记录指标"""
+        self._route = 'other'
+        self._status = 0
+        self.command = None
+        self._book = None
+        # 请求行和请求头需要在空闲超时加读超时内收完
+        self.connection.settimeout(IDLE_TIMEOUT)
+        self._socket_io.deadline = time.monotonic() + IDLE_TIMEOUT + READ_TIMEOUT
+        self._trace = RequestTrace() if TRACE_ENABLED else None
+        start = time.perf_counter()
+        bytes_before = self.wfile.bytes_written
+        try:
+            PROFILER.profile_call(super().handle_one_request)
+        finally:
+            if self._book is not None:
+                release_book(self._book)
+                self._book = None
+        if self.command:
+            duration = time.perf_counter() - start
+            bytes_sent = self.wfile.bytes_written - bytes_before
+            METRICS.observe_request(self._route, self.command, self._status, duration, bytes_sent)
+            if TRACE_RECORDER is not None:
+                TRACE_RECORDER.record(self, start, duration, bytes_sent)
+            if self._trace is not None and TRACE_LOGGER is not None:
+                TRACE_LOGGER.info(json.dumps(self._trace.to_record(self), ensure_ascii=False))
+    
+    def request_book(self):
+        """本次请求使用的书：第一次调用时取得当前的书，持有到请求结束（中途换书不影响这个请求）"""
+        if self._book is None:
+            self._book = acquire_book()
+        return self._book
+    
+    def trace_phase(self, name):
+        """记录一个处理阶段的耗时（未开启追踪时无开销）"""
+        if self._trace is None:
+            return _NULL_PHASE
+        return self._trace.phase(name)
+    
+    def translate_path(self, path):
+        with self.trace_phase('translate_path'):
+            return super().translate_path(path)
+    
+    def copyfile(self, source, outputfile):
+        with self.trace_phase('write'):
+            super().copyfile(source, outputfile)
+    
+    def parse_request(self):
+        self.connection.settimeout(READ_TIMEOUT)
+        return super().parse_request()
+    
+    def send_response(self, code, message=None):
+        self._status = code
+        # 发送响应时客户端每次无响应不超过写超时，整个响应不超过响应时限
+        self.connection.settimeout(WRITE_TIMEOUT)
+        self._socket_io.deadline = time.monotonic() + RESPONSE_TIMEOUT
+        super().send_response(code, message)
+    
+    def read_body(self, limit=None):
+        """
+        读取请求体：必须带Content-Length且不超过limit字节，整个请求体需在读超时内收完；
+        不符合时回复411/400/413/408并关闭连接，返回None
+        """
+        limit = MAX_BODY_BYTES if limit is None else limit
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self.close_connection = True
+            self.send_error(411, "Content-Length required")
+            return None
+        try:
+            length = int(length)
+            if length < 0:
+                raise ValueError(length)
+        except ValueError:
+            self.close_connection = True
+            self.send_error(400, "Invalid Content-Length")
+            return None
+        if length > limit:
+            # 不读取剩余的请求体，直接关闭连接
+            self.close_connection = True
+            self.send_error(413, f"Request body exceeds {limit} bytes")
+            return None
+        
+        self.connection.settimeout(READ_TIMEOUT)
+        self._socket_io.deadline = time.monotonic() + READ_TIMEOUT
+        chunks = []
+        remaining = length
+        try:
+            while remaining > 0:
+                chunk = self.rfile.read1(min(remaining, 65536))
+                if not chunk:
+                    raise ConnectionError('客户端在请求体发送完之前断开')
+                chunks.append(chunk)
+                remaining -= len(chunk)
+        except TimeoutError as e:
+            self.close_connection = True
+            if not isinstance(e, DeadlineExceeded):
+                METRICS.record_dropped('timeout')
+            self.send_error(408, "Request body timeout")
+            return None
+        return b''.join(chunks)
+    
+    def do_GET(self):
+        """处理GET请求，自动注入历史记录恢复代码"""
+        if self.path == '/metrics':
+            self._route = 'metrics'
+            return self.serve_metrics()
+        
+        if self.path.startswith('/admin/'):
+            self._route = 'admin'
+            return self.handle_admin()
+        
+        if self.path == '/' or self.path.startswith('/?'):
+            # 重定向到index.html（保留查询参数，如?reader=）
+            self.path = '/index.html' + self.path[1:]
+        
+        if self.path == '/api/progress' or self.path.startswith('/api/progress?'):
+            # 阅读进度（百分比和目录标题）
+            self._route = 'progress'
+            if not self.wait_book_ready():
+                return
+            return self.serve_progress()
+        
+        if self.path.startswith('/' + OPDS_PREFIX):
+            # OPDS目录
+            self._route = 'opds'
+            return self.serve_opds()
+        
+        if self.path.startswith('/' + LIBRARY_PREFIX):
+            # 书库目录页、封面缩略图和电子书下载
+            self._route = 'library'
+            return self.serve_library()
+        
+        if self.path.startswith('/' + LITE_PREFIX):
+            # 精简视图（服务器渲染的章节页面）
+            self._route = 'lite'
+            if not self.wait_book_ready():
+                return
+            return self.serve_lite()
+        
+        if self.path.startswith('/' + BOOK_ENTRY_PREFIX):
+            # 拆分模式下的单个章节或资源
+            self._route = 'book_entry'
+            if not self.wait_book_ready():
+                return
+            return self.serve_book_entry()
+        
+        if self.path.split('?')[0] == '/' + PAYLOAD_BOOK_URL and get_payload() is not None:
+            # 附加在程序中的电子书
+            self._route = 'static'
+            if not self.wait_book_ready():
+                return
+            return self.serve_payload_file(PAYLOAD_BOOK_NAME, 'application/epub+zip')
+        
+        if self.path.split('?')[0] in ('/' + SERVICE_WORKER_NAME, '/precache-manifest.json'):
+            # 离线缓存的Service Worker和预缓存清单（清单包含当前电子书）
+            self._route = 'static'
+            if not self.wait_book_ready():
+                return
+            return self.serve_service_worker()
+        
+        if self.path.startswith(('/js/bundle.', '/' + SYNC_SCRIPT_PREFIX + '.')):
+            # 合并脚本、集成脚本及其source map
+            self._route = 'static'
+            return self.serve_bundle()
+        
+        if urlparse(self.path).path.endswith('.html'):
+            # 对于HTML文件，注入历史记录恢复代码
+            self._route = 'html'
+            if not self.wait_book_ready():
+                return
+            return self.serve_html_with_history()
+        else:
+            # 其他文件正常处理
+            self._route = 'static'
+            if ASSET_ARCHIVE is not None:
+                name = self.archive_asset_name(self.path)
+                if name is not None:
+                    return self.serve_payload_file(name, self.guess_type(name))
+            return super().do_GET()
+    
+    def wait_book_ready(self):
+        """等待后台准备好书籍信息，超时返回503"""
+        if BOOK_READY.is_set():
+            return True
+        with self.trace_phase('book_ready'):
+            if BOOK_READY.wait(BOOK_READY_TIMEOUT):
+                return True
+        self.send_error(503, "Book not ready")
+        return False
+    
+    def archive_asset_name(self, path):
+        """把请求路径转换为附加数据中的阅读器资源名，不存在时返回None"""
+        path = unquote(urlparse(path).path)
+        parts = [part for part in path.split('/') if part and part not in ('.', '..')]
+        name = PAYLOAD_READER_PREFIX + '/'.join(parts)
+        return name if ASSET_ARCHIVE.has(name) else None
+    
+    def read_reader_text(self, path):
+        """读取阅读器中的文本文件（附加数据或目录），不存在时返回None"""
+        if ASSET_ARCHIVE is not None:
+            name = self.archive_asset_name(path)
+            if name is not None:
+                return ASSET_ARCHIVE.read(name).decode('utf-8')
+        file_path = self.translate_path(path)
+        if not os.path.isfile(file_path):
+            return None
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    
+    def serve_bundle(self):
+        """发送合并脚本、集成脚本或source map（文件名带内容哈希，可以永久缓存）"""
+        path = urlparse(self.path).path.lstrip('/')
+        bundle = get_sync_script() if path.startswith(SYNC_SCRIPT_PREFIX + '.') else get_asset_bundle()
+        if bundle is None or path not in (bundle.name, bundle.map_name):
+            self.send_error(404, "File not found")
+            return
+        if self.headers.get('If-None-Match') == bundle.etag:
+            self.send_response(304)
+            self.send_header('ETag', bundle.etag)
+            self.end_headers()
+            return
+        if path == bundle.map_name:
+            body, content_type, encoding = bundle.map_body, 'application/json', None
+        elif 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body, content_type, encoding = bundle.gzipped, 'application/javascript', 'gzip'
+        else:
+            body, content_type, encoding = bundle.body, 'application/javascript', None
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Cache-Control', 'public, max-age=31536000, immutable')
+        self.send_header('ETag', bundle.etag)
+        self.end_headers()
+        with self.trace_phase('write'):
+            self.wfile.write(body)
+    
+    def serve_service_worker(self):
+        """发送注入了预缓存清单的Service Worker脚本，或单独的清单"""
+        manifest = get_precache_manifest()
+        if self.path.split('?')[0] == '/precache-manifest.json':
+            return self.send_json(manifest)
+        source = read_reader_asset(SERVICE_WORKER_NAME)
+        if source is None:
+            self.send_error(404, "File not found")
+            return
+        body = f"const PRECACHE_MANIFEST = {json.dumps(manifest)};\n".encode('utf-8') + source
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/javascript')
+        self.send_header('Content-Length', str(len(body)))
+        # 浏览器每次都要检查Service Worker是否更新
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Service-Worker-Allowed', '/')
+        self.end_headers()
+        with self.trace_phase('write'):
+            self.wfile.write(body)
+    
+    def serve_book_entry(self):
+        """发送电子书中的单个条目，章节响应中预加载后面的章节"""
+        index = self.request_book().index()
+        name = unquote(urlparse(self.path).path)[len(BOOK_ENTRY_PREFIX) + 1:]
+        if index is None or name not in index.names:
+            self.send_error(404, "File not found")
+            return
+        links = []
+        preload = []
+        if name in index.positions:
+            position = index.positions[name]
+            preload = index.preload_entries(position + 1, PRELOAD_COUNT)
+            links = [preload_link(entry, index.content_type(entry)) for entry in preload]
+        etag = index.etag(name)
+        content_type = index.content_type(name)
+        body = None
+        
+        # 图片按客户端视口缩放，章节中预加载的图片提前在后台处理
+        resizer = get_image_resizer()
+        width = self.image_width() if resizer is not None else None
+        accept = self.headers.get('Accept', '')
+        fmt = None
+        if width is not None and content_type in RESIZABLE_IMAGE_TYPES:
+            # 不需要缩放时发送原图，同一规格的响应不变，ETag都按规格计算
+            fmt = resizer.output_format(content_type, accept)
+            etag = resizer.etag(index, name, width, fmt)
+        elif width is not None and preload:
+            resizer.prefetch(index, preload, width, accept)
+        
+        # 浏览器的缓存仍然有效时直接返回304，不用缩放图片
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        if fmt is not None:
+            with self.trace_phase('resize'):
+                body = resizer.get(index, name, width, fmt)
+            if body is not None:
+                content_type = IMAGE_FORMAT_TYPES[fmt]
+        if body is None:
+            with self.trace_phase('read_file'):
+                body = index.read(name)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if resizer is not None and content_type.startswith('image/'):
+            self.send_header('Vary', 'Accept, Cookie, Sec-CH-Viewport-Width, Sec-CH-DPR')
+        for link in links:
+            self.send_header('Link', link)
+        self.end_headers()
+        with self.trace_phase('write'):
+            self.wfile.write(body)
+    
+    def serve_library(self):
+        """发送书库目录页、封面缩略图（地址带电子书哈希，可以永久缓存）或书库中的电子书"""
+        path = unquote(urlparse(self.path).path)[len(LIBRARY_PREFIX) + 1:]
+        if _LIBRARY is None:
+            self.send_error(404, "Library not enabled")
+            return
+        
+        if path == '':
+            import hashlib
+            _LIBRARY.refresh()
+            reader, device, _ = self.reader_identity()
+            progress = _LIBRARY.progress(reader, device)
+            body = _LIBRARY.render(BOOK.hash, progress).encode('utf-8')
+            etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('ETag', etag)
+            self.end_headers()
+            with self.trace_phase('write'):
+                self.wfile.write(body)
+            return
+        
+        if path.startswith('cover/'):
+            book_hash, _, size = path[len('cover/'):].rpartition('-')
+            with self.trace_phase('cover'):
+                cover = _LIBRARY.cover(book_hash, size)
+            if cover is None:
+                self.send_error(404, "File not found")
+                return
+            file_path, content_type = cover
+            cache_control = 'public, max-age=31536000, immutable'
+        elif path.startswith('book/') and path.endswith('.epub'):
+            book = _LIBRARY.books.get(path[len('book/'):-len('.epub')])
+            if book is None:
+                self.send_error(404, "File not found")
+                return
+            file_path, content_type = book['path'], 'application/epub+zip'
+            cache_control = 'no-cache'
+        else:
+            self.send_error(404, "File not found")
+            return
+        
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404, "File not found")
+            return
+        with f:
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(os.fstat(f.fileno()).st_size))
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            self.copyfile(f, self.wfile)
+    
+    def serve_opds(self):
+        """
+        发送OPDS feed：/opds/为导航目录，/opds/all、/opds/recent、/opds/search?q=为获取目录（?page=分页），
+        /opds/search.xml为OpenSearch描述
+        """
+        parsed = urlparse(self.path)
+        kind = unquote(parsed.path)[len(OPDS_PREFIX) + 1:].strip('/') or 'root'
+        if _OPDS_CATALOG is None:
+            self.send_error(404, "Library not enabled")
+            return
+        _LIBRARY.refresh()
+        
+        if kind == 'search.xml':
+            template = html.escape(f"http://{self.headers.get('Host', '')}/{OPDS_PREFIX}search?q={{searchTerms}}")
+            body = f"""<?xml version="1.0" encoding="UTF-8"?>
+<OpenSearchDescription xmlns="http://a9.com/-/spec/opensearch/1.1/">
+<ShortName>书库</ShortName>
+<Description>按书名搜索</Description>
+<InputEncoding>UTF-8</InputEncoding>
+<Url type="{OPDS_ACQUISITION}" template="{template}"/>
+</OpenSearchDescription>
+""".encode('utf-8')
+            content_type, etag = 'application/opensearchdescription+xml', None
+        elif kind in ('root', 'all', 'recent', 'search'):
+            query = parse_qs(parsed.query)
+            try:
+                page = int(query.get('page', ['0'])[0])
+            except ValueError:
+                page = -1
+            with self.trace_phase('render'):
+                feed = _OPDS_CATALOG.feed(kind, page, query.get('q', [''])[0].strip())
+            if feed is None:
+                self.send_error(404, "File not found")
+                return
+            etag, body = feed
+            content_type = (OPDS_NAVIGATION if kind == 'root' else OPDS_ACQUISITION) + ';charset=utf-8'
+        else:
+            self.send_error(404, "File not found")
+            return
+        
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        with self.trace_phase('write'):
+            self.wfile.write(body)
+    
+    def serve_progress(self):
+        """
+        阅读进度：/api/progress为当前的书，/api/progress?library=all（或逗号分隔的电子书哈希）为书库中的书，
+        一次请求返回所有书的进度；保存的CFI按位置表换算为百分比和所在的目录标题
+        """
+        reader, device, set_cookies = self.reader_identity()
+        library = parse_qs(urlparse(self.path).query).get('library', [None])[0]
+        if library:
+            if _LIBRARY is None:
+                self.send_error(404, "Library not enabled")
+                return
+            with self.trace_phase('locate'):
+                books = _LIBRARY.progress(reader, device, None if library == 'all' else set(library.split(',')))
+            return self.send_json({'reader': reader, 'books': books}, set_cookies=set_cookies)
+        
+        book = self.request_book()
+        with self.trace_phase('get_last_position'):
+            cfi = get_last_position(book.path, reader, device, book)
+        result = {'reader': reader, 'title': book.title, 'hash': book.hash, 'cfi': cfi}
+        if cfi:
+            with self.trace_phase('locate'):
+                position = get_position_tables().locate(book.hash or book.key, cfi, book.index, book=book)
+            result.update(position or {'pending': True})
+        self.send_json(result, set_cookies=set_cookies)
+    
+    def serve_lite(self):
+        """
+        精简视图：/lite/跳转到上次阅读的位置，/lite/contents为目录，/lite/{章节}?id={锚点}跳转到锚点所在页，
+        /lite/{章节}/{页}为净化后的章节页面（页为负数时从最后一页倒数），打开页面时保存阅读进度
+        """
+        book = self.request_book()
+        index = book.index()
+        if index is None or not index.spine:
+            self.send_error(404, "File not found")
+            return
+        parsed = urlparse(self.path)
+        parts = [part for part in unquote(parsed.path)[len(LITE_PREFIX) + 1:].split('/') if part]
+        
+        reader, device, set_cookies = self.reader_identity()
+        if not parts:
+            cfi = get_last_position(book.path, reader, device, book)
+            position = min(max(BookIndex.cfi_spine_index(cfi) or 0, 0), len(index.spine) - 1)
+            with self.trace_phase('render'):
+                page = get_lite_chapter(index, position).page_of(cfi_element_path(cfi)) if cfi else 0
+            return self.send_redirect(f'/{LITE_PREFIX}{position}/{page}', set_cookies)
+        
+        if parts == ['contents']:
+            items = []
+            for position, name in enumerate(index.spine):
+                with self.trace_phase('render'):
+                    title = get_lite_chapter(index, position).title or posixpath.basename(name)
+                items.append(f'<li><a href="/{LITE_PREFIX}{position}/0">{html.escape(title)}</a></li>')
+            nav = f'<nav><a href="/{LITE_PREFIX}">继续阅读</a><a href="/">完整阅读器</a></nav>'
+            body = render_lite_page(f'{book.title} - 目录', f'<h1>{html.escape(book.title or "")}</h1><ol>{"".join(items)}</ol>', nav)
+            return self.send_lite_body(body.encode('utf-8'), None)
+        
+        try:
+            position = int(parts[0])
+            page = int(parts[1]) if len(parts) > 1 else None
+        except ValueError:
+            position = page = -1
+        if not 0 <= position < len(index.spine):
+            self.send_error(404, "File not found")
+            return
+        with self.trace_phase('render'):
+            chapter = get_lite_chapter(index, position)
+        if page is None:
+            anchor = parse_qs(parsed.query).get('id', [''])[0]
+            page = chapter.anchors.get(anchor, 0)
+            return self.send_redirect(f'/{LITE_PREFIX}{position}/{page}' + (f'#{quote(anchor)}' if anchor else ''))
+        if page < 0:
+            page += len(chapter.pages)
+        if not 0 <= page < len(chapter.pages):
+            self.send_error(404, "File not found")
+            return
+        
+        # 保存阅读进度（浏览器预取的请求不算）
+        purpose = self.headers.get('Sec-Purpose') or self.headers.get('Purpose') or ''
+        if 'prefetch' not in purpose:
+            with self.trace_phase('history_io'):
+                update_history(book.path, lite_cfi(index, position, chapter.starts[page]), reader, device, book)
+        
+        links = []
+        if page > 0:
+            links.append(f'<a href="/{LITE_PREFIX}{position}/{page - 1}" rel="prev">上一页</a>')
+        elif position > 0:
+            links.append(f'<a href="/{LITE_PREFIX}{position - 1}/-1" rel="prev">上一章</a>')
+        links.append(f'<a href="/{LITE_PREFIX}contents">目录 {position + 1}/{len(index.spine)} · {page + 1}/{len(chapter.pages)}</a>')
+        if page + 1 < len(chapter.pages):
+            links.append(f'<a href="/{LITE_PREFIX}{position}/{page + 1}" rel="next">下一页</a>')
+        elif position + 1 < len(index.spine):
+            links.append(f'<a href="/{LITE_PREFIX}{position + 1}/0" rel="next">下一章</a>')
+        nav = f'<nav>{"".join(links)}</nav>'
+        title = ' - '.join(filter(None, [chapter.title, book.title]))
+        body = render_lite_page(title, chapter.pages[page], nav).encode('utf-8')
+        etag = index.etag(index.spine[position])[:-1] + f'-{LITE_PAGE_CHARS}-{page}"'
+        self.send_lite_body(body, etag, set_cookies)
+    
+    def send_lite_body(self, body, etag, set_cookies=()):
+        """发送精简视图页面（每次都要向服务器确认，打开页面时才能保存进度）"""
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        for cookie in set_cookies:
+            self.send_header('Set-Cookie', cookie)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        with self.trace_phase('write'):
+            self.wfile.write(body)
+    
+    def send_redirect(self, location, set_cookies=()):
+        self.send_response(302)
+        self.send_header('Location', location)
+        for cookie in set_cookies:
+            self.send_header('Set-Cookie', cookie)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    
+    def reader_identity(self):
+        """
+        当前请求的读者和设备：读者取查询参数reader（同时写入Cookie）或Cookie，默认为default；
+        设备取Cookie，没有时分配一个新的写入Cookie，本次请求仍作为匿名设备（不保存Cookie的客户端
+        每次都会分配新的，不能作为设备记录）。返回(读者, 设备, 需要设置的Cookie)
+        """
+        import re
+        import secrets
+        from http.cookies import SimpleCookie, CookieError
+        try:
+            cookies = SimpleCookie(self.headers.get('Cookie', ''))
+        except CookieError:
+            cookies = SimpleCookie()
+        set_cookies = []
+        
+        def _valid(name):
+            return name and re.fullmatch(r'[\w.-]{1,64}', name)
+        
+        reader = parse_qs(urlparse(self.path).query).get('reader', [None])[0]
+        if _valid(reader):
+            set_cookies.append(f'{READER_COOKIE}={quote(reader)}; Path=/; Max-Age=31536000; SameSite=Lax')
+        else:
+            reader = unquote(cookies[READER_COOKIE].value) if READER_COOKIE in cookies else None
+            if not _valid(reader):
+                reader = DEFAULT_READER
+        device = cookies[DEVICE_COOKIE].value if DEVICE_COOKIE in cookies else None
+        if not (device and re.fullmatch(r'[0-9a-f]{16}', device)):
+            set_cookies.append(f'{DEVICE_COOKIE}={secrets.token_hex(8)}; Path=/; Max-Age=315360000; SameSite=Lax')
+            device = ANONYMOUS_DEVICE
+        return reader, device, set_cookies
+    
+    def image_width(self):
+        """
+        客户端需要的图片宽度：查询参数w（和dpr），或客户端提示（Sec-CH-Viewport-Width、Sec-CH-DPR），
+        或集成脚本写入的Cookie（视口宽度x像素比），都没有时返回None
+        """
+        from http.cookies import SimpleCookie, CookieError
+        query = parse_qs(urlparse(self.path).query)
+        viewport = query.get('w', [None])[0]
+        dpr = query.get('dpr', [None])[0]
+        if viewport is None:
+            viewport = self.headers.get('Sec-CH-Viewport-Width') or self.headers.get('Viewport-Width')
+            dpr = self.headers.get('Sec-CH-DPR') or self.headers.get('DPR')
+        if viewport is None:
+            try:
+                morsel = SimpleCookie(self.headers.get('Cookie', '')).get(IMAGE_VIEWPORT_COOKIE)
+            except CookieError:
+                morsel = None
+            if morsel is not None:
+                viewport, _, dpr = morsel.value.partition('x')
+        try:
+            return image_target_width(float(viewport), float(dpr or 1)) if viewport else None
+        except ValueError:
+            return None
+    
+    def html_preload_links(self, last_cfi, book):
+        """页面的预加载列表：拆分模式下的容器文件、OPF、当前章节和后面的章节"""
+        if BOOK_MODE != 'unpacked':
+            return []
+        index = book.index()
+        if index is None:
+            return []
+        position = BookIndex.cfi_spine_index(last_cfi) or 0
+        entries = ['META-INF/container.xml', index.opf_path] + index.preload_entries(position, PRELOAD_COUNT + 1)
+        return [preload_link(entry, index.content_type(entry)) for entry in entries]
+    
+    def serve_metrics(self):
+        """输出Prometheus文本格式的指标"""
+        body = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def serve_payload_file(self, name, content_type):
+        """直接从附加数据中读取并发送文件"""
+        payload = get_payload()
+        if not payload.has(name):
+            self.send_error(404, "File not found")
+            return
+        etag = payload.etag(name)
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(payload.size(name)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        with payload.open(name) as f:
+            self.copyfile(f, self.wfile)
+    
+    def send_json(self, data, status=200, set_cookies=()):
+        """发送JSON响应"""
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for cookie in set_cookies:
+            self.send_header('Set-Cookie', cookie)
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def handle_admin(self):
+        """处理管理接口请求"""
+        if not is_admin_request(self):
+            self.send_error(403, "Forbidden")
+            return
+        
+        parsed = urlparse(self.path)
+        query = parse_qs(parsed.query)
+        if parsed.path == '/admin/profile':
+            # /admin/profile?seconds=30 开始一次性能分析
+            try:
+                seconds = min(max(float(query.get('seconds', ['30'])[0]), 1.0), 600.0)
+            except ValueError:
+                self.send_error(400, "Invalid seconds")
+                return
+            files = PROFILER.start(seconds)
+            if files is None:
+                self.send_json({'status': 'busy'}, 409)
+            else:
+                self.send_json({'status': 'started', 'seconds': seconds, 'files': files})
+        elif parsed.path == '/admin/restart':
+            # 热重启，监听套接字由新进程继承
+            if not can_restart_in_place():
+                self.send_error(501, "Restart not supported on this platform")
+                return
+            self.send_json({'status': 'restarting'})
+            request_restart()
+        elif parsed.path == '/admin/book':
+            # GET /admin/book查看当前的书；POST /admin/book换书，参数epub=路径或library=书库中的哈希（可加title=书名），
+            # 放在查询字符串或表单格式的请求体中。换书会改变状态，GET带换书参数时返回405
+            if self.command == 'POST':
+                if self.headers.get('Content-Length'):
+                    post_data = self.read_body()
+                    if post_data is None:
+                        return
+                    query.update(parse_qs(post_data.decode('utf-8', 'replace')))
+            elif 'epub' in query or 'library' in query:
+                self.send_error(405, "Use POST to swap books")
+                return
+            if not self.wait_book_ready():
+                return
+            epub_path = query.get('epub', [None])[0]
+            library_hash = query.get('library', [None])[0]
+            if library_hash:
+                book = _LIBRARY.books.get(library_hash) if _LIBRARY is not None else None
+                if book is None:
+                    self.send_error(404, "Book not in library")
+                    return
+                epub_path = str(book['path'])
+            if epub_path:
+                is_valid, result = validate_epub_path(epub_path, READER_DIR)
+                if not is_valid:
+                    self.send_json({'status': 'error', 'error': result}, 400)
+                    return
+                try:
+                    swap_book(epub_path, query.get('title', [None])[0])
+                except Exception as e:
+                    self.send_json({'status': 'error', 'error': str(e)}, 400)
+                    return
+            book = BOOK
+            self.send_json({'status': 'swapped' if epub_path else 'ok', 'title': book.title,
+                            'path': book.path, 'hash': book.hash, 'key': book.key})
+        else:
+            self.send_error(404, "Not found")
+    
+    def serve_html_with_history(self):
+        """处理HTML文件并注入历史记录恢复代码"""
         try:
-            import termios
-            import tty
-            import select
+            # 读取HTML文件内容
+            with self.trace_phase('read_file'):
+                content = self.read_reader_text(self.path)
+            if content is None:
+                self.send_error(404, "File not found")
+                return
+            
+            # 脚本标签替换为合并脚本
+            bundle = get_asset_bundle()
+            if bundle is not None:
+                content = bundle.rewrite_html(content)
+            
+            # 使用当前的书（整个请求中使用同一本，中途换书不影响这个页面）
+            book = self.request_book()
+            book_path = book.path
+            
+            # 获取当前读者上次阅读的位置
+            reader, device, set_cookies = self.reader_identity()
+            with self.trace_phase('get_last_position'):
+                last_cfi = get_last_position(book_path, reader, device, book)
+            
+            # 拆分模式：浏览器按目录方式打开，预加载当前和后面的章节
+            links = []
+            book_hash = book.hash
+            resize_images = False
+            if BOOK_MODE == 'unpacked':
+                resize_images = get_image_resizer() is not None
+                with self.trace_phase('preload'):
+                    links = self.html_preload_links(last_cfi, book)
+                book_path = BOOK_ENTRY_PREFIX
+                book_hash = None
+            
+            # 注入配置和集成脚本（书籍路径、进度恢复与同步、本地缓存都在集成脚本中）
+            sync_config = {
+                'bookPath': book_path,
+                'lastCFI': last_cfi,
+                'bookHash': book_hash,
+                'bookKey': book.key,
+                'serviceWorker': '/' + SERVICE_WORKER_NAME,
+                'viewportCookie': IMAGE_VIEWPORT_COOKIE if resize_images else None,
+            }
+            # 转义<，避免数据中的</script>提前结束脚本
+            sync_config = json.dumps(sync_config, ensure_ascii=False).replace('<', '\\u003c')
+            sync_script = get_sync_script()
+            injected_code = f"""
+    <script>window.READER_SYNC = {sync_config};</script>
+"""
+            if sync_script is not None:
+                injected_code += f"""    <script src="{sync_script.name}"></script>
+"""
+            
+            # 在</head>标签前注入代码
+            if '</head>' in content:
+                content = content.replace('</head>', injected_code + '</head>')
+            else:
+                # 如果没有head标签，在body开始处注入
+                content = content.replace('<body>', '<body>' + injected_code)
+            
+            # 发送修改后的内容
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            for cookie in set_cookies:
+                self.send_header('Set-Cookie', cookie)
+            if resize_images:
+                # 支持客户端提示的浏览器在之后的图片请求中带上视口宽度和像素比
+                self.send_header('Accept-CH', 'Sec-CH-Viewport-Width, Sec-CH-DPR')
+            for link in links:
+                self.send_header('Link', link)
+            self.end_headers()
+            with self.trace_phase('write'):
+                self.wfile.write(content.encode('utf-8'))
             
-            # 设置非阻塞输入
-            fd = sys.stdin.fileno()
-            old_settings = termios.tcgetattr(fd)
+        except Exception as e:
+            # 修复HTTP头中的Unicode编码问题
+            error_msg = str(e).encode('ascii', 'ignore').decode('ascii')
+            self.send_error(500, f"Internal server error: {error_msg}")
+    
+    def do_POST(self):
+        """处理POST请求，用于保存历史记录和管理接口中的换书"""
+        if urlparse(self.path).path == '/admin/book':
+            self._route = 'admin'
+            return self.handle_admin()
+        if self.path == '/api/save_history':
+            self._route = 'save_history'
+            if not self.wait_book_ready():
+                return
             try:
-                tty.setraw(fd)
-                while True:
-                    # 检查是否有输入
-                    if select.select([sys.stdin], [], [], 0.1)[0]:
-                        key = sys.stdin.read(1)
-                        if key == '\x1b':  # ESC键
-                            print("\n收到ESC键，正在退出服务器...")
-                            break
+                with self.trace_phase('read_body'):
+                    post_data = self.read_body()
+                if post_data is None:
+                    return
+                try:
+                    data = json.loads(post_data.decode('utf-8'))
+                except ValueError:
+                    self.send_error(400, "Invalid JSON")
+                    return
+                # book_path、cfi和book都应为字符串（可以省略），格式不对时返回400而不是在查找时出错
+                if not isinstance(data, dict) or any(
+                        not isinstance(data.get(field), (str, type(None))) for field in ('book_path', 'cfi', 'book')):
+                    self.send_error(400, "Invalid history data")
+                    return
+                
+                book_path = data.get('book_path')
+                cfi = data.get('cfi')
+                
+                # 换书前打开的页面仍保存到原来那本书（不认识的书不保存），并提示页面重新加载
+                current = self.request_book()
+                key = data.get('book')
+                book = current if key is None else _BOOK_STATES.get(key)
+                result = {'status': 'success'}
+                if book is not current:
+                    result['book_changed'] = True
+                
+                # 离线时保存、由Service Worker重放的进度带有距离保存的秒数，按服务器时间换算保存的时间
+                saved_at = None
+                age = data.get('age')
+                if isinstance(age, (int, float)) and not isinstance(age, bool) and 0 < age < float('inf'):
+                    saved_at = time.time() - age
+                
+                reader, device, set_cookies = self.reader_identity()
+                if book is not None and book_path and cfi:
+                    with self.trace_phase('history_io'):
+                        update_history(book_path, cfi, reader, device, book, saved_at)
+                    print(f"历史记录已保存: {reader}@{device[:6]} {book_path} -> {cfi}")
+                
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                for cookie in set_cookies:
+                    self.send_header('Set-Cookie', cookie)
+                self.end_headers()
+                with self.trace_phase('write'):
+                    self.wfile.write(json.dumps(result).encode('utf-8'))
+            except Exception as e:
+                self.send_error(500, f"Save history error: {str(e)}")
+        else:
+            self.send_error(404, "Not found")
+    
+    def end_headers(self):
+        # 添加CORS头信息
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        if getattr(self, '_trace', None) is not None:
+            # 各阶段耗时，浏览器开发者工具的Timing面板中可见
+            self.send_header('Server-Timing', self._trace.server_timing())
+            self.send_header('Timing-Allow-Origin', '*')
+        super().end_headers()
+
+# 连接和超时限制：固定数量的工作线程处理连接，等待队列和同一客户端的连接数都有上限，
+# 慢客户端和异常客户端最多占用一个工作线程到超时为止，不影响其他设备
+WORKER_COUNT = 16
+ACCEPT_QUEUE_SIZE = 64
+CLIENT_CONNECTION_LIMIT = 12
+IDLE_TIMEOUT = 15.0
+READ_TIMEOUT = 10.0
+WRITE_TIMEOUT = 30.0
+RESPONSE_TIMEOUT = 600.0
+MAX_BODY_BYTES = 64 * 1024
+
+class ReaderHTTPServer(socketserver.TCPServer):
+    """
+    HTTP服务器：地址复用需要在绑定前设置（类属性），监听队列加大到128，
+    重启期间到达的连接在内核队列中等待而不是被拒绝；
+    传入listen_socket时直接使用继承来的已在监听的套接字，不再绑定端口。
+    接受的连接交给工作线程处理：等待队列满时直接返回503，同一客户端的连接数超过上限时返回429
+    """
+    allow_reuse_address = True
+    request_queue_size = 128
+    
+    def __init__(self, server_address, handler_class, listen_socket=None):
+        import queue
+        self._pending = queue.Queue(ACCEPT_QUEUE_SIZE)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._workers = []
+        if listen_socket is None:
+            super().__init__(server_address, handler_class)
+        else:
+            super().__init__(server_address, handler_class, bind_and_activate=False)
+            self.socket.close()
+            self.socket = listen_socket
+            self.server_address = listen_socket.getsockname()
+        for i in range(max(WORKER_COUNT, 1)):
+            worker = threading.Thread(target=self._work, name=f'worker-{i}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        METRICS.register_gauge('epub_server_accept_queue_depth', '等待工作线程处理的连接数', self._pending.qsize)
+    
+    def process_request(self, request, client_address):
+        """把连接放入等待队列（在接受连接的线程中执行，不做任何阻塞操作）"""
+        import queue
+        client = client_address[0]
+        with self._clients_lock:
+            count = self._clients.get(client, 0)
+            if count < CLIENT_CONNECTION_LIMIT:
+                self._clients[client] = count + 1
+        if count >= CLIENT_CONNECTION_LIMIT:
+            return self._reject(request, 429, 'Too Many Requests', 'client_limit')
+        try:
+            self._pending.put_nowait((request, client_address))
+        except queue.Full:
+            self._release(client)
+            self._reject(request, 503, 'Service Unavailable', 'queue_full')
+    
+    def _reject(self, request, status, reason, metric):
+        """直接回复一个错误状态并关闭连接（响应很小，非阻塞发送，不等待客户端）"""
+        METRICS.record_dropped(metric)
+        try:
+            request.setblocking(False)
+            request.send(f'HTTP/1.0 {status} {reason}\r\nRetry-After: 1\r\n'
+                         f'Content-Length: 0\r\nConnection: close\r\n\r\n'.encode('ascii'))
+        except OSError:
+            pass
+        self.shutdown_request(request)
+    
+    def _release(self, client):
+        with self._clients_lock:
+            count = self._clients.get(client, 1) - 1
+            if count > 0:
+                self._clients[client] = count
+            else:
+                self._clients.pop(client, None)
+    
+    def _work(self):
+        while True:
+            item = self._pending.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
             finally:
-                termios.tcsetattr(fd, termios.TCSADRAIN, old_settings)
+                # 客户端收到完整响应后可能立即发起下一个连接，先释放计数再关闭
+                self._release(client_address[0])
+                self.shutdown_request(request)
+    
+    def handle_error(self, request, client_address):
+        """客户端断开或超时时只计数，不输出错误堆栈"""
+        error = sys.exc_info()[1]
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            METRICS.record_dropped('disconnected' if isinstance(error, ConnectionError) else 'timeout')
+            return
+        super().handle_error(request, client_address)
+    
+    def stop_workers(self, timeout=None):
+        """处理完队列中剩余的连接后停止工作线程，返回是否在期限内全部停止"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for _ in self._workers:
+            try:
+                self._pending.put(None, timeout=None if deadline is None else max(deadline - time.monotonic(), 0.01))
+            except Exception:
+                return False
+        for worker in self._workers:
+            worker.join(None if deadline is None else max(deadline - time.monotonic(), 0))
+        return not any(worker.is_alive() for worker in self._workers)
+    
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            try:
+                self._pending.put_nowait(None)
+            except Exception:
+                break
+
+# systemd套接字激活时继承的第一个文件描述符
+SD_LISTEN_FDS_START = 3
+
+def get_listen_socket(listen_fd=None):
+    """
+    获取继承的监听套接字：--listen-fd指定的文件描述符，
+    或systemd套接字激活（LISTEN_PID为本进程且LISTEN_FDS≥1时使用描述符3），没有时返回None
+    """
+    if listen_fd is None and os.environ.get('LISTEN_PID') == str(os.getpid()):
+        try:
+            if int(os.environ.get('LISTEN_FDS', '0')) >= 1:
+                listen_fd = SD_LISTEN_FDS_START
+        except ValueError:
+            pass
+        # 与sd_listen_fds一样清除环境变量，避免传给子进程
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+    if listen_fd is None:
+        return None
+    return socket.socket(fileno=listen_fd)
+
+# 退出处理函数（恢复终端设置、删除解压目录、关闭轨迹文件等）：正常退出时由atexit执行，
+# 热重启时exec不会执行atexit注册的函数，在exec前显式执行
+_EXIT_HANDLERS = []
+
+def register_exit_handler(func, *args):
+    """注册退出时执行的函数"""
+    _EXIT_HANDLERS.append((func, args))
+
+def run_exit_handlers():
+    """按注册的相反顺序执行退出处理函数（每个只执行一次）"""
+    while _EXIT_HANDLERS:
+        func, args = _EXIT_HANDLERS.pop()
+        try:
+            func(*args)
+        except Exception as e:
+            print(f"退出处理失败: {e}")
+
+atexit.register(run_exit_handlers)
+
+# 热重启（SIGHUP或/admin/restart）：serve_forever返回后在main中重新执行程序
+RESTART_REQUESTED = threading.Event()
+# 启动后会切换到reader目录，脚本路径要在导入时转换为绝对路径
+SCRIPT_PATH = os.path.abspath(sys.argv[0])
+
+def can_restart_in_place():
+    """热重启需要exec和可继承的套接字描述符（Linux/macOS）"""
+    return os.name == 'posix'
+
+def request_restart():
+    """请求热重启：处理完当前请求后停止服务，监听套接字保持打开"""
+    if LIFECYCLE is None or LIFECYCLE.stopping:
+        return
+    RESTART_REQUESTED.set()
+    LIFECYCLE.request_stop("收到热重启请求")
+
+def install_restart_signal():
+    """在Linux/macOS上注册SIGHUP，收到后热重启"""
+    if not hasattr(signal, 'SIGHUP'):
+        return
+    signal.signal(signal.SIGHUP, lambda signum, frame: request_restart())
+
+def restart_in_place(httpd):
+    """保留监听套接字重新执行程序，新进程通过--listen-fd继承套接字，期间的连接在内核队列中等待"""
+    fd = httpd.socket.fileno()
+    os.set_inheritable(fd, True)
+    
+    # 去掉旧的--listen-fd，重启后不再打开浏览器
+    argv = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+        elif arg == '--listen-fd':
+            skip = True
+        elif not arg.startswith('--listen-fd='):
+            argv.append(arg)
+    argv += ['--listen-fd', str(fd)]
+    if '--no-browser' not in argv:
+        argv.append('--no-browser')
+    if getattr(sys, 'frozen', False):
+        argv = [sys.executable] + argv
+    else:
+        argv = [sys.executable, SCRIPT_PATH] + argv
+    
+    print("正在热重启...")
+    # 清理步骤已在LIFECYCLE.run中执行，超时跳过的步骤这里再执行一次：写入未保存的进度、关闭电子书；
+    # 再执行退出处理函数，监听套接字由新进程继承，不关闭
+    PROGRESS.flush()
+    close_books()
+    run_exit_handlers()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.execv(sys.executable, argv)
+
+class StartupProfile:
+    """启动阶段计时（--startup-profile），时间均从模块开始执行算起"""
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+    
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _StartupPhase(self, name)
+    
+    def mark(self, name):
+        """记录一个时间点（如开始接受连接）"""
+        if self.enabled:
+            self.phases.append((name, time.perf_counter() - _MODULE_START, 0.0, threading.current_thread().name))
+    
+    def report(self, min_import_ms=1.0):
+        if not self.enabled:
+            return
+        print("启动分析（从模块开始执行计时，单位ms）：")
+        print(f"  {'阶段':<20}{'开始':>10}{'耗时':>10}  线程")
+        for name, offset, seconds, thread in sorted(self.phases, key=lambda phase: phase[1]):
+            print(f"  {name:<20}{offset * 1000:>10.1f}{seconds * 1000:>10.1f}  {thread}")
+        if IMPORT_TIMER is not None and IMPORT_TIMER.records:
+            records = IMPORT_TIMER.records
+            total = sum(self_time for _, self_time, _, _ in records)
+            print(f"模块导入：共{len(records)}个，合计{total * 1000:.1f}ms（只列出累计耗时≥{min_import_ms:g}ms的模块）")
+            print("  import time: self [us] | cumulative | imported package")
+            for name, self_time, cumulative, depth in records:
+                if cumulative * 1000 >= min_import_ms:
+                    print(f"  import time: {self_time * 1e6:>9.0f} | {cumulative * 1e6:>10.0f} | {'  ' * depth}{name}")
+
+class _StartupPhase:
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+    
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc):
+        self.profile.phases.append((self.name, self.start - _MODULE_START,
+                                    time.perf_counter() - self.start, threading.current_thread().name))
+        return False
+
+STARTUP = StartupProfile()
+
+# 书名、电子书文件和历史记录目录在开始监听后由后台线程准备，准备好之前依赖它们的请求会等待
+BOOK_READY = threading.Event()
+BOOK_READY_TIMEOUT = 60
+
+def load_book(epub_path, reader_dir, title, config, payload_book):
+    """读取书籍信息：计算内容哈希、提取书名、复制电子书，返回BookState"""
+    # 电子书内容哈希和书名（有缓存时不用重新读取电子书）
+    metadata = None
+    source = source_stamp = None
+    with STARTUP.phase('book_metadata'):
+        try:
+            if epub_path is None and payload_book:
+                metadata = get_book_metadata(get_payload().path, PAYLOAD_BOOK_NAME)
+            elif epub_path:
+                source = Path(epub_path)
+                source = source if source.is_absolute() else reader_dir / source
+                source_stamp = file_stamp(source)
+                metadata = get_book_metadata(source)
+        except OSError as e:
+            print(f"读取电子书元数据失败: {e}")
+        book_hash = metadata['hash'] if metadata else None
+    
+    # 确定书名（优先级：命令行参数 > 从epub文件提取 > 配置文件 > 默认值）
+    with STARTUP.phase('book_title'):
+        if title:
+            book_title = title
+            print(f"使用命令行指定的书名: {book_title}")
+        elif epub_path:
+            # 尝试从epub文件中提取书名（以reader目录为起点）
+            try:
+                if metadata and metadata.get('title'):
+                    book_title = metadata['title']
+                else:
+                    book_title = get_book_title_from_file(epub_path, reader_dir)
+                print(f"从电子书文件中提取的书名: {book_title}")
+            except Exception as e:
+                print(f"从电子书提取书名失败: {e}")
+                book_title = Path(epub_path).stem
+        elif config and config.get('book_title'):
+            book_title = config['book_title']
+        else:
+            book_title = "history"
+    
+    # 处理电子书文件
+    with STARTUP.phase('epub_file'):
+        if epub_path is None and payload_book:
+            # 电子书附加在程序末尾，直接从附加数据中读取
+            book_path = PAYLOAD_BOOK_URL
+            print(f"使用附加在程序中的电子书: {get_payload().path}")
+        else:
+            book_path = setup_epub_file(epub_path, book_title, reader_dir, book_hash)
+    return BookState(book_path, book_title, book_hash, source, source_stamp)
+
+def publish_book(book):
+    """把book设为当前的书（替换一个引用，之后开始的请求使用新书）"""
+    global BOOK
+    _BOOK_STATES.pop(book.key, None)
+    _BOOK_STATES[book.key] = book
+    # 只保留最近提供过的几本书
+    while len(_BOOK_STATES) > 16:
+        del _BOOK_STATES[next(iter(_BOOK_STATES))]
+    with _BOOK_LOCK:
+        BOOK = book
+
+def prepare_book(epub_path, reader_dir, title, config, payload_book):
+    """后台准备书籍信息：计算内容哈希、提取书名、复制电子书、创建历史记录目录"""
+    try:
+        book = load_book(epub_path, reader_dir, title, config, payload_book)
+        
+        # 创建历史记录目录并预读历史记录
+        with STARTUP.phase('history'):
+            history_dir = get_history_dir()
+            PROGRESS.load(book.history_filename())
+            print(f"历史记录目录: {history_dir}")
+            print(f"历史记录文件: {book.history_filename()}")
+        publish_book(book)
+    finally:
+        BOOK_READY.set()
+    print(f"当前书籍: {BOOK.title}")
+    print(f"电子书路径: {BOOK.path}")
+
+# 换书：管理接口（POST /admin/book?epub=路径）或电子书文件变化（--watch-book）时不重启服务器，
+# 在后台准备好新书后整体替换BOOK；同一时间只进行一次换书
+READER_DIR = None
+BOOK_WATCH_INTERVAL = 2.0
+_SWAP_LOCK = threading.Lock()
+
+def swap_book(epub_path, title=None):
+    """
+    换成另一本书（或重新读取修改过的同一本书）：重新计算哈希和书名、复制电子书、生成书脊索引，
+    之后开始的请求使用新书，页面、预缓存清单、章节和精简视图的缓存都随BookState更换。
+    电子书无效时抛出ValueError，当前的书不变
+    """
+    with _SWAP_LOCK:
+        book = load_book(epub_path, READER_DIR, title, None, False)
+        if book.index() is None:
+            raise ValueError(f"无法读取电子书: {epub_path}")
+        PROGRESS.load(book.history_filename())
+        previous = BOOK
+        publish_book(book)
+        retire_book(previous)
+    if previous.title != book.title or previous.path != book.path:
+        print(f"已换书: {previous.title} -> {book.title}")
+    else:
+        print(f"已重新读取电子书: {book.title}")
+    return book
+
+class BookWatcher:
+    """
+    监视当前电子书的原文件（--watch-book），文件被修改或替换且大小和修改时间稳定一个检查周期后重新读取，
+    书名保持不变（阅读进度继续使用同一个历史记录文件）
+    """
+    def __init__(self, interval=BOOK_WATCH_INTERVAL):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='book-watcher', daemon=True)
+    
+    def start(self):
+        self._thread.start()
+    
+    def stop(self):
+        self._stop.set()
+    
+    def _run(self):
+        BOOK_READY.wait()
+        pending = None
+        while not self._stop.wait(self.interval):
+            # 通过管理接口换书后自动改为监视新书
+            book = BOOK
+            current = file_stamp(book.source) if book.source else None
+            if current is None or current == book.source_stamp:
+                pending = None
+                continue
+            if current != pending:
+                # 文件可能还在写入，等下一个周期确认没有继续变化
+                pending = current
+                continue
+            pending = None
+            try:
+                swap_book(str(book.source), book.title)
+            except Exception as e:
+                print(f"重新读取电子书失败: {e}")
+                # 文件再次变化前不再重试
+                book.source_stamp = current
+
+def parse_arguments():
+    """解析命令行参数"""
+    import argparse
+    parser = argparse.ArgumentParser(description='ePub服务器')
+    parser.add_argument('--title', type=str, help='书名')
+    parser.add_argument('--epub', type=str, help='ePub电子书路径（绝对路径或相对路径）')
+    parser.add_argument('--ip', type=str, help='服务器IP地址')
+    parser.add_argument('--port', type=int, help='服务器端口')
+    parser.add_argument('--trace', action='store_true', help='开启请求分阶段追踪（输出Server-Timing响应头）')
+    parser.add_argument('--trace-log', type=str, help='追踪日志文件路径（按大小轮转，每行一个JSON）')
+    parser.add_argument('--admin-token', type=str, help='管理接口令牌（不设置时管理接口只允许本机访问）')
+    parser.add_argument('--record-trace', type=str, help='把请求轨迹记录到文件（.gz结尾时压缩），供benchmarks.replay重放')
+    parser.add_argument('--data-dir', type=str, help='数据目录，History、Cache和Profiles都保存在其中（默认为程序所在目录）')
+    parser.add_argument('--history-dir', type=str, help='历史记录目录（默认为数据目录下的History）')
+    parser.add_argument('--no-browser', action='store_true', help='启动后不自动打开浏览器')
+    parser.add_argument('--headless', action='store_true', help='无界面模式：不读取键盘输入，只通过SIGTERM/Ctrl+C停止（标准输入不是终端时自动开启）')
+    parser.add_argument('--asset-mode', choices=['archive', 'cache'],
+                        help='附加数据中阅读器资源的使用方式：archive直接从附加数据读取（默认），cache解压到持久化缓存目录并在之后的启动中复用')
+    parser.add_argument('--payload', type=str, help='从指定文件读取附加数据（调试用，打包模式下自动读取程序自身）')
+    parser.add_argument('--listen-fd', type=int, help='使用继承的已在监听的套接字描述符（热重启时使用，也支持systemd的LISTEN_FDS）')
+    parser.add_argument('--no-bundle', action='store_true', help='不合并脚本，页面使用原始的各个脚本文件（调试用）')
+    parser.add_argument('--book-mode', choices=['archive', 'unpacked'],
+                        help='电子书加载方式：archive整本下载（默认），unpacked按章节请求并预加载接下来的章节')
+    parser.add_argument('--preload', type=int, help='拆分模式下预加载后面的章节数（默认2）')
+    parser.add_argument('--no-image-resize', action='store_true', help='拆分模式下不按视口缩放书中的图片')
+    parser.add_argument('--image-quality', type=int, help='缩放后图片的JPEG/WebP质量（默认80）')
+    parser.add_argument('--image-cache-mb', type=int, help='缩放后图片的磁盘缓存上限，单位MB（默认256）')
+    parser.add_argument('--progress-policy', choices=['latest', 'device'],
+                        help='打开页面时使用的阅读位置：latest为该读者在所有设备上最新的位置（默认），device优先使用本设备的位置')
+    parser.add_argument('--lite-page-chars', type=int, help='精简视图每页的字数（默认4000，0表示每章一页）')
+    parser.add_argument('--library', type=str, help='书库目录：/library/页面列出其中所有电子书及封面')
+    parser.add_argument('--watch-book', action='store_true', help='电子书文件被修改或替换后自动重新读取，不需要重启服务器')
+    parser.add_argument('--workers', type=int, help='处理连接的工作线程数（默认16）')
+    parser.add_argument('--accept-queue', type=int, help='等待工作线程的连接数上限，超过时返回503（默认64）')
+    parser.add_argument('--client-limit', type=int, help='同一客户端地址的并发连接数上限，超过时返回429（默认12）')
+    parser.add_argument('--idle-timeout', type=float, help='连接建立后等待请求的秒数（默认15）')
+    parser.add_argument('--read-timeout', type=float, help='读取请求头和请求体的秒数（默认10）')
+    parser.add_argument('--write-timeout', type=float, help='发送响应时客户端无响应的秒数（默认30）')
+    parser.add_argument('--response-timeout', type=float, help='发送一个响应的总时限，单位秒（默认600）')
+    parser.add_argument('--max-body-kb', type=int, help='接口请求体的大小上限，单位KB（默认64）')
+    parser.add_argument('--startup-profile', action='store_true', help='输出启动各阶段耗时和模块导入耗时')
+    return parser.parse_args()
+
+def is_packaged():
+    """检查是否在打包模式下运行"""
+    return getattr(sys, 'frozen', False)
+
+def get_user_input():
+    """获取用户输入（仅在独立运行时使用）"""
+    # 获取服务器IP
+    server_ip = input("请输入服务器IP（直接回车为127.0.0.1）: ").strip()
+    if not server_ip:
+        server_ip = "127.0.0.1"
+    
+    # 获取服务器端口
+    server_port_input = input("请输入服务器端口（直接回车为10086）: ").strip()
+    if server_port_input:
+        try:
+            server_port = int(server_port_input)
+        except ValueError:
+            print("输入无效，使用默认端口10086")
+            server_port = 10086
+    else:
+        server_port = 10086
+    
+    return server_ip, server_port
+
+def get_epub_path_from_user(reader_dir):
+    """从用户输入获取epub路径，以reader目录为起点验证路径有效性"""
+    while True:
+        epub_path_input = input("请输入ePub电子书路径（直接回车为epub\\book.epub）: ").strip()
+        
+        # 移除可能包裹的双引号
+        epub_path_input = epub_path_input.strip('"')
+        
+        if not epub_path_input:
+            print("路径为epub\\book.epub")
+            epub_path_input = "epub\\book.epub"
+        
+        # 验证路径有效性（以reader目录为起点）
+        is_valid, result = validate_epub_path(epub_path_input, reader_dir)
+        
+        if is_valid:
+            print(f"找到电子书文件: {result}")
+            return epub_path_input
+        else:
+            print(f"错误: {result}")
+            print("请重新输入有效的电子书路径")
+
+class LifecycleManager:
+    """
+    服务器生命周期：serve_forever在后台线程运行，主线程阻塞等待关闭请求（信号、ESC键、热重启），
+    关闭时先在期限内等待进行中的请求完成，再依次执行各清理步骤（每步都有时间上限）
+    """
+    def __init__(self, httpd, drain_timeout=10.0):
+        self.httpd = httpd
+        self.drain_timeout = drain_timeout
+        self.reason = None
+        self._stop = threading.Event()
+        self._steps = []
+        self._server_thread = None
+    
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+    
+    def add_cleanup(self, name, func, timeout=5.0):
+        """注册关闭时的清理步骤（按注册顺序执行）"""
+        self._steps.append((name, func, timeout))
+    
+    def install_signals(self):
+        """SIGTERM/SIGINT（Windows上还有SIGBREAK）触发优雅关闭，再次收到时立即退出"""
+        def _handler(signum, frame):
+            if self.stopping:
+                print("\n再次收到退出信号，立即退出")
+                os._exit(1)
+            self.request_stop(f"收到信号{signal.Signals(signum).name}")
+        for name in ('SIGINT', 'SIGTERM', 'SIGBREAK'):
+            if hasattr(signal, name):
+                signal.signal(getattr(signal, name), _handler)
+    
+    def watch_keyboard(self):
+        """在守护线程中阻塞读取按键（不轮询），ESC键退出"""
+        threading.Thread(target=self._read_keys, name='keyboard', daemon=True).start()
+    
+    def _read_keys(self):
+        try:
+            import msvcrt
         except ImportError:
-            # 如果都不支持，使用简单的input方式
-            print("按ESC键退出服务器...")
-            while True:
-                try:
-                    # 使用超时输入
-                    import select
-                    if select.select([sys.stdin], [], [], 1)[0]:
-                        line = sys.stdin.readline()
-                        if line.strip().lower() in ['esc', 'exit', 'quit']:
-                            print("正在退出服务器...")
-                            break
-                except:
-                    # 如果select不支持，使用简单循环
-                    time.sleep(1)
-    # 关闭服务器
-    httpd.shutdown()
-    # 清理临时目录
-    cleanup_temp_dir(reader_dir)
+            msvcrt = None
+        try:
+            if msvcrt is not None:
+                # Windows：getch会阻塞到有按键
+                while msvcrt.getch() not in (b'\x1b', b'\x03'):
+                    pass
+            else:
+                import termios
+                import tty
+                fd = sys.stdin.fileno()
+                old_settings = termios.tcgetattr(fd)
+                # 退出（包括热重启exec前）时由退出处理函数恢复终端设置
+                register_exit_handler(termios.tcsetattr, fd, termios.TCSADRAIN, old_settings)
+                # cbreak模式逐个读取按键，同时保留Ctrl+C信号和正常的输出换行
+                tty.setcbreak(fd)
+                while True:
+                    key = os.read(fd, 1)
+                    if not key:
+                        # 标准输入已关闭，之后只能通过信号停止
+                        return
+                    if key == b'\x1b':
+                        break
+        except Exception as e:
+            print(f"无法监听键盘，请使用Ctrl+C停止服务器: {e}")
+            return
+        self.request_stop("收到ESC键")
+    
+    def request_stop(self, reason):
+        """请求关闭（可在任意线程和信号处理函数中调用）"""
+        if self.stopping:
+            return
+        self.reason = reason
+        print(f"\n{reason}，正在停止服务器...")
+        self._stop.set()
+    
+    def run(self):
+        """运行服务器直到收到关闭请求，返回时服务器已停止并完成清理"""
+        self._server_thread = threading.Thread(target=self.httpd.serve_forever, name='server', daemon=True)
+        self._server_thread.start()
+        # 在POSIX上无超时的等待可被信号打断；Windows上锁等待不响应Ctrl+C，只能定时醒来
+        wait_interval = None if os.name == 'posix' else 1.0
+        while not self._stop.wait(wait_interval):
+            pass
+        self.drain()
+        self.cleanup()
+    
+    def drain(self):
+        """停止接受新请求，在期限内等待进行中的请求完成"""
+        deadline = time.monotonic() + self.drain_timeout
+        threading.Thread(target=self.httpd.shutdown, daemon=True).start()
+        self._server_thread.join(self.drain_timeout)
+        if self._server_thread.is_alive() or not self.httpd.stop_workers(deadline - time.monotonic()):
+            print(f"等待进行中的请求超过{self.drain_timeout:g}秒，不再等待")
+            return False
+        return True
+    
+    def cleanup(self):
+        """依次执行清理步骤，超时的步骤不再等待"""
+        for name, func, timeout in self._steps:
+            worker = threading.Thread(target=func, name=f'cleanup-{name}', daemon=True)
+            worker.start()
+            worker.join(timeout)
+            if worker.is_alive():
+                print(f"清理步骤“{name}”超过{timeout:g}秒，已跳过")
+
+LIFECYCLE = None
 
 def main():
-    global BOOK_TITLE, CURRENT_BOOK_PATH
+    global ADMIN_TOKEN, DATA_DIR, HISTORY_DIR, TRACE_RECORDER, PAYLOAD_PATH, ASSET_ARCHIVE, LIFECYCLE, BUNDLE_ENABLED
+    global BOOK_MODE, PRELOAD_COUNT, IMAGE_RESIZE_ENABLED, IMAGE_QUALITY, IMAGE_CACHE_MB
+    global LIBRARY_DIR, _LIBRARY, LITE_PAGE_CHARS, _OPDS_CATALOG, PROGRESS_POLICY, READER_DIR
+    global WORKER_COUNT, ACCEPT_QUEUE_SIZE, CLIENT_CONNECTION_LIMIT, IDLE_TIMEOUT, READ_TIMEOUT, WRITE_TIMEOUT, RESPONSE_TIMEOUT, MAX_BODY_BYTES
+    
+    STARTUP.enabled = IMPORT_TIMER is not None
+    STARTUP.phases.append(('imports', 0.0, time.perf_counter() - _MODULE_START, threading.current_thread().name))
     
     # 解析命令行参数
-    args = parse_arguments()
+    with STARTUP.phase('parse_arguments'):
+        args = parse_arguments()
     
-    # 获取配置（打包模式下从配置文件读取）
-    config = None
-    if is_packaged():
-        config = get_config()
+    # 获取配置（打包模式下从附加数据或配置文件读取）
+    with STARTUP.phase('config'):
+        if args.payload:
+            PAYLOAD_PATH = Path(args.payload).resolve()
+        config = None
+        if is_packaged() or PAYLOAD_PATH:
+            config = get_config()
+        payload = get_payload()
+        payload_book = payload is not None and payload.has(PAYLOAD_BOOK_NAME)
     
-    # 获取reader目录路径
-    reader_dir = get_resource_path("reader")
+    # 获取reader目录路径（附加数据中包含阅读器资源时不再使用解压到临时目录的资源）
+    with STARTUP.phase('reader_dir'):
+        if payload_has_reader(payload):
+            asset_mode = args.asset_mode or (config.get('asset_mode') if config else None) or 'archive'
+            if asset_mode == 'cache':
+                reader_dir = extract_reader_cache(payload, config.get('assets_key') if config else None)
+            else:
+                # 阅读器资源直接从附加数据读取，目录只用于存放复制的电子书等临时文件
+                import shutil
+                import tempfile
+                ASSET_ARCHIVE = payload
+                reader_dir = Path(tempfile.mkdtemp(prefix="epub-reader-"))
+                register_exit_handler(shutil.rmtree, reader_dir, True)
+                print("阅读器资源直接从附加数据读取")
+        else:
+            reader_dir = get_resource_path("reader")
     
     # 检查reader目录是否存在
     if not reader_dir.exists():
@@ -583,32 +4486,16 @@ def main():
             print("将使用默认电子书路径")
             epub_path = None
     
-    if epub_path is None and not is_packaged():
+    if epub_path is None and not payload_book and not is_packaged():
         # 调试模式下，如果命令行和配置文件都没有指定epub路径，则从用户输入获取
         epub_path = get_epub_path_from_user(reader_dir)
     
-    # 确定书名（优先级：命令行参数 > 从epub文件提取 > 配置文件 > 默认值）
-    if args.title:
-        BOOK_TITLE = args.title
-        print(f"使用命令行指定的书名: {BOOK_TITLE}")
-    elif epub_path:
-        # 尝试从epub文件中提取书名（以reader目录为起点）
-        try:
-            BOOK_TITLE = get_book_title_from_file(epub_path, reader_dir)
-            print(f"从电子书文件中提取的书名: {BOOK_TITLE}")
-        except Exception as e:
-            print(f"从电子书提取书名失败: {e}")
-            BOOK_TITLE = Path(epub_path).stem
-    elif config and config.get('book_title'):
-        BOOK_TITLE = config['book_title']
-    elif is_packaged():
-        BOOK_TITLE = "history"
-    else:
-        # 调试模式下，如果都没有提供书名，则使用默认值
-        BOOK_TITLE = "history"
-    
-    # 获取IP和端口（优先级：命令行参数 > 配置文件 > 默认值）
-    if args.ip and args.port:
+    # 获取IP和端口（优先级：继承的监听套接字 > 命令行参数 > 配置文件 > 默认值）
+    listen_socket = get_listen_socket(args.listen_fd)
+    if listen_socket is not None:
+        ip, port = listen_socket.getsockname()[:2]
+        print(f"使用继承的监听套接字: {ip}:{port}")
+    elif args.ip and args.port:
         ip = args.ip
         port = args.port
         print(f"使用命令行指定的服务器配置: {ip}:{port}")
@@ -623,49 +4510,158 @@ def main():
         ip, port = get_user_input()
     
     # 检查index.html是否存在
-    if not (reader_dir / "index.html").exists():
+    if ASSET_ARCHIVE is None and not (reader_dir / "index.html").exists():
         print(f"错误: 在{reader_dir}中找不到index.html")
         input("按回车键退出...")
         sys.exit(1)
     
-    # 处理电子书文件
-    CURRENT_BOOK_PATH = setup_epub_file(epub_path, BOOK_TITLE, reader_dir)
+    # 数据目录和历史记录目录（优先级：命令行参数 > 配置文件 > 默认值）
+    data_dir_arg = args.data_dir or (config.get('data_dir') if config else None)
+    if data_dir_arg:
+        DATA_DIR = Path(data_dir_arg).resolve()
+    history_dir_arg = args.history_dir or (config.get('history_dir') if config else None)
+    if history_dir_arg:
+        HISTORY_DIR = Path(history_dir_arg).resolve()
+    
+    # 请求轨迹记录（优先级：命令行参数 > 配置文件）
+    record_trace = args.record_trace or (config.get('record_trace') if config else None)
+    if record_trace:
+        TRACE_RECORDER = TraceRecorder(record_trace)
+        register_exit_handler(TRACE_RECORDER.close)
+        print(f"请求轨迹记录: {TRACE_RECORDER.path}")
+    
+    # 管理接口令牌（优先级：命令行参数 > 配置文件）
+    ADMIN_TOKEN = args.admin_token or (config.get('admin_token') if config else None)
+    install_profile_signal()
+    
+    # 请求追踪（优先级：命令行参数 > 配置文件）
+    trace_log = args.trace_log or (config.get('trace_log') if config else None)
+    if args.trace or trace_log or (config and config.get('trace')):
+        setup_tracing(True, trace_log)
+    
+    # 合并脚本（优先级：命令行参数 > 配置文件）
+    if args.no_bundle or (config and config.get('bundle') is False):
+        BUNDLE_ENABLED = False
+    
+    # 电子书加载方式和预加载（优先级：命令行参数 > 配置文件 > 默认值）
+    BOOK_MODE = args.book_mode or (config.get('book_mode') if config else None) or BOOK_MODE
+    preload = args.preload if args.preload is not None else (config.get('preload') if config else None)
+    if preload is not None:
+        PRELOAD_COUNT = max(int(preload), 0)
     
-    # 创建历史记录目录
-    history_dir = get_history_dir()
-    print(f"历史记录目录: {history_dir}")
-    print(f"历史记录文件: {get_history_filename()}")
+    # 图片缩放（优先级：命令行参数 > 配置文件 > 默认值）
+    if args.no_image_resize or (config and config.get('image_resize') is False):
+        IMAGE_RESIZE_ENABLED = False
+    image_quality = args.image_quality or (config.get('image_quality') if config else None)
+    if image_quality:
+        IMAGE_QUALITY = min(max(int(image_quality), 1), 95)
+    image_cache_mb = args.image_cache_mb or (config.get('image_cache_mb') if config else None)
+    if image_cache_mb:
+        IMAGE_CACHE_MB = int(image_cache_mb)
     
-    # 切换到reader目录
+    # 阅读位置的选择方式（优先级：命令行参数 > 配置文件 > 默认值）
+    PROGRESS_POLICY = args.progress_policy or (config.get('progress_policy') if config else None) or PROGRESS_POLICY
+    
+    # 精简视图每页字数（优先级：命令行参数 > 配置文件 > 默认值）
+    lite_page_chars = args.lite_page_chars if args.lite_page_chars is not None else (config.get('lite_page_chars') if config else None)
+    if lite_page_chars is not None:
+        LITE_PAGE_CHARS = max(int(lite_page_chars), 0)
+    
+    # 连接和超时限制（优先级：命令行参数 > 配置文件 > 默认值）
+    def setting(value, key):
+        return value if value is not None else (config.get(key) if config else None)
+    WORKER_COUNT = max(int(setting(args.workers, 'workers') or WORKER_COUNT), 1)
+    ACCEPT_QUEUE_SIZE = max(int(setting(args.accept_queue, 'accept_queue') or ACCEPT_QUEUE_SIZE), 1)
+    CLIENT_CONNECTION_LIMIT = max(int(setting(args.client_limit, 'client_limit') or CLIENT_CONNECTION_LIMIT), 1)
+    IDLE_TIMEOUT = float(setting(args.idle_timeout, 'idle_timeout') or IDLE_TIMEOUT)
+    READ_TIMEOUT = float(setting(args.read_timeout, 'read_timeout') or READ_TIMEOUT)
+    WRITE_TIMEOUT = float(setting(args.write_timeout, 'write_timeout') or WRITE_TIMEOUT)
+    RESPONSE_TIMEOUT = float(setting(args.response_timeout, 'response_timeout') or RESPONSE_TIMEOUT)
+    MAX_BODY_BYTES = int(setting(args.max_body_kb, 'max_body_kb') or MAX_BODY_BYTES // 1024) * 1024
+    
+    # 书库目录（优先级：命令行参数 > 配置文件）
+    library_dir = args.library or (config.get('library_dir') if config else None)
+    if library_dir:
+        LIBRARY_DIR = Path(library_dir).resolve()
+        if LIBRARY_DIR.is_dir():
+            _LIBRARY = Library(LIBRARY_DIR, get_cache_dir())
+            _OPDS_CATALOG = OPDSCatalog(_LIBRARY)
+        else:
+            print(f"警告: 书库目录不存在: {LIBRARY_DIR}")
+    
+    # 切换到reader目录（换书时以它为起点查找相对路径）
+    READER_DIR = reader_dir.resolve()
     os.chdir(reader_dir)
     
     display_ip = 'localhost' if ip == '127.0.0.1' else ip
     
-    # 创建HTTP服务器
-    with socketserver.TCPServer((ip, port), CORSRequestHandler) as httpd:
-        httpd.allow_reuse_address = True
+    # 先开始监听，书名提取、电子书复制、历史记录目录和打开浏览器都放到后台进行
+    with STARTUP.phase('bind'):
+        httpd = ReaderHTTPServer((ip, port), CORSRequestHandler, listen_socket)
+    # 无界面模式（优先级：命令行参数 > 配置文件；标准输入不是终端时自动开启）
+    headless = args.headless or bool(config and config.get('headless'))
+    if not headless and not (sys.stdin and sys.stdin.isatty()):
+        headless = True
+    
+    with httpd:
+        LIFECYCLE = LifecycleManager(httpd)
+        LIFECYCLE.install_signals()
+        install_restart_signal()
+        if TRACE_RECORDER is not None:
+            LIFECYCLE.add_cleanup('请求轨迹', TRACE_RECORDER.close)
+        LIFECYCLE.add_cleanup('历史记录', PROGRESS.flush)
+        LIFECYCLE.add_cleanup('图片缩放', close_image_resizer)
+        LIFECYCLE.add_cleanup('书库', close_library)
+        LIFECYCLE.add_cleanup('位置表', close_position_tables)
+        LIFECYCLE.add_cleanup('电子书', close_books)
+        LIFECYCLE.add_cleanup('临时目录', lambda: cleanup_temp_dir(reader_dir))
+        
         print(f"服务器启动在 http://{display_ip}:{port}")
         print(f"服务目录: {reader_dir}")
-        print(f"当前书籍: {BOOK_TITLE}")
-        print(f"电子书路径: {CURRENT_BOOK_PATH}")
-        print("正在打开浏览器...")
-        print("按 ESC 键优雅地退出服务器")
+        print(f"精简视图: http://{display_ip}:{port}/{LITE_PREFIX}")
+        if _LIBRARY is not None:
+            print(f"书库: http://{display_ip}:{port}/{LIBRARY_PREFIX}")
+            print(f"OPDS目录: http://{display_ip}:{port}/{OPDS_PREFIX}")
+            threading.Thread(target=_LIBRARY.scan, name='library', daemon=True).start()
+        # 电子书文件变化后自动重新读取（优先级：命令行参数 > 配置文件）
+        if args.watch_book or (config and config.get('watch_book')):
+            watcher = BookWatcher()
+            watcher.start()
+            LIFECYCLE.add_cleanup('文件监视', watcher.stop)
+            print("电子书文件被修改或替换后将自动重新读取")
+        if headless:
+            print("无界面模式，使用Ctrl+C或SIGTERM停止服务器")
+        else:
+            print("按 ESC 键优雅地退出服务器")
+            LIFECYCLE.watch_keyboard()
         
-        # 自动打开浏览器
-        webbrowser.open(f"http://{display_ip}:{port}")
+        def _background_startup():
+            prepare_book(epub_path, reader_dir, args.title, config, payload_book)
+            # 预先生成合并脚本和预缓存清单，第一次打开页面时不用等待
+            with STARTUP.phase('bundle'):
+                get_asset_bundle()
+                get_precache_assets()
+                if BOOK_MODE == 'unpacked':
+                    get_image_resizer()
+            # 自动打开浏览器
+            if not args.no_browser:
+                with STARTUP.phase('browser'):
+                    import webbrowser
+                    print("正在打开浏览器...")
+                    webbrowser.open(f"http://{display_ip}:{port}")
+            STARTUP.report()
         
-        # 启动键盘监听线程（ESC键退出）
-        keyboard_thread = threading.Thread(target=keyboard_listener, args=(httpd, reader_dir), daemon=False)
-        keyboard_thread.start()
+        threading.Thread(target=_background_startup, name='startup', daemon=True).start()
         
+        STARTUP.mark('serving')
         try:
-            # 启动服务器
-            httpd.serve_forever()
-            print("服务器已优雅地停止")
-        except KeyboardInterrupt:
-            print("\n收到Ctrl+C，强制停止服务器")
+            LIFECYCLE.run()
         except Exception as e:
             print(f"\n服务器错误: {e}")
+            return
+        if RESTART_REQUESTED.is_set() and can_restart_in_place():
+            restart_in_place(httpd)
+        print("服务器已优雅地停止")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
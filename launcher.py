@@ -10,6 +10,10 @@ import subprocess
 import base64
 import ctypes
 import platform
+import socket
+
+# 随机端口范围
+PORT_RANGE = (55000, 65535)
 
 def get_script_dir():
     """获取脚本所在目录"""
@@ -76,7 +80,8 @@ def get_book_title_from_file(epub_path):
                     if text:
                         return text
             return Path(epub_path).stem
-    except zipfile.BadZipFile:
+    except (zipfile.BadZipFile, ET.ParseError, OSError, KeyError, RuntimeError, NotImplementedError, ValueError):
+        # 不是有效的zip、XML格式错误、读取失败、加密或不支持的压缩方式时使用文件名
         return Path(epub_path).stem
 
 def clean_filename(filename):
@@ -293,6 +298,18 @@ def create_symlink_with_admin(source, target, target_is_directory=True):
             print("权限不足，请使用sudo或管理员权限运行此脚本")
             return False
 
+def batch_escape(text, quoted=False):
+    """
+    转义批处理中的特殊字符：%在批处理文件中总要写成%%；不在引号中时&|<>()^前加^，
+    在引号中时不能转义引号本身，去掉其中的引号
+    """
+    text = text.replace('%', '%%')
+    if quoted:
+        return text.replace('"', '')
+    for char in '^&|<>()':
+        text = text.replace(char, '^' + char)
+    return text
+
 def generate_batch_script(book_title, epub_path, ip, port, script_dir):
     """生成Windows批处理脚本"""
     clean_title = clean_filename(book_title)
@@ -303,7 +320,7 @@ def generate_batch_script(book_title, epub_path, ip, port, script_dir):
     
     content = f"""@echo off
 chcp 65001 >nul
-python epub服务器.py --title "{book_title}" --epub "{epub_path}" --ip {ip} --port {port}
+python epub服务器.py --title "{batch_escape(book_title, quoted=True)}" --epub "{batch_escape(epub_path, quoted=True)}" --ip {ip} --port {port} %*
 """
     
     try:
@@ -324,7 +341,7 @@ def generate_shell_script(book_title, epub_path, ip, port, script_dir):
     server_script = "epub服务器" if getattr(sys, 'frozen', False) else "epub服务器.py"
     
     content = f"""#!/bin/bash
-python3 "{server_script}" --title "{book_title}" --epub "{epub_path}" --ip {ip} --port {port}
+python3 "{server_script}" --title "{book_title}" --epub "{epub_path}" --ip {ip} --port {port} "$@"
 """
     
     try:
@@ -338,6 +355,42 @@ python3 "{server_script}" --title "{book_title}" --epub "{epub_path}" --ip {ip}
         print(f"生成Shell脚本失败: {e}")
         return None
 
+def get_script_ports(script_dir):
+    """已生成的启动脚本使用的端口，返回{脚本文件名: 端口}（对应的服务器现在可能没有运行，探测不到）"""
+    import re
+    ports = {}
+    for pattern in ('*.bat', '*.sh'):
+        for script in script_dir.glob(pattern):
+            try:
+                match = re.search(r'--port (\d+)', script.read_text(encoding='utf-8'))
+            except (OSError, UnicodeDecodeError):
+                continue
+            if match:
+                ports[script.name] = int(match.group(1))
+    return ports
+
+def get_used_ports(script_dir):
+    """已生成的启动脚本使用的所有端口"""
+    return set(get_script_ports(script_dir).values())
+
+def is_port_free(ip, port):
+    """实际绑定一次端口，能绑定时说明没有被其他程序占用"""
+    try:
+        with socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind((ip, port))
+        return True
+    except OSError:
+        return False
+
+def find_free_port(ip, used, port_range=PORT_RANGE):
+    """在端口范围内随机选择一个没有被占用、也不在used中的端口，找不到时返回None"""
+    candidates = list(range(port_range[0], port_range[1] + 1))
+    random.shuffle(candidates)
+    for port in candidates:
+        if port not in used and is_port_free(ip, port):
+            return port
+    return None
+
 def get_user_input():
     """获取用户输入"""
     script_dir = get_script_dir()
@@ -385,16 +438,19 @@ def get_user_input():
     if not ip:
         ip = "127.0.0.1"
     
-    # 获取端口
+    # 获取端口（随机选择时跳过已被占用或已分配给其他启动脚本的端口）
     port_input = input("请输入服务器端口（直接回车为随机55000-65535）: ").strip()
+    port = None
     if port_input:
         try:
             port = int(port_input)
         except ValueError:
             print("输入无效，使用随机端口")
-            port = random.randint(55000, 65535)
-    else:
-        port = random.randint(55000, 65535)
+    if port is None:
+        port = find_free_port(ip, get_used_ports(script_dir))
+        if port is None:
+            print("找不到可用的端口!")
+            return None
     
     # 设置暂存目录并复制文件
     relative_epub_path = setup_staging_directory(epub_path, book_title, script_dir)
@@ -410,8 +466,196 @@ def get_user_input():
         'script_dir': script_dir
     }
 
+def collect_books(sources):
+    """
+    收集要处理的电子书，返回[(电子书路径, 指定的书名或None)]：
+    目录中（含子目录）的所有.epub文件，或清单文件中每行一本（"路径"或"路径<Tab>书名"，#开头为注释，
+    相对路径以清单文件所在目录为起点），也可以直接指定.epub文件
+    """
+    books = []
+    for source in sources:
+        source = Path(source)
+        if source.is_dir():
+            books += [(path, None) for path in sorted(source.rglob('*.epub')) if path.is_file()]
+        elif source.suffix.lower() == '.epub':
+            books.append((source, None))
+        elif source.is_file():
+            with open(source, 'r', encoding='utf-8-sig') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    path, _, title = line.partition('\t')
+                    path = Path(path.strip().strip('"\''))
+                    if not path.is_absolute():
+                        path = source.parent / path
+                    books.append((path, title.strip() or None))
+        else:
+            print(f"找不到: {source}")
+    
+    # 去掉重复和不存在的文件
+    result = []
+    seen = set()
+    for path, title in books:
+        key = path.resolve()
+        if key in seen:
+            continue
+        if not path.is_file():
+            print(f"文件不存在: {path}")
+            continue
+        seen.add(key)
+        result.append((path, title))
+    return result
+
+def stage_book(epub_path, book_title, script_dir):
+    """复制电子书到暂存目录（已有相同大小和修改时间的副本时不再复制），返回相对reader目录的路径"""
+    target = script_dir / "reader" / "epub" / "staging" / f"{clean_filename(book_title)}.epub"
+    try:
+        src, dst = epub_path.stat(), target.stat()
+        if src.st_size == dst.st_size and int(src.st_mtime) == int(dst.st_mtime):
+            return f"epub/staging/{target.name}"
+    except OSError:
+        pass
+    return setup_staging_directory(epub_path, book_title, script_dir)
+
+def generate_start_all_script(entries, script_dir):
+    """生成同时启动所有服务器的脚本（不打开浏览器，每本书的地址输出到终端）"""
+    import shlex
+    if os.name == 'nt':
+        start_file = script_dir / "启动全部.bat"
+        lines = ['@echo off', 'chcp 65001 >nul', 'cd /d "%~dp0"']
+        for entry in entries:
+            # echo(在内容为空或以/开头时也只输出内容；直接用start启动服务器，
+            # 不经过cmd /c call（会再展开一次%，书名中的%无法可靠转义）
+            title = batch_escape(entry["book_title"], quoted=True)
+            lines.append(f'echo({batch_escape(entry["book_title"])}  http://{entry["ip"]}:{entry["port"]}/')
+            lines.append(f'start "{title}" /min python epub服务器.py --title "{title}" '
+                         f'--epub "{batch_escape(entry["epub_path"], quoted=True)}" --ip {entry["ip"]} --port {entry["port"]} '
+                         f'--no-browser --headless')
+    else:
+        start_file = script_dir / "启动全部.sh"
+        lines = ['#!/bin/bash', 'cd "$(dirname "$0")"', '# 结束时停止所有服务器', "trap 'kill $(jobs -p) 2>/dev/null' INT TERM EXIT"]
+        for entry in entries:
+            lines.append(f'echo {shlex.quote(entry["book_title"] + "  http://" + entry["ip"] + ":" + str(entry["port"]) + "/")}')
+            lines.append(f'./{shlex.quote(entry["script"].name)} --no-browser --headless > /dev/null 2>&1 &')
+        lines.append('wait')
+    try:
+        with open(start_file, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        if os.name != 'nt':
+            start_file.chmod(0o755)
+        return start_file
+    except Exception as e:
+        print(f"生成启动全部的脚本失败: {e}")
+        return None
+
+def run_batch(sources, ip, port_start=None, jobs=None):
+    """
+    批量模式：用进程池提取所有书的书名，再并行复制电子书，为每本书探测分配不冲突的端口，
+    生成各自的启动脚本和一个同时启动所有服务器的脚本
+    """
+    import time
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    start = time.perf_counter()
+    script_dir = get_script_dir()
+    books = collect_books(sources)
+    if not books:
+        print("没有找到电子书!")
+        return 1
+    print(f"找到{len(books)}本电子书")
+    
+    # 提取书名（解析zip和OPF，按CPU核数并行），某本书提取失败时使用文件名，不影响其他书
+    missing = [path for path, title in books if not title]
+    extracted = {}
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {path: pool.submit(get_book_title_from_file, path) for path in missing}
+        for path, future in futures.items():
+            try:
+                extracted[path] = future.result()
+            except Exception as e:
+                print(f"读取书名失败，使用文件名: {path} ({e})")
+                extracted[path] = None
+    
+    # 书名相同（清理后）的书使用不同的书名，否则历史记录文件会相互覆盖
+    entries = []
+    names = set()
+    for path, title in books:
+        title = title or extracted[path] or path.stem
+        base, n = title, 1
+        while clean_filename(title).lower() in names:
+            n += 1
+            title = f"{base} ({n})"
+        names.add(clean_filename(title).lower())
+        entries.append({'book_title': title, 'source': path, 'ip': ip})
+    
+    # 复制电子书（第一本单独处理，可能需要创建暂存目录的链接）
+    entries[0]['epub_path'] = stage_book(entries[0]['source'], entries[0]['book_title'], script_dir)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        staged = pool.map(lambda entry: stage_book(entry['source'], entry['book_title'], script_dir), entries[1:])
+        for entry, epub_path in zip(entries[1:], staged):
+            entry['epub_path'] = epub_path
+    
+    # 分配端口：跳过已生成的其他启动脚本使用的端口和实际被占用的端口，
+    # 未指定起始端口时重新生成的脚本沿用原来的端口（浏览器中的书签和离线缓存仍然有效）
+    script_ports = get_script_ports(script_dir)
+    suffix = '.bat' if os.name == 'nt' else '.sh'
+    old_ports = {}
+    for entry in entries:
+        name = clean_filename(entry['book_title']) + suffix
+        if name in script_ports:
+            old_ports[name] = script_ports.pop(name)
+    used = set(script_ports.values())
+    for entry in entries:
+        old_port = old_ports.get(clean_filename(entry['book_title']) + suffix)
+        if port_start is None and old_port and old_port not in used and is_port_free(ip, old_port):
+            port = old_port
+        elif port_start is not None:
+            port = port_start
+            while port <= 65535 and (port in used or not is_port_free(ip, port)):
+                port += 1
+            port_start = port + 1
+            if port > 65535:
+                port = None
+        else:
+            port = find_free_port(ip, used | set(old_ports.values()))
+        if port is None:
+            print("可用的端口不够!")
+            return 1
+        used.add(port)
+        entry['port'] = port
+    
+    # 生成启动脚本
+    generate = generate_batch_script if os.name == 'nt' else generate_shell_script
+    generated = []
+    for entry in entries:
+        if not entry['epub_path']:
+            print(f"跳过（复制电子书失败）: {entry['source']}")
+            continue
+        entry['script'] = generate(entry['book_title'], entry['epub_path'], entry['ip'], entry['port'], script_dir)
+        if entry['script']:
+            generated.append(entry)
+    
+    start_all = generate_start_all_script(generated, script_dir) if generated else None
+    print(f"\n已生成{len(generated)}/{len(entries)}个启动脚本（用时{time.perf_counter() - start:.1f}秒）")
+    if start_all:
+        print(f"同时启动所有服务器: {start_all}")
+    return 0 if len(generated) == len(entries) else 1
+
+def parse_arguments():
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description='生成电子书服务器的启动脚本')
+    parser.add_argument('sources', nargs='*',
+                        help='电子书文件、目录或清单文件（指定时进入批量模式，不再交互询问）')
+    parser.add_argument('--ip', type=str, default='127.0.0.1', help='服务器IP（批量模式，默认127.0.0.1）')
+    parser.add_argument('--port', type=int, help='起始端口（批量模式，依次使用可用的端口，默认在55000-65535之间随机）')
+    parser.add_argument('--jobs', type=int, help='提取书名的进程数（默认为CPU核数）')
+    return parser.parse_args()
+
 def main():
     """主函数"""
+    args = parse_arguments()
+    if args.sources:
+        return run_batch(args.sources, args.ip, args.port, args.jobs)
     
     # 获取用户输入
     params = get_user_input()
@@ -445,4 +689,7 @@ def main():
         print("生成启动脚本失败!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 打包为exe时进程池需要
+    import multiprocessing
+    multiprocessing.freeze_support()
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,144 @@
+// 与服务器的集成：书籍路径、进度恢复与同步、浏览器本地缓存电子书、离线缓存
+// 服务器在页面中注入window.READER_SYNC（书籍路径、上次阅读位置、内容哈希），本文件内容固定，文件名带内容哈希可长期缓存
+(function (window) {
+  "use strict";
+
+  var config = window.READER_SYNC || {};
+  var bookPath = config.bookPath;
+  var lastSavedCfi = config.lastCFI || null;
+
+  // 覆盖书籍路径获取函数，强制使用服务器指定的路径
+  window.getBookParam = function () {
+    console.log("使用服务器指定的书籍路径:", bookPath);
+    return bookPath;
+  };
+
+  // 保存进度：每次翻页立即发送，同一位置不重复发送；keepalive保证关闭页面时也能发出
+  function saveProgress(cfi) {
+    if (!cfi || cfi === lastSavedCfi) {
+      return;
+    }
+    lastSavedCfi = cfi;
+    console.log("页面变化，保存历史记录:", cfi);
+    fetch("/api/save_history", {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ book_path: bookPath, book: config.bookKey, cfi: cfi }),
+      keepalive: true
+    }).then(function (response) {
+      return response.ok ? response.json() : null;
+    }).then(function (result) {
+      // 服务器已换书：进度已保存到原来的书，重新加载页面打开新书
+      if (result && result.book_changed) {
+        console.log("服务器已更换电子书，重新加载页面");
+        window.location.reload();
+      }
+    }).catch(function (err) {
+      console.error("保存历史记录失败:", err);
+    });
+  }
+
+  // 阅读器创建后rendition已经存在，直接监听翻页事件，不需要等待
+  function attach(reader) {
+    if (!reader || !reader.rendition) {
+      return;
+    }
+    reader.rendition.on("relocated", function (location) {
+      if (location && location.start) {
+        saveProgress(location.start.cfi);
+      }
+    });
+  }
+
+  // 包装ePubReader：使用服务器指定的路径（有本地缓存时直接使用缓存的内容）并恢复上次阅读位置
+  var originalEPubReader = window.ePubReader;
+  if (typeof originalEPubReader === "function") {
+    window.ePubReader = function (path, options) {
+      options = options || {};
+      if (config.lastCFI) {
+        options.previousLocationCfi = config.lastCFI;
+        console.log("设置上次阅读位置:", config.lastCFI);
+      }
+      var reader = originalEPubReader(window.bookArchive || bookPath, options);
+      attach(reader);
+      return reader;
+    };
+    window.ePubReader.prototype = originalEPubReader.prototype;
+  }
+
+  // 拆分模式下服务器按视口宽度和像素比缩放书中的图片，通过Cookie告诉服务器（窗口大小变化时更新）
+  if (config.viewportCookie) {
+    var resizeTimer = null;
+    var setViewportCookie = function () {
+      var dpr = Math.round((window.devicePixelRatio || 1) * 100) / 100;
+      document.cookie = config.viewportCookie + "=" + Math.round(window.innerWidth) + "x" + dpr +
+        "; path=/; max-age=31536000; SameSite=Lax";
+    };
+    setViewportCookie();
+    window.addEventListener("resize", function () {
+      clearTimeout(resizeTimer);
+      resizeTimer = setTimeout(setViewportCookie, 250);
+    });
+  }
+
+  // 离线缓存（浏览器只允许在localhost或HTTPS下注册Service Worker）
+  var serviceWorker = "serviceWorker" in navigator ? navigator.serviceWorker : null;
+  if (serviceWorker && config.serviceWorker) {
+    serviceWorker.register(config.serviceWorker).catch(function (err) {
+      console.warn("注册Service Worker失败:", err);
+    });
+    // 恢复联网后重放离线期间保存的进度
+    window.addEventListener("online", function () {
+      if (serviceWorker.controller) {
+        serviceWorker.controller.postMessage({ type: "replay" });
+      }
+    });
+  }
+
+  // 电子书按内容哈希缓存在浏览器IndexedDB中，哈希不变时不再下载
+  // （Service Worker已接管页面时由它缓存，不重复保存）
+  function loadCachedBook() {
+    var key = "book:" + config.bookHash;
+    return localforage.getItem(key).then(function (data) {
+      if (data) {
+        console.log("使用本地缓存的电子书:", config.bookHash);
+        return data;
+      }
+      return fetch(bookPath).then(function (response) {
+        if (!response.ok) {
+          throw new Error("HTTP " + response.status);
+        }
+        return response.arrayBuffer();
+      }).then(function (data) {
+        // 同一路径的旧版本电子书不再需要
+        return localforage.getItem("book-path:" + bookPath).then(function (oldHash) {
+          if (oldHash && oldHash !== config.bookHash) {
+            return localforage.removeItem("book:" + oldHash);
+          }
+        }).then(function () {
+          return localforage.setItem(key, data);
+        }).then(function () {
+          return localforage.setItem("book-path:" + bookPath, config.bookHash);
+        }).catch(function (err) {
+          console.warn("缓存电子书失败:", err);
+        }).then(function () {
+          return data;
+        });
+      });
+    });
+  }
+
+  var originalInitializeReader = window.initializeReader;
+  window.initializeReader = function () {
+    if (!config.bookHash || !window.localforage || !window.fetch || (serviceWorker && serviceWorker.controller)) {
+      return originalInitializeReader();
+    }
+    loadCachedBook().then(function (data) {
+      window.bookArchive = data;
+    }).catch(function (err) {
+      console.warn("读取本地缓存的电子书失败:", err);
+    }).then(function () {
+      originalInitializeReader();
+    });
+  };
+})(window);
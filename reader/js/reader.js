@@ -3491,7 +3491,8 @@ EPUBJS.Reader.prototype.saveSettings = function(){
         
         // 同时保存到服务器历史记录
         if (this.settings.previousLocationCfi) {
-            const bookPath = this.settings.bookPath;
+            // 从浏览器本地缓存打开时bookPath是电子书内容，改用服务器指定的路径
+            const bookPath = typeof this.settings.bookPath === 'string' ? this.settings.bookPath : getBookParam();
             const cfi = this.settings.previousLocationCfi;
             
             // 发送到服务器保存
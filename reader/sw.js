@@ -0,0 +1,205 @@
+// 离线缓存Service Worker
+// 服务器在本文件前注入PRECACHE_MANIFEST（阅读器资源和当前电子书的地址及内容哈希），内容变化时浏览器会自动更新本文件
+"use strict";
+
+const SHELL_CACHE = "reader-shell-" + PRECACHE_MANIFEST.version;
+const BOOK_CACHE = "reader-book-" + (PRECACHE_MANIFEST.book ? PRECACHE_MANIFEST.book.revision : "none");
+const PAGE_CACHE = "reader-pages";
+const QUEUE_DB = "reader-offline";
+const QUEUE_STORE = "save_history";
+const NAVIGATION_TIMEOUT = 3000;
+
+function normalize(url) {
+  const parsed = new URL(url, self.registration.scope);
+  return decodeURIComponent(parsed.pathname);
+}
+
+const SHELL_PATHS = new Set(PRECACHE_MANIFEST.assets.map((asset) => normalize(asset.url)));
+const BOOK_PATH = PRECACHE_MANIFEST.book ? normalize(PRECACHE_MANIFEST.book.url) : null;
+
+self.addEventListener("install", (event) => {
+  event.waitUntil((async () => {
+    const shell = await caches.open(SHELL_CACHE);
+    await shell.addAll(PRECACHE_MANIFEST.assets.map((asset) => new Request(asset.url, { cache: "reload" })));
+    if (PRECACHE_MANIFEST.book) {
+      // 电子书较大，缓存失败不影响安装，第一次阅读时再缓存
+      try {
+        const book = await caches.open(BOOK_CACHE);
+        await book.add(new Request(PRECACHE_MANIFEST.book.url, { cache: "reload" }));
+      } catch (err) {
+        console.warn("预缓存电子书失败:", err);
+      }
+    }
+    await self.skipWaiting();
+  })());
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil((async () => {
+    // 删除旧版本的缓存
+    const keep = new Set([SHELL_CACHE, BOOK_CACHE, PAGE_CACHE]);
+    for (const name of await caches.keys()) {
+      if (name.startsWith("reader-") && !keep.has(name)) {
+        await caches.delete(name);
+      }
+    }
+    await self.clients.claim();
+    await replayQueue();
+  })());
+});
+
+self.addEventListener("fetch", (event) => {
+  const request = event.request;
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) {
+    return;
+  }
+  if (request.method === "POST" && url.pathname === "/api/save_history") {
+    event.respondWith(saveHistory(request));
+    return;
+  }
+  if (request.method !== "GET") {
+    return;
+  }
+  if (request.mode === "navigate") {
+    event.respondWith(networkFirst(request));
+    return;
+  }
+  const path = normalize(request.url);
+  if (SHELL_PATHS.has(path)) {
+    event.respondWith(cacheFirst(SHELL_CACHE, request));
+  } else if (path === BOOK_PATH) {
+    event.respondWith(cacheFirst(BOOK_CACHE, request));
+  }
+});
+
+self.addEventListener("sync", (event) => {
+  if (event.tag === "save-history") {
+    event.waitUntil(replayQueue());
+  }
+});
+
+self.addEventListener("message", (event) => {
+  if (event.data && event.data.type === "replay") {
+    event.waitUntil(replayQueue());
+  }
+});
+
+// 资源和电子书：优先使用缓存（忽略查询参数，如字体的版本号）
+async function cacheFirst(cacheName, request) {
+  const cache = await caches.open(cacheName);
+  const cached = await cache.match(request, { ignoreSearch: true });
+  if (cached) {
+    return cached;
+  }
+  const response = await fetch(request);
+  if (response.ok) {
+    await cache.put(request, response.clone());
+  }
+  return response;
+}
+
+// 页面：注入了最新的阅读进度，优先从服务器获取，超时或离线时使用上次缓存的页面
+async function networkFirst(request) {
+  const cache = await caches.open(PAGE_CACHE);
+  try {
+    const response = await Promise.race([
+      fetch(request),
+      new Promise((resolve, reject) => setTimeout(() => reject(new Error("timeout")), NAVIGATION_TIMEOUT)),
+    ]);
+    if (response.ok) {
+      await cache.put(request, response.clone());
+      replayQueue();
+    }
+    return response;
+  } catch (err) {
+    const cached = await cache.match(request, { ignoreSearch: true }) ||
+      await cache.match(new URL("index.html", self.registration.scope).href);
+    if (cached) {
+      return cached;
+    }
+    throw err;
+  }
+}
+
+// 保存进度：离线时存入IndexedDB（记下保存的时间），恢复联网后重放（每本书只保留最新的进度）
+async function saveHistory(request) {
+  const body = await request.clone().text();
+  try {
+    const response = await fetch(request);
+    replayQueue();
+    return response;
+  } catch (err) {
+    const data = JSON.parse(body);
+    data.queued_at = Date.now();
+    await queuePut(data.book_path || "", JSON.stringify(data));
+    if (self.registration.sync) {
+      try {
+        await self.registration.sync.register("save-history");
+      } catch (syncErr) {
+        // 不支持后台同步时，等下次打开页面或联网时重放
+      }
+    }
+    return new Response(JSON.stringify({ status: "queued" }), {
+      status: 202,
+      headers: { "Content-Type": "application/json" },
+    });
+  }
+}
+
+function openQueue() {
+  return new Promise((resolve, reject) => {
+    const open = indexedDB.open(QUEUE_DB, 1);
+    open.onupgradeneeded = () => open.result.createObjectStore(QUEUE_STORE);
+    open.onsuccess = () => resolve(open.result);
+    open.onerror = () => reject(open.error);
+  });
+}
+
+function queueRequest(mode, action) {
+  return openQueue().then((db) => new Promise((resolve, reject) => {
+    const tx = db.transaction(QUEUE_STORE, mode);
+    const result = action(tx.objectStore(QUEUE_STORE));
+    tx.oncomplete = () => resolve(result.result);
+    tx.onerror = () => reject(tx.error);
+  }));
+}
+
+function queuePut(key, body) {
+  return queueRequest("readwrite", (store) => store.put(body, key));
+}
+
+let replaying = null;
+
+function replayQueue() {
+  if (!replaying) {
+    replaying = (async () => {
+      const keys = await queueRequest("readonly", (store) => store.getAllKeys());
+      for (const key of keys) {
+        const body = await queueRequest("readonly", (store) => store.get(key));
+        // 发送距离保存过了多少秒，服务器按它换算保存的时间，离线时的旧进度不会覆盖其他设备更新的进度
+        const data = JSON.parse(body);
+        if (data.queued_at) {
+          data.age = Math.max(0, (Date.now() - data.queued_at) / 1000);
+          delete data.queued_at;
+        }
+        const response = await fetch("/api/save_history", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify(data),
+        });
+        if (!response.ok) {
+          break;
+        }
+        // 重放期间又有新的进度时保留新的
+        const current = await queueRequest("readonly", (store) => store.get(key));
+        if (current === body) {
+          await queueRequest("readwrite", (store) => store.delete(key));
+        }
+      }
+    })().catch(() => {}).finally(() => {
+      replaying = null;
+    });
+  }
+  return replaying;
+}